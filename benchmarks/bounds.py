@@ -0,0 +1,176 @@
+"""
+Benchmark of gributils.bounds.bounds on a synthetic layer with the
+grid of the MetCoOp AROME model (949x739 points, 2.5km, Lambert
+conformal) and an irregular area of valid values, compared to
+projecting the contours vertex by vertex with shapely.ops.transform
+and pyproj.transform, and on a layer without missing values.
+
+Usage:
+python benchmarks/bounds.py [--repeat 3]
+"""
+
+import argparse
+import functools
+import time
+import numpy as np
+import pyproj
+import shapely
+import shapely.geometry
+import shapely.ops
+import scipy.ndimage
+import skimage.measure
+import gributils.bounds
+import gributils.projection
+
+class SyntheticLayer(object):
+    """The parts of a pygrib message used by bounds()"""
+    def __init__(self, values):
+        self.values = values
+        self.minimum = float(values.min())
+        self.maximum = float(values.max())
+        self.projparams = {"a": 6371229, "b": 6371229, "proj": "lcc",
+                           "lon_0": 15.0, "lat_0": 63.3, "lat_1": 63.3, "lat_2": 63.3}
+        self.attrs = {
+            "Nx": values.shape[1],
+            "Ny": values.shape[0],
+            "DxInMetres": 2500.0,
+            "DyInMetres": 2500.0,
+            "iScansNegatively": 0,
+            "jScansPositively": 1,
+            "latitudeOfFirstGridPointInDegrees": 50.319616,
+            "longitudeOfFirstGridPointInDegrees": 0.278280
+        }
+        self.__dict__.update(self.attrs)
+
+    def keys(self):
+        return list(self.attrs.keys())
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+def synthetic_layer(ny=949, nx=739, seed=0, all_valid=False):
+    """A layer with valid values inside a noisy ellipse, so that its
+    outline has many vertices, or everywhere if all_valid is set"""
+    rnd = np.random.default_rng(seed)
+    if all_valid:
+        return SyntheticLayer(np.ma.masked_array(rnd.normal(280, 5, size=(ny, nx)), mask=False))
+    rows, cols = np.mgrid[0:ny, 0:nx]
+    radius = ((rows - ny / 2) / (ny * 0.48)) ** 2 + ((cols - nx / 2) / (nx * 0.48)) ** 2
+    noise = scipy.ndimage.gaussian_filter(rnd.normal(size=(ny, nx)), 8) * 20
+    values = rnd.normal(280, 5, size=(ny, nx))
+    return SyntheticLayer(np.ma.masked_array(values, mask=radius + noise > 1))
+
+def contours(layer):
+    validmap = scipy.ndimage.binary_fill_holes(gributils.bounds.valid_map(layer))
+    framedvalidmap = np.zeros((validmap.shape[0] + 2, validmap.shape[1]+2))
+    framedvalidmap[1:-1, 1:-1] = validmap
+    return skimage.measure.find_contours(framedvalidmap, 0.5)
+
+class ReferenceProjection(object):
+    """A frozen copy of gributils.projection.LayerProjection as it was
+    before contours were projected as one array, projecting through
+    pyproj.transform, so that the reference does not change with the
+    code it is compared to"""
+    def __init__(self, layer):
+        self.layer = layer
+        self.projparams = layer.projparams
+        if self.projparams["proj"] in gributils.projection.latlon_projs:
+            self.projparams = {"init": 'epsg:4326'}
+            if "Nx" in layer.keys():
+                self.nx = layer.Nx
+            else:
+                self.nx = layer.Ni
+            if "Ny" in layer.keys():
+                self.ny = layer.Ny
+            else:
+                self.ny = layer.Nj
+            self.dy = (layer.latitudeOfLastGridPointInDegrees - layer.latitudeOfFirstGridPointInDegrees) / (self.ny - 1)
+            self.dx = (layer.longitudeOfLastGridPointInDegrees - layer.longitudeOfFirstGridPointInDegrees) / (self.nx  - 1)
+        else:
+            if "DxInMetres" in layer.keys():
+                self.dx = layer.DxInMetres
+            else:
+                self.dx = layer.DiInMetres
+            if "DyInMetres" in layer.keys():
+                self.dy = layer.DyInMetres
+            else:
+                self.dy = layer.DjInMetres
+
+        self.gridproj = pyproj.Proj(**self.projparams)
+        self.gridproj_over = pyproj.Proj(over=True, **self.projparams)
+        self.wgs84 = pyproj.Proj(over=True, init='epsg:4326')
+
+        self.project = functools.partial(pyproj.transform, self.wgs84, self.gridproj)
+        self.unproject = functools.partial(pyproj.transform, self.gridproj_over, self.wgs84)
+
+        self.x0, self.y0 = self.project((layer.longitudeOfFirstGridPointInDegrees + 180) % 360 - 180,
+                                        layer.latitudeOfFirstGridPointInDegrees)
+
+    def scale(self, x, y):
+        """Returns x,y in projected units (suitable for
+        self.unproject) given input in grid coordinates x_index, y_index"""
+        return self.x0 + self.dx*x, self.y0 + self.dy*y
+
+def reference_polygons(contours, proj):
+    """Projects contours vertex by vertex through shapely.ops.transform,
+    given a ReferenceProjection"""
+    validshape = shapely.geometry.MultiPolygon([(np.concatenate((cnt[:,1:], cnt[:,:1]), axis=1) - 1, [])
+                                                for cnt in contours])
+    validshape = shapely.ops.transform(proj.scale, validshape)
+    return shapely.ops.transform(proj.unproject, validshape)
+
+def reference_bounds(layer, simplify=0.01, add_buffer=0.3):
+    """bounds() using reference_polygons()"""
+    validshape = reference_polygons(contours(layer), ReferenceProjection(layer))
+    validshape = gributils.bounds.split_dateline(validshape)
+    validshape = gributils.bounds.unwrap_dateline(validshape)
+    return validshape.buffer(add_buffer).simplify(simplify)
+
+def timeit(fn, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        res = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), res
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    layer = synthetic_layer()
+    print("grid %sx%s, %s valid points" % (layer.Ny, layer.Nx, layer.values.count()))
+
+    cnts = contours(layer)
+    reference_proj = ReferenceProjection(layer)
+    proj = gributils.projection.layer_projection(layer)
+    print("%s contours, %s vertices" % (len(cnts), sum(len(cnt) for cnt in cnts)))
+    reference_time, reference = timeit(lambda: reference_polygons(cnts, reference_proj), args.repeat)
+    print("projecting contours, reference: %.3fs" % reference_time)
+    for grid_simplify in (0, 0.5):
+        projection_time, res = timeit(
+            lambda: shapely.geometry.MultiPolygon(list(gributils.bounds.contour_polygons(cnts, proj, grid_simplify))),
+            args.repeat)
+        print("projecting contours, contour_polygons(simplify=%s): %.3fs (%.1fx), %s vertices, area difference %.2e" % (
+            grid_simplify, projection_time, reference_time / projection_time,
+            len(shapely.get_coordinates(res)), reference.symmetric_difference(res).area / reference.area))
+
+    reference_time, reference = timeit(lambda: reference_bounds(layer), args.repeat)
+    print("bounds, reference: %.3fs" % reference_time)
+    for grid_simplify in (0, 0.5):
+        bounds_time, res = timeit(lambda: gributils.bounds.bounds(layer, grid_simplify=grid_simplify), args.repeat)
+        print("bounds(grid_simplify=%s): %.3fs (%.1fx), area difference %.2e" % (
+            grid_simplify, bounds_time, reference_time / bounds_time,
+            reference.symmetric_difference(res).area / reference.area))
+
+    layer = synthetic_layer(all_valid=True)
+    reference_time, reference = timeit(lambda: reference_bounds(layer), args.repeat)
+    print("all valid grid, bounds, reference: %.3fs" % reference_time)
+    bounds_time, res = timeit(lambda: gributils.bounds.bounds(layer), args.repeat)
+    print("all valid grid, bounds: %.3fs (%.1fx), area difference %.2e" % (
+        bounds_time, reference_time / bounds_time,
+        reference.symmetric_difference(res).area / reference.area))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import json
+import hashlib
+
+outputs = ("layers", "names", "units", "level-types", "levels")
+
+output_fields = {
+    "names": "parameterName",
+    "units": "parameterUnit",
+    "level-types": "typeOfLevel",
+    "levels": "level"
+}
+
+def layer_id(url, idx):
+    """Document id of a layer, so that adding a file twice replaces
+    its layers rather than duplicating them"""
+    return hashlib.sha256(("%s#%s" % (url, idx)).encode("utf-8")).hexdigest()
+
+def series_id(layer):
+    """Key identifying the series (parameter name and unit, level type
+    and level) a layer belongs to, stored with the layer as seriesKey"""
+    return json.dumps([layer["parameterName"], layer["parameterUnit"], layer["typeOfLevel"], float(layer["level"])])
+
+def check_output(output):
+    if output not in outputs:
+        raise Exception("Unknown output. Available outputs are %s" % ", ".join(outputs))
+
+class Backend(object):
+    """Storage and query interface behind GribIndex.
+
+    Grids are stored as a gridid, projparams and a polygon (WKT) of
+    the area they cover, layers as dictionaries as returned by
+    GribIndex.format_layer."""
+
+    def init_db(self):
+        """Create the database structure"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns statistics about database requests"""
+        return {}
+
+    def add_parametermap(self, name, mapping):
+        """Store a parametermap, a dictionary of parameter: (name, unit)"""
+        raise NotImplementedError
+
+    def get_parametermaps(self):
+        """Returns a list of the names of all parametermaps"""
+        raise NotImplementedError
+
+    def get_parametermap(self, name):
+        """Returns the mapping of a parametermap, or None"""
+        raise NotImplementedError
+
+    def get_grids_for_position(self, lat, lon):
+        """Returns a list of the gridids of all grids covering a point"""
+        raise NotImplementedError
+
+    def get_grids_for_bbox(self, minlon, minlat, maxlon, maxlat):
+        """Returns a dictionary of gridid: shapely polygon for all grids
+        intersecting a bounding box"""
+        raise NotImplementedError
+
+    def get_grids(self):
+        """Returns a dictionary of gridid: shapely polygon for all grids"""
+        raise NotImplementedError
+
+    def has_grid(self, gridid):
+        raise NotImplementedError
+
+    def add_grid(self, gridid, projparams, polygon):
+        raise NotImplementedError
+
+    def get_grid_for_fingerprint(self, fingerprint):
+        """Returns the gridid for a grid fingerprint, or None"""
+        raise NotImplementedError
+
+    def add_grid_fingerprint(self, fingerprint, gridid):
+        raise NotImplementedError
+
+    def add_layers(self, layers):
+        """Add (or replace, by url and idx) layers from an iterable,
+        writing them in batches as they are produced. Returns a list
+        of {"layer": layer, "error": error} for layers that could not
+        be added."""
+        raise NotImplementedError
+
+    def iter_lookup(self, output="layers", gridids=None, timestamp=None,
+                    parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                    timestamp_last_before=1, level_highest_below=True, timestamp_end=None):
+        """Yields layers matching the specified requirements, see
+        GribIndex.lookup, fetching them from the database page by page.
+        For the outputs names, units, level-types and levels, yields
+        {"key": value, "doc_count": count}, ordered by value, where
+        count is the number of distinct layers by contentHash (or url
+        when unknown) and idx."""
+        raise NotImplementedError
+
+    def has_content(self, content_hash):
+        """True if there are layers with this contentHash"""
+        raise NotImplementedError
+
+    def lookup(self, *arg, **kw):
+        """Like iter_lookup, but returns a list"""
+        return list(self.iter_lookup(*arg, **kw))
+
+    def lookup_bracket(self, timestamp, gridids=None,
+                       parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                       level_highest_below=True):
+        """Returns (last before, first after), the layers bracketing
+        timestamp in each series, as two lists of layers"""
+        filters = dict(gridids=gridids, timestamp=timestamp,
+                       parameter_name=parameter_name, parameter_unit=parameter_unit,
+                       type_of_level=type_of_level, level=level,
+                       level_highest_below=level_highest_below)
+        return (self.lookup(timestamp_last_before=1, **filters),
+                self.lookup(timestamp_last_before=0, **filters))
+
+def connect(database):
+    """Returns a backend for a database url. http(s) urls are
+    Elasticsearch servers, anything else is the path of an embedded
+    local index (optionally prefixed with sqlite://)."""
+    if database.startswith("http://") or database.startswith("https://"):
+        import gributils.esbackend
+        return gributils.esbackend.ElasticsearchBackend(database)
+    import gributils.localbackend
+    if database.startswith("sqlite://"):
+        database = database[len("sqlite://"):]
+    return gributils.localbackend.LocalBackend(database)
@@ -1,4 +1,5 @@
 import pygrib
+import shapely
 import shapely.geometry
 import shapely.ops
 import shapely.affinity
@@ -10,7 +11,7 @@ import functools
 import hashlib
 import gributils.projection
 
-def bounds(layer, fill_holes=True, simplify=0.01, add_buffer=0.3):
+def bounds(layer, fill_holes=True, simplify=0.01, add_buffer=0.3, grid_simplify=0):
     """Extracts a shapely.geometry.MultiPolygon object representing all
     areas with valid values in a grib file layer. Valid values are
     defined as grid cells with a value >= layer.minimum and <=
@@ -24,27 +25,29 @@ def bounds(layer, fill_holes=True, simplify=0.01, add_buffer=0.3):
     factor of 0.01. To not smoth the polygon, set simplify=False. Note
     that unsmothed polygons will generally be very large and therefore
     slow to plot and doing point-in-polygon tests on.
+
+    grid_simplify is a tolerance in grid cells for simplifying the
+    contours before they are projected. The default, 0, only removes
+    vertices along straight lines in grid space.
     """
     
-    validmap = (layer.values >= layer.minimum) & (layer.values <= layer.maximum)
+    validmap = valid_map(layer)
+    proj = gributils.projection.layer_projection(layer)
 
-    if fill_holes:
-        validmap = scipy.ndimage.morphology.binary_fill_holes(validmap)
-    
-    framedvalidmap = np.zeros((validmap.shape[0] + 2, validmap.shape[1]+2))
-    framedvalidmap[1:-1, 1:-1] = validmap
-    contours = skimage.measure.find_contours(framedvalidmap, 0.5)
+    rectangle = valid_rectangle(validmap)
+    if rectangle is not None:
+        # No need to trace the outline, it is given by the edges
+        contours = [rectangle_contour(*rectangle)]
+    else:
+        if fill_holes:
+            validmap = scipy.ndimage.morphology.binary_fill_holes(validmap)
 
-    def unframe(x, y):
-        return x-1, y-1        
-    
-    validshape = shapely.geometry.MultiPolygon([(np.concatenate((cnt[:,1:], cnt[:,:1]), axis=1), []) for cnt in contours])
-    validshape = shapely.ops.transform(unframe, validshape)
+        framedvalidmap = np.zeros((validmap.shape[0] + 2, validmap.shape[1]+2))
+        framedvalidmap[1:-1, 1:-1] = validmap
+        contours = skimage.measure.find_contours(framedvalidmap, 0.5)
+
+    validshape = shapely.geometry.MultiPolygon(list(contour_polygons(contours, proj, grid_simplify)))
 
-    proj = gributils.projection.LayerProjection(layer)
-    validshape = shapely.ops.transform(proj.scale, validshape)
-    validshape = shapely.ops.transform(proj.unproject, validshape)
-    
     validshape = split_dateline(validshape)
     validshape = unwrap_dateline(validshape)
 
@@ -56,6 +59,72 @@ def bounds(layer, fill_holes=True, simplify=0.01, add_buffer=0.3):
 
     return validshape
 
+def valid_rectangle(validmap):
+    """Returns (row0, row1, col0, col1) if the valid cells of a valid
+    map are exactly validmap[row0:row1, col0:col1], and None otherwise"""
+    rows = np.flatnonzero(validmap.any(axis=1))
+    cols = np.flatnonzero(validmap.any(axis=0))
+    if not len(rows):
+        return None
+    row0, row1, col0, col1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    if (row1 - row0) * (col1 - col0) != np.count_nonzero(validmap):
+        return None
+    return row0, row1, col0, col1
+
+def rectangle_contour(row0, row1, col0, col1):
+    """Returns the contour find_contours() would give for the valid
+    cells validmap[row0:row1, col0:col1] in a framed valid map: the
+    rectangle half a cell outside of the cell centers, with the
+    corners cut, in the same order."""
+    row0, row1, col0, col1 = row0 + 1, row1 + 1, col0 + 1, col1 + 1
+    return np.array([(row1 - 0.5, col1 - 1), (row1 - 0.5, col0),
+                     (row1 - 1, col0 - 0.5), (row0, col0 - 0.5),
+                     (row0 - 0.5, col0), (row0 - 0.5, col1 - 1),
+                     (row0, col1 - 0.5), (row1 - 1, col1 - 0.5),
+                     (row1 - 0.5, col1 - 1)], dtype=float)
+
+def contour_polygons(contours, proj, simplify=0, max_segment=8):
+    """Returns an array of polygons in lon/lat for contours as returned
+    by find_contours() on a valid map framed by one row/column of
+    invalid cells, simplified in grid space with the tolerance
+    simplify (in grid cells).
+
+    Straight lines in grid space are curves in lon/lat, so after
+    simplification no segment is left longer than max_segment grid
+    cells. The vertices of all contours are then projected together,
+    in a single call."""
+    lengths = [len(cnt) for cnt in contours]
+    if not lengths:
+        return np.array([], dtype=object)
+    coords = np.concatenate(contours)[:, ::-1] - 1
+    polygons = shapely.polygons(shapely.linearrings(coords, indices=np.repeat(np.arange(len(lengths)), lengths)))
+    # Removing only collinear vertices can not change the topology,
+    # and is much faster without checking it
+    polygons = shapely.simplify(polygons, simplify, preserve_topology=simplify > 0)
+    polygons = shapely.segmentize(polygons, max_segment)
+    polygons = polygons[~shapely.is_empty(polygons)]
+    coords = shapely.get_coordinates(polygons)
+    x, y = proj.scale(coords[:, 0], coords[:, 1])
+    lons, lats = proj.unproject(x, y)
+    return shapely.set_coordinates(polygons, np.column_stack((lons, lats)))
+
+def valid_map(layer):
+    """Returns a boolean array that is True for grid cells with valid
+    values in a grib file layer"""
+    values = layer.values
+    return np.ma.filled((values >= layer.minimum) & (values <= layer.maximum), False)
+
+def grid_fingerprint(layer):
+    """Returns a hash value identifying the grid geometry and the
+    valid area of a layer. Much cheaper to compute than
+    polygon_id(bounds(layer)), and layers with the same fingerprint
+    will have the same bounds."""
+    fingerprint = hashlib.sha256(gributils.projection.grid_signature(layer).encode("utf-8"))
+    validmap = valid_map(layer)
+    fingerprint.update(repr(validmap.shape).encode("utf-8"))
+    fingerprint.update(np.packbits(validmap).tobytes())
+    return fingerprint.hexdigest()
+
 def polygon_id(polygon):
     """Returns a hash value of a polygon/multipolygon"""
     return hashlib.sha256(polygon.wkb).hexdigest()
@@ -0,0 +1,149 @@
+import collections
+import threading
+
+class Cache(object):
+    """A size bounded cache. Each entry has a size given by
+    sizeof(value) (1 per entry by default), and entries are evicted
+    until the total size is within maxsize. on_evict(key, value) is
+    called for every evicted entry.
+
+    Use one of the subclasses LRUCache or LFUCache, or the policies
+    dictionary, to select the eviction policy."""
+    policy = None
+
+    def __init__(self, maxsize, sizeof=None, on_evict=None):
+        self.maxsize = maxsize
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.values = {}
+        self.sizes = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, load):
+        """Returns the value for key, calling load() to produce it if it
+        is not in the cache."""
+        with self.lock:
+            if key in self.values:
+                self.hits += 1
+                self._touch(key)
+                return self.values[key]
+            self.misses += 1
+        value = load()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.values:
+                self._remove(key)
+            while self.values and self.size + size > self.maxsize:
+                self._evict()
+            self.values[key] = value
+            self.sizes[key] = size
+            self.size += size
+            self._insert(key)
+
+    def clear(self):
+        with self.lock:
+            while self.values:
+                self._evict()
+
+    def _remove(self, key):
+        value = self.values.pop(key)
+        self.size -= self.sizes.pop(key)
+        self._discard(key)
+        return value
+
+    def _evict(self):
+        key = self._victim()
+        value = self._remove(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "policy": self.policy,
+                "entries": len(self.values),
+                "size": self.size,
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+class LRUCache(Cache):
+    """Evicts the least recently used entry first"""
+    policy = "lru"
+
+    def __init__(self, *arg, **kw):
+        Cache.__init__(self, *arg, **kw)
+        self.order = collections.OrderedDict()
+
+    def _touch(self, key):
+        self.order.move_to_end(key)
+
+    def _insert(self, key):
+        self.order[key] = None
+
+    def _discard(self, key):
+        del self.order[key]
+
+    def _victim(self):
+        return next(iter(self.order))
+
+class LFUCache(Cache):
+    """Evicts the least frequently used entry first, and among those
+    the least recently used one"""
+    policy = "lfu"
+
+    def __init__(self, *arg, **kw):
+        Cache.__init__(self, *arg, **kw)
+        self.counts = {}
+        self.buckets = collections.defaultdict(collections.OrderedDict)
+        self.mincount = 0
+
+    def _touch(self, key):
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.mincount == count:
+                self.mincount = count + 1
+        self.counts[key] = count + 1
+        self.buckets[count + 1][key] = None
+
+    def _insert(self, key):
+        self.counts[key] = 1
+        self.buckets[1][key] = None
+        self.mincount = 1
+
+    def _discard(self, key):
+        count = self.counts.pop(key)
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def _victim(self):
+        if self.mincount not in self.buckets:
+            self.mincount = min(self.buckets)
+        return next(iter(self.buckets[self.mincount]))
+
+policies = {
+    "lru": LRUCache,
+    "lfu": LFUCache
+}
@@ -1,18 +1,27 @@
 """
 Usage samples:
+gributils index --database=index.sqlite initialize
 gributils index --database="$DATABASE" add-file --filepath="/home/saghar/IG/projects/gributils/data/smhi/arome/AM25H2_201808300600+000H00M.grib"
 gributils index --database="$DATABASE" add-dir --basedir="/home/saghar/IG/projects/gributils/data/smhi/arome" 1>&2
+gributils index --database="$DATABASE" add-dir --basedir="/home/saghar/IG/projects/gributils/data/smhi/arome" --workers 8 1>&2
+gributils index --database="$DATABASE" add-dir --basedir="/home/saghar/IG/projects/gributils/data/smhi/arome" --manifest=arome.sqlite 1>&2
+gributils index --database="$DATABASE" --fieldstore=fields --store-fields add-dir --basedir="/home/saghar/IG/projects/gributils/data/smhi/arome" 1>&2
 gributils index --database="$DATABASE" lookup layers --parameter-name="Temperature" --timestamp="2018-08-30 00:04:00" 
 gributils index --database="$DATABASE" lookup layers --parameter-name="P Pressure" --timestamp="2018-08-29 00:30:00" --timestamp-last-before 1 --lat 58.496206 --lon 10.2360331
 gributils index --database="$DATABASE" interp-latlon --gribfile "/home/saghar/IG/projects/gributils/data/smhi/arome/AM25H2_201808300600+000H00M.grib" --layeridx 13 --lat 60. --lon 0.
+gributils index --database="$DATABASE" interp-latlon --gribfile "/home/saghar/IG/projects/gributils/data/smhi/arome/AM25H2_201808300600+000H00M.grib" --layeridx 13 --points track.csv
 gributils index --database="$DATABASE" interp-timestamp --parameter-name="Temperature" --timestamp "2018-09-12 08:00:00" --lat 60 --lon 30
+gributils index --database="$DATABASE" timeseries --parameter-name="Temperature" --start "2018-09-12 00:00:00" --end "2018-09-14 00:00:00" --step 3600 --lat 60 --lon 30
+gributils index --database="$DATABASE" subset --gribfile "/home/saghar/IG/projects/gributils/data/smhi/arome/AM25H2_201808300600+000H00M.grib" --layeridx 13 --minlat 55 --minlon 10 --maxlat 60 --maxlon 20 --stride 2 --output subset.npy
 """
 
 import click
 import click_datetime
 import gributils.gribindex
+import gributils.ingest
 import gributils.server
 import json
+import numpy
 
 @click.group()
 @click.pass_context
@@ -24,18 +33,37 @@ def main(ctx, **kw):
 @click.option('--filearea', default=".")
 @click.option('--host', default="0.0.0.0")
 @click.option('--port', default=1028)
+@click.option('--cache-size', default=512, help="Memory budget for decoded layers in MB")
+@click.option('--cache-files', default=10, help="Number of grib files to keep open")
+@click.option('--cache-policy', type=click.Choice(['lru', 'lfu']), default='lru')
+@click.option('--ingest-workers', default=2, help="Number of files to index concurrently")
+@click.option('--ingest-queue', default=16, help="Number of uploaded files that can wait to be indexed")
+@click.option('--fieldstore', help="Directory to store decoded layers in, so they are decoded only once")
+@click.option('--store-fields', is_flag=True, help="Store decoded layers when files are added rather than on first use")
+@click.option('--shared-cache', help="Directory (e.g. under /dev/shm) for a cache of decoded layers shared between server processes")
+@click.option('--shared-cache-size', default=1024, help="Size of the shared cache in MB")
+@click.option('--grid-ttl', default=60, help="Seconds between reloads of the grid polygons, to pick up grids added by other processes")
 @click.pass_context
-def server(ctx, database, filearea, host, port, **kw):
+def server(ctx, database, filearea, host, port, cache_size, cache_files, cache_policy, ingest_workers, ingest_queue,
+           fieldstore, store_fields, shared_cache, shared_cache_size, grid_ttl, **kw):
     gributils.server.filearea = filearea
-    gributils.server.index = gributils.gribindex.GribIndex(database)
+    gributils.server.index = gributils.gribindex.GribIndex(
+        database, cache_size=cache_size*1024**2, cache_files=cache_files, cache_policy=cache_policy,
+        fieldstore=fieldstore, store_fields=store_fields,
+        shared_cache=shared_cache, shared_cache_size=shared_cache_size*1024**2,
+        grid_ttl=grid_ttl)
+    gributils.server.ingest = gributils.ingest.IngestQueue(
+        gributils.server.index, workers=ingest_workers, size=ingest_queue)
     gributils.server.app.run(host=host, port=port)
     
 @main.group()
 @click.option('--database')
+@click.option('--fieldstore', help="Directory to store decoded layers in, so they are decoded only once")
+@click.option('--store-fields', is_flag=True, help="Store decoded layers when files are added rather than on first use")
 @click.pass_context
-def index(ctx, database, **kw):
+def index(ctx, database, fieldstore, store_fields, **kw):
     ctx.obj = {}
-    ctx.obj['index'] = gributils.gribindex.GribIndex(database)
+    ctx.obj['index'] = gributils.gribindex.GribIndex(database, fieldstore=fieldstore, store_fields=store_fields)
 
 @index.command()
 @click.pass_context
@@ -62,7 +90,7 @@ def initialize(ctx, **kw):
 @click.pass_context
 def lookup(ctx, **kw):
     pretty = kw.pop("pretty", False)
-    res = ctx.obj["index"].lookup(**kw)
+    res = ctx.obj["index"].lookup(stream=not pretty, **kw)
     if pretty:
         print(json.dumps(res, indent=2))
     else:
@@ -103,9 +131,19 @@ def grids(ctx, **kw):
 @click.option('--layeridx', type=str)
 @click.option('--lat', type=float)
 @click.option('--lon', type=float)
+@click.option('--points', type=click.File('r'), help="CSV file with lat,lon per line to interpolate at instead of --lat/--lon")
 @click.pass_context
 def interp_latlon(ctx, **kw):
-    print(ctx.obj["index"].interp_latlon(**kw))
+    points = kw.pop("points", None)
+    if points is None:
+        print(ctx.obj["index"].interp_latlon(**kw))
+        return
+    latlons = numpy.loadtxt(points, delimiter=",", ndmin=2)
+    values = ctx.obj["index"].interp_latlon_points(
+        gribfile=kw["gribfile"], layeridx=kw["layeridx"],
+        lats=latlons[:,0], lons=latlons[:,1])
+    for value in values:
+        print(value)
 
 @index.command()
 @click.option('--timestamp', type=click_datetime.Datetime(format='%Y-%m-%d %H:%M:%S'), default=None)
@@ -127,6 +165,46 @@ def interp_timestamp(ctx, **kw):
         for row in res:
             print(json.dumps(row))
             
+@index.command()
+@click.option('--start', type=click_datetime.Datetime(format='%Y-%m-%d %H:%M:%S'))
+@click.option('--end', type=click_datetime.Datetime(format='%Y-%m-%d %H:%M:%S'))
+@click.option('--step', type=float, help="Resample to this time step in seconds")
+@click.option('--parameter-name')
+@click.option('--parameter-unit')
+@click.option('--type-of-level')
+@click.option('--level', type=float)
+@click.option('--level-highest-below', is_flag=True)
+@click.option('--lat', type=float)
+@click.option('--lon', type=float)
+@click.option('--pretty', is_flag=True)
+@click.pass_context
+def timeseries(ctx, **kw):
+    pretty = kw.pop("pretty", False)
+    res = ctx.obj["index"].timeseries(**kw)
+    if pretty:
+        print(json.dumps(res, indent=2))
+    else:
+        for row in res:
+            print(json.dumps(row))
+            
+@index.command()
+@click.option('--gribfile', type=str)
+@click.option('--layeridx', type=str)
+@click.option('--minlat', type=float)
+@click.option('--minlon', type=float)
+@click.option('--maxlat', type=float)
+@click.option('--maxlon', type=float)
+@click.option('--stride', type=int, default=1, help="Only keep every stride:th row and column")
+@click.option('--output', type=str, help="NPY file to write the values to")
+@click.pass_context
+def subset(ctx, **kw):
+    output = kw.pop("output")
+    values, georef = ctx.obj["index"].subset(**kw)
+    if values is None:
+        raise click.ClickException("The bounding box is outside the grid of the layer")
+    numpy.save(output, values)
+    print(json.dumps(georef))
+
 @index.command()
 @click.option("--filepath", type=str)
 @click.option("--parametermap", type=str)
@@ -140,6 +218,8 @@ def show_error(err):
 @index.command()
 @click.option("--basedir", type=str)
 @click.option("--parametermap", type=str)
+@click.option("--workers", type=int, default=1, help="Number of processes decoding files in parallel")
+@click.option("--manifest", type=str, help="SQLite file recording added files. Unchanged files are skipped")
 @click.pass_context
 def add_dir(ctx, **kw):
     ctx.obj["index"].add_dir(**kw, cb=show_error)
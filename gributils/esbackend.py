@@ -0,0 +1,516 @@
+import json
+import time
+import threading
+import urllib.parse
+import requests
+import requests.adapters
+import urllib3.util.retry
+import shapely.wkt
+import gributils.backend
+
+# Number of hits or buckets per request when paging through results
+page_size = 1000
+
+class ElasticsearchClient(object):
+    """A shared HTTP client for an Elasticsearch server: a pool of
+    keep-alive connections, a timeout on every request, retries with
+    exponential backoff when the server is overloaded (429, 503) or
+    unreachable, and latency statistics per operation."""
+    def __init__(self, es_url, pool_size=10, timeout=60, retries=5, backoff=0.5):
+        self.es_url = es_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = urllib3.util.retry.Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 503),
+            # All requests are idempotent: documents are written by id
+            allowed_methods=None,
+            raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def request(self, operation, method, path, timeout=None, **kw):
+        """Send a request to path on the server. operation names the
+        kind of request in the statistics."""
+        start = time.time()
+        error = False
+        try:
+            return self.session.request(method, self.es_url + path,
+                                        timeout=timeout or self.timeout, **kw)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(operation, time.time() - start, error)
+
+    def get(self, operation, path, **kw):
+        return self.request(operation, "GET", path, **kw)
+
+    def post(self, operation, path, **kw):
+        return self.request(operation, "POST", path, **kw)
+
+    def put(self, operation, path, **kw):
+        return self.request(operation, "PUT", path, **kw)
+
+    def record(self, operation, duration, error):
+        with self.lock:
+            metrics = self.metrics.setdefault(operation, {
+                "requests": 0,
+                "errors": 0,
+                "time": 0.0,
+                "max": 0.0})
+            metrics["requests"] += 1
+            metrics["errors"] += error
+            metrics["time"] += duration
+            metrics["max"] = max(metrics["max"], duration)
+
+    def stats(self):
+        """Returns request counts, errors, and total, mean and max
+        latency in seconds, per operation"""
+        with self.lock:
+            return {operation: dict(metrics, mean=metrics["time"] / metrics["requests"])
+                    for operation, metrics in self.metrics.items()}
+
+def check_result(res):
+    try:
+        res.raise_for_status()
+        return res
+    except Exception as e:
+        raise Exception("%s: %s" % (e, res.content))
+
+def check_es_result(res):
+    res = check_result(res)
+    if not res.json().get('acknowledged'):
+        raise Exception(json.dumps(res.json(), indent=2))
+    return res
+
+# Counts distinct layers by contentHash (or url) and idx, so that copies
+# of a file under several urls are counted once. The count is exact up
+# to precision_threshold layers per bucket, and approximate above.
+distinct_layers = {
+    "cardinality": {
+        "script": {
+            "lang": "painless",
+            "source": "(doc['contentHash'].size() == 0 ? doc['url'].value : doc['contentHash'].value) + '#' + doc['idx'].value"
+        },
+        "precision_threshold": 40000
+    }
+}
+
+def sort_order(order):
+    """Sort on validDate, with ties broken by url and idx, all in
+    order ("asc" or "desc")"""
+    return [{"validDate": order}, {"url": order}, {"idx": order}]
+
+class ElasticsearchBackend(gributils.backend.Backend):
+    """Index stored in an Elasticsearch server"""
+    def __init__(self, es_url, bulk_docs=1000, bulk_bytes=10*1024**2, **kw):
+        """Layers are written in bulk requests of at most bulk_docs
+        layers and bulk_bytes bytes. Other keyword arguments are passed
+        on to ElasticsearchClient."""
+        self.es_url = es_url
+        self.bulk_docs = bulk_docs
+        self.bulk_bytes = bulk_bytes
+        self.client = ElasticsearchClient(es_url, **kw)
+
+    def stats(self):
+        return self.client.stats()
+
+    def init_db(self):
+        check_es_result(
+            self.client.put("admin", "/geocloud-gribfile-parametermap",
+                         json={
+                             "mappings": {
+                                 "doc": {
+                                     "properties": {
+                                         "name": {"type": "keyword"},
+                                         "mapping": {"type": "object"}
+                                     }
+                                 }
+                             }
+                         }))
+        
+        check_es_result(
+            self.client.put("admin", "/geocloud-gribfile-grid",
+                         json={
+                             "mappings": {
+                                 "doc": {
+                                     "properties": {
+                                         "gridid": {"type": "keyword"},
+                                         "projparams": {"type": "object"},
+                                         "polygon": {
+                                             "type": "geo_shape",
+                                             "strategy": "recursive"
+                                         }
+                                     }
+                                 }
+                             }
+                         }))
+
+        check_es_result(
+            self.client.put("admin", "/geocloud-gribfile-gridfingerprint",
+                         json={
+                             "mappings": {
+                                 "doc": {
+                                     "properties": {
+                                         "fingerprint": {"type": "keyword"},
+                                         "gridid": {"type": "keyword"}
+                                     }
+                                 }
+                             }
+                         }))
+
+        check_es_result(
+            self.client.put("admin", "/geocloud-gribfile-layer",
+                         json={
+                             "mappings": {
+                                 "doc": {
+                                     "properties": {
+                                         "gridid": {"type": "keyword"},
+                                         
+                                         "parameterName": {"type": "keyword"},
+                                         "parameterUnit": {"type": "keyword"},
+                                         "typeOfLevel": {"type": "keyword"},
+                                         "level": {"type": "double"},
+                                         "seriesKey": {"type": "keyword"},
+                                         
+                                         "validDate": {"type": "date"},
+                                         "analDate": {"type": "date"},
+                                         
+                                         "url": {"type": "keyword"},
+                                         "contentHash": {"type": "keyword"},
+                                         "idx": {"type": "integer"},
+                                         "offset": {"type": "long"},
+                                         "length": {"type": "long"}
+                                     }
+                                 }
+                             }
+                         }))
+
+    def add_parametermap(self, name, mapping):
+        check_result(
+            self.client.put("parametermap", "/geocloud-gribfile-parametermap/doc/%s" % urllib.parse.quote(name, safe=""), json = {
+                "name": name,
+                "mapping": mapping}))
+            
+    def get_parametermaps(self):
+        res = check_result(
+            self.client.post("parametermap", "/geocloud-gribfile-parametermap/_search",
+                          json={
+                              "_source": ["name"],
+                              "query":{
+                                  "bool": {
+                                      "must": {
+                                          "match_all": {}
+                                      }
+                                  }
+                              }
+                          }))
+        return [item["_source"]["name"] for item in res.json()["hits"]["hits"]]
+        
+    def get_parametermap(self, name):
+        res = check_result(
+            self.client.post("parametermap", "/geocloud-gribfile-parametermap/_search",
+                          json={"query":{"bool": {"must": {"term": {"name": name}}}}}))
+        res = res.json()["hits"]["hits"]
+        if len(res):
+            return res[0]["_source"]["mapping"]
+        return None
+
+    def get_grids_for_position(self, lat, lon):
+        res = check_result(
+            self.client.post("grid", "/geocloud-gribfile-grid/_search",
+                          json={
+                              "_source": ["gridid"],
+                              "query":{
+                                  "bool": {
+                                      "must": {
+                                          "match_all": {}
+                                      },
+                                      "filter": {
+                                          "geo_shape": {
+                                              "polygon": {
+                                                  "shape": {
+                                                      "type": "point",
+                                                      "coordinates": [lon, lat]
+                                                  },
+                                                  "relation": "contains"
+                                              }
+                                          }
+                                      }
+                                  }
+                              }
+                          }))
+        return [item["_source"]["gridid"] for item in res.json()["hits"]["hits"]]
+        
+    def get_grids_for_bbox(self, minlon, minlat, maxlon, maxlat):
+        res = check_result(
+            self.client.post("grid", "/geocloud-gribfile-grid/_search",
+                          json={
+                              "_source": ["gridid", "polygon"],
+                              "query":{
+                                  "bool": {
+                                      "must": {
+                                          "match_all": {}
+                                      },
+                                      "filter": {
+                                          "geo_shape": {
+                                              "polygon": {
+                                                  "shape": {
+                                                      "type": "envelope",
+                                                      "coordinates": [[minlon, maxlat], [maxlon, minlat]]
+                                                  },
+                                                  "relation": "intersects"
+                                              }
+                                          }
+                                      }
+                                  }
+                              },
+                              "size": 10000
+                          }))
+        return {hit["_source"]["gridid"]: shapely.wkt.loads(hit["_source"]["polygon"])
+                for hit in res.json()["hits"]["hits"]}
+
+    def get_grids(self):
+        res = check_result(
+            self.client.post("grid", "/geocloud-gribfile-grid/_search",
+                          json={
+                              "query": {"match_all": {}},
+                              "size": 10000
+                          }))
+        return {hit["_source"]["gridid"]: shapely.wkt.loads(hit["_source"]["polygon"])
+                for hit in res.json()["hits"]["hits"]}
+
+    def has_grid(self, gridid):
+        res = check_result(
+            self.client.post("grid", "/geocloud-gribfile-grid/_search",
+                          json={"query": {"bool": {"must": {"match": {"gridid": gridid}}}}}))
+        return res.json()["hits"]["total"] != 0
+
+    def add_grid(self, gridid, projparams, polygon):
+        check_result(
+            self.client.put("grid", "/geocloud-gribfile-grid/doc/%s" % gridid, json = {
+                "gridid": gridid,
+                "projparams": projparams,
+                "polygon": polygon}))
+
+    def get_grid_for_fingerprint(self, fingerprint):
+        res = self.client.get("grid", "/geocloud-gribfile-gridfingerprint/doc/%s" % fingerprint)
+        if res.status_code == 404:
+            return None
+        return check_result(res).json()["_source"]["gridid"]
+
+    def add_grid_fingerprint(self, fingerprint, gridid):
+        check_result(
+            self.client.put("grid", "/geocloud-gribfile-gridfingerprint/doc/%s" % fingerprint,
+                         json={"fingerprint": fingerprint, "gridid": gridid}))
+
+    def add_layers(self, layers):
+        errors = []
+        batch = []
+        size = 0
+        for layer in layers:
+            item = (json.dumps({"index": {"_index": "geocloud-gribfile-layer", "_type":"doc",
+                                          "_id": gributils.backend.layer_id(layer["url"], layer["idx"])}}) + "\n" +
+                    json.dumps(layer) + "\n")
+            if batch and (len(batch) >= self.bulk_docs or size + len(item) > self.bulk_bytes):
+                errors.extend(self.bulk(batch))
+                batch = []
+                size = 0
+            batch.append((layer, item))
+            size += len(item)
+        if batch:
+            errors.extend(self.bulk(batch))
+        return errors
+
+    def bulk(self, batch):
+        """Index a batch of (layer, bulk request item) in one request,
+        and return the per item errors"""
+        res = check_result(
+            self.client.post("bulk", "/_bulk",
+                          data = "".join(item for layer, item in batch).encode("utf-8"),
+                          headers = {'Content-Type': 'application/x-ndjson'}))
+        res = res.json()
+        if not res["errors"]:
+            return []
+        return [{"layer": layer, "error": result["index"]["error"]}
+                for (layer, item), result in zip(batch, res["items"])
+                if "error" in result["index"]]
+
+    def has_content(self, content_hash):
+        res = self.search_layers({
+            "query": {"term": {"contentHash": content_hash}},
+            "size": 0
+        })
+        total = res["hits"]["total"]
+        if isinstance(total, dict):
+            total = total["value"]
+        return total > 0
+
+    def layer_filters(self, gridids=None, parameter_name=None, parameter_unit=None,
+                      type_of_level=None, level=None, level_highest_below=True):
+        filters = []
+        if gridids is not None:
+            filters.append({
+                "terms": {
+                    "gridid": gridids
+                }
+            })
+        if parameter_name is not None:
+            filters.append({"term": {"parameterName": parameter_name}})
+        if parameter_unit is not None:
+            filters.append({"term": {"parameterUnit": parameter_unit}})
+        if type_of_level is not None:
+            filters.append({"term": {"typeOfLevel": type_of_level}})
+        if level is not None:
+            filters.append({
+                "range": {
+                    "level": {
+                        ["gte", "lte"][not not level_highest_below]: level
+                    }
+                }
+            })            
+        return filters
+
+    def search_layers(self, query):
+        #print(json.dumps(query, indent=2))
+        res = check_result(
+            self.client.post("lookup", "/geocloud-gribfile-layer/_search",
+                          json=query))
+        return res.json()
+
+    def search_hits(self, filters):
+        """Yields the source of all layers matching filters, paging
+        through them with search_after"""
+        query = {
+            "query": {
+                "bool": {"must": filters}
+            },
+            "sort": sort_order("asc"),
+            "size": page_size
+        }
+        while True:
+            hits = self.search_layers(query)["hits"]["hits"]
+            for hit in hits:
+                yield hit["_source"]
+            if len(hits) < page_size:
+                break
+            query["search_after"] = hits[-1]["sort"]
+
+    def search_buckets(self, filters, field, aggs=None):
+        """Yields the buckets of a composite aggregation on field over
+        the layers matching filters, paging through them with the
+        after key of each page"""
+        composite = {
+            "composite": {
+                "size": page_size,
+                "sources": [{"key": {"terms": {"field": field}}}]
+            }
+        }
+        if aggs is not None:
+            composite["aggs"] = aggs
+        query = {
+            "aggs" : {
+                "results": {
+                    "filter": {"bool": {"must": filters}},
+                    "aggs": {
+                        "results": composite
+                    }
+                }
+            },
+            "size": 0
+        }
+        while True:
+            res = self.search_layers(query)["aggregations"]["results"]["results"]
+            for bucket in res["buckets"]:
+                yield bucket
+            if len(res["buckets"]) < page_size:
+                break
+            composite["composite"]["after"] = res.get("after_key", res["buckets"][-1]["key"])
+
+    def iter_lookup(self, output="layers", gridids=None, timestamp=None,
+                    parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                    timestamp_last_before=1, level_highest_below=True, timestamp_end=None):
+        gributils.backend.check_output(output)
+
+        filters = self.layer_filters(gridids, parameter_name, parameter_unit,
+                                     type_of_level, level, level_highest_below)
+
+        series = False
+        if timestamp is not None and timestamp_end is not None:
+            filters.append({
+                "range" : {
+                    "validDate" : {
+                        "gte": timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                        "lte": timestamp_end.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                    }
+                }
+            })
+        elif timestamp is not None:
+            filters.append({
+                "range" : {
+                    "validDate" : {
+                        ["gte", "lte"][not not timestamp_last_before]: timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                    }
+                }
+            })
+            series = True
+
+        if not filters:
+            filters = {"match_all": {}}
+
+        if output != "layers":
+            for bucket in self.search_buckets(filters, gributils.backend.output_fields[output],
+                                              {"layers": distinct_layers}):
+                yield {"key": bucket["key"]["key"], "doc_count": bucket["layers"]["value"]}
+        elif series:
+            aggs = {
+                "results": {
+                    "top_hits": {
+                        "sort": sort_order(["asc", "desc"][not not timestamp_last_before]),
+                        "size" : 1
+                    }
+                }
+            }
+            for bucket in self.search_buckets(filters, "seriesKey", aggs):
+                for hit in bucket["results"]["hits"]["hits"]:
+                    yield hit["_source"]
+        else:
+            for layer in self.search_hits(filters):
+                yield layer
+
+    def lookup_bracket(self, timestamp, gridids=None,
+                       parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                       level_highest_below=True):
+        timestamp = timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        filters = self.layer_filters(gridids, parameter_name, parameter_unit,
+                                     type_of_level, level, level_highest_below)
+        if not filters:
+            filters = {"match_all": {}}
+
+        def side(comparison, order):
+            return {
+                "filter": {"range": {"validDate": {comparison: timestamp}}},
+                "aggs": {
+                    "results": {
+                        "top_hits": {
+                            "sort": sort_order(order),
+                            "size": 1
+                        }
+                    }
+                }
+            }
+
+        before = []
+        after = []
+        for bucket in self.search_buckets(filters, "seriesKey",
+                                          {"before": side("lte", "desc"),
+                                           "after": side("gte", "asc")}):
+            before.extend(hit["_source"] for hit in bucket["before"]["results"]["hits"]["hits"])
+            after.extend(hit["_source"] for hit in bucket["after"]["results"]["hits"]["hits"])
+        return before, after
@@ -0,0 +1,226 @@
+import os
+import contextlib
+import uuid
+import fcntl
+import threading
+import numpy as np
+import gributils.backend
+
+class FieldStore(object):
+    """Decoded layer values stored on disk as float32 .npy files,
+    keyed by url and idx, so that they can be memory mapped instead of
+    decoded from grib again. The lats and lons of grids are stored once
+    per gridid.
+
+    Arrays are written atomically, and a stored layer is ignored if
+    its grib file has been modified since it was written."""
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def layer_path(self, url, idx):
+        key = gributils.backend.layer_id(url, idx)
+        return os.path.join(self.path, "layers", key[:2], "%s.npy" % key)
+
+    def grid_path(self, gridid):
+        return os.path.join(self.path, "grids", "%s.npy" % gridid)
+
+    def read(self, path):
+        try:
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            return None
+
+    def write(self, path, data):
+        dirpath = os.path.dirname(path)
+        os.makedirs(dirpath, exist_ok=True)
+        tmppath = os.path.join(dirpath, ".%s.tmp" % uuid.uuid4())
+        try:
+            with open(tmppath, "wb") as f:
+                np.save(f, data)
+            self.replace(tmppath, path)
+        except:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+
+    def replace(self, tmppath, path):
+        os.replace(tmppath, path)
+
+    def get(self, url, idx):
+        """Returns the values of a layer as a read only memory mapped
+        array, or None if they have not been stored"""
+        path = self.layer_path(url, idx)
+        try:
+            if os.stat(path).st_mtime < os.stat(url).st_mtime:
+                return None
+        except FileNotFoundError:
+            return None
+        return self.read(path)
+
+    def put(self, url, idx, values):
+        """Store the values of a layer. Masked values are stored as NaN."""
+        self.write(self.layer_path(url, idx),
+                   np.ma.filled(np.ma.asarray(values, dtype=np.float32), np.nan))
+
+    def load(self, url, idx, decode):
+        """Returns the values of a layer, calling decode() to produce
+        and store them if they have not been stored"""
+        values = self.get(url, idx)
+        if values is not None:
+            self.hits += 1
+            return values
+        self.misses += 1
+        values = decode()
+        self.put(url, idx, values)
+        stored = self.get(url, idx)
+        if stored is not None:
+            values = stored
+        return values
+
+    def latlons(self, gridid, decode):
+        """Returns (lats, lons) for a grid, calling decode() to produce
+        and store them if they have not been stored"""
+        path = self.grid_path(gridid)
+        latlons = self.read(path)
+        if latlons is None:
+            latlons = np.array(decode(), dtype=np.float64)
+            self.write(path, latlons)
+            # Use the stored copy, unless it has already been evicted
+            stored = self.read(path)
+            if stored is not None:
+                latlons = stored
+        return latlons[0], latlons[1]
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+class SharedLayerCache(FieldStore):
+    """A FieldStore used as a cache shared by all processes on a
+    machine, typically in a tmpfs such as /dev/shm, so that a layer
+    decoded by one server process is memory mapped by all others.
+
+    The total size of the cache is bounded by maxsize bytes. Reading
+    an entry updates its mtime. The total size is kept in a file,
+    updated when entries are added, and only when an entry takes the
+    cache over maxsize is the cache scanned, to evict the least
+    recently used entries. Both happen under an exclusive flock on the
+    cache, so that processes do not update it concurrently. Evicted
+    arrays stay valid for processes that already have them mapped.
+
+    Misses are loaded from backing, another FieldStore, if given, and
+    decoded otherwise."""
+    def __init__(self, path, maxsize=1024**3, backing=None):
+        FieldStore.__init__(self, path)
+        self.maxsize = maxsize
+        self.backing = backing
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def read(self, path):
+        values = FieldStore.read(self, path)
+        if values is not None:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        return values
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock, open(os.path.join(self.path, ".lock"), "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            yield
+
+    def replace(self, tmppath, path):
+        size = os.stat(tmppath).st_size
+        with self.locked():
+            try:
+                size -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            # Read before replacing, in case the size has to be
+            # recomputed from the entries
+            total = self.read_size() + size
+            os.replace(tmppath, path)
+            if total > self.maxsize:
+                total = self.remove_lru()
+            self.write_size(total)
+
+    def read_size(self):
+        """Returns the total size of the entries. Call with the cache
+        locked."""
+        try:
+            with open(os.path.join(self.path, ".size")) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return sum(entry[1] for entry in self.entries())
+
+    def write_size(self, size):
+        with open(os.path.join(self.path, ".size"), "w") as f:
+            f.write(str(size))
+
+    def load(self, url, idx, decode):
+        if self.backing is None:
+            return FieldStore.load(self, url, idx, decode)
+        return FieldStore.load(self, url, idx, lambda: self.backing.load(url, idx, decode))
+
+    def latlons(self, gridid, decode):
+        if self.backing is None:
+            return FieldStore.latlons(self, gridid, decode)
+        return FieldStore.latlons(self, gridid, lambda: self.backing.latlons(gridid, decode))
+
+    def entries(self):
+        """Returns a list of (mtime, size, path) of all entries"""
+        res = []
+        for root, dirs, files in os.walk(self.path):
+            for filename in files:
+                if not filename.endswith(".npy"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                res.append((stat.st_mtime, stat.st_size, path))
+        return res
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is
+        within maxsize"""
+        with self.locked():
+            self.write_size(self.remove_lru())
+
+    def remove_lru(self):
+        """Remove the least recently used entries until the cache is
+        within maxsize, and return its total size. Call with the cache
+        locked."""
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        if size <= self.maxsize:
+            return size
+        entries.sort()
+        for mtime, entrysize, path in entries:
+            if size <= self.maxsize:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            size -= entrysize
+            self.evictions += 1
+        return size
+
+    def stats(self):
+        entries = self.entries()
+        return dict(FieldStore.stats(self),
+                    entries=len(entries),
+                    size=sum(entry[1] for entry in entries),
+                    maxsize=self.maxsize,
+                    evictions=self.evictions)
@@ -1,6 +1,7 @@
 import os
 import sys
 import pygrib
+import shapely
 import shapely.geometry
 import shapely.ops
 import shapely.affinity
@@ -13,178 +14,213 @@ import json
 import pyproj
 import functools
 import hashlib
+import gributils.backend
 import gributils.bounds
+import gributils.fieldstore
+import gributils.gridtree
 import gributils.layer
+import gributils.manifest
 import csv
-from datetime import datetime
-import requests
+import multiprocessing
+import threading
+import time
+from datetime import datetime, timedelta
 
-def check_result(res):
-    try:
-        res.raise_for_status()
-        return res
-    except Exception as e:
-        raise Exception("%s: %s" % (e, res.content))
-
-def check_es_result(res):
-    res = check_result(res)
-    if not res.json().get('acknowledged'):
-        raise Exception(json.dumps(res.json(), indent=2))
-    return res
-     
 class GribIndex(object):
-    def __init__(self, es_url):
-        self.es_url = es_url
+    def __init__(self, database, cache_size=512*1024**2, cache_files=10, cache_policy="lru",
+                 fieldstore=None, store_fields=False, shared_cache=None, shared_cache_size=1024**3,
+                 grid_ttl=60):
+        """database is the url of an Elasticsearch server, or the path
+        of a local index database, see gributils.backend.connect.
+
+        cache_size is the memory budget in bytes for decoded layers,
+        cache_files the number of grib files to keep open, and
+        cache_policy is either lru or lfu.
+
+        fieldstore is an optional directory for a
+        gributils.fieldstore.FieldStore of decoded layers, which are
+        then decoded from grib only once. With store_fields, layers
+        are written to it when they are added to the index, rather
+        than when they are first read.
+
+        shared_cache is an optional directory (preferably in a tmpfs
+        like /dev/shm) for a gributils.fieldstore.SharedLayerCache of
+        at most shared_cache_size bytes, shared by all processes using
+        the same directory.
+
+        Grid polygons are kept in memory, and reloaded from the
+        database every grid_ttl seconds, to pick up grids added by
+        other processes. Positions not covered by any grid in memory
+        are always checked against the database."""
+        self.database = database
+        self.fieldstore = fieldstore
+        self.store_fields = store_fields
+        self.backend = gributils.backend.connect(database)
         self.gridcache = set()
+        # Grids are looked up and registered under gridlock, so that
+        # threads adding files concurrently register each grid once
+        self.gridlock = threading.RLock()
+        self.grid_ttl = grid_ttl
+        self.gridtree = None
+        self.gridtree_loaded = 0
+        self.fingerprintcache = {}
+        self.defer_grids = False
+        self.pending_grids = {}
         self.parametermapcache = {}
-        self.gribcache = gributils.layer.GribCache()
-        self.layercache = gributils.layer.LayerCache()
+        self.gribcache = gributils.layer.GribCache(cache_files, cache_policy)
+        self.fields = gributils.fieldstore.FieldStore(fieldstore) if fieldstore is not None else None
+        fields = self.fields
+        if shared_cache is not None:
+            fields = gributils.fieldstore.SharedLayerCache(shared_cache, shared_cache_size, backing=self.fields)
+        self.layercache = gributils.layer.LayerCache(
+            cache_size, policy=cache_policy, gribcache=self.gribcache, fieldstore=fields)
+
+    def cache_stats(self):
+        """Returns hit, miss and eviction counters and sizes for the
+        layer and file caches"""
+        return self.layercache.stats()
+
+    def stats(self):
+        """Returns cache_stats, and under the key database, request
+        counts and latencies per database operation"""
+        return dict(self.cache_stats(), database=self.backend.stats())
         
     def extract_polygons(self, layer):
         shape = gributils.bounds.bounds(layer)
         return gributils.bounds.polygon_id(shape), shape
 
     def init_db(self):
-        check_es_result(
-            requests.put("%s/geocloud-gribfile-parametermap" % self.es_url,
-                         json={
-                             "mappings": {
-                                 "doc": {
-                                     "properties": {
-                                         "name": {"type": "keyword"},
-                                         "mapping": {"type": "object"}
-                                     }
-                                 }
-                             }
-                         }))
-        
-        check_es_result(
-            requests.put("%s/geocloud-gribfile-grid" % self.es_url,
-                         json={
-                             "mappings": {
-                                 "doc": {
-                                     "properties": {
-                                         "gridid": {"type": "keyword"},
-                                         "projparams": {"type": "object"},
-                                         "polygon": {
-                                             "type": "geo_shape",
-                                             "strategy": "recursive"
-                                         }
-                                     }
-                                 }
-                             }
-                         }))
-
-        check_es_result(
-            requests.put("%s/geocloud-gribfile-layer" % self.es_url,
-                         json={
-                             "mappings": {
-                                 "doc": {
-                                     "properties": {
-                                         "gridid": {"type": "keyword"},
-                                         
-                                         "parameterName": {"type": "keyword"},
-                                         "parameterUnit": {"type": "keyword"},
-                                         "typeOfLevel": {"type": "keyword"},
-                                         "level": {"type": "double"},
-                                         
-                                         "validDate": {"type": "date"},
-                                         "analDate": {"type": "date"},
-                                         
-                                         "url": {"type": "keyword"},
-                                         "idx": {"type": "integer"}                                      
-                                     }
-                                 }
-                             }
-                         }))
+        self.backend.init_db()
 
     def add_parametermap(self, name, mapping):
         parametermap = {}
         with open(mapping) as f:
             for row in csv.DictReader(f):
                 parametermap[str(row["parameter"])] = (row["name"], row["unit"])
-        
-        check_result(
-            requests.post("%s/geocloud-gribfile-parametermap/doc" % self.es_url, json = {
-                "name": name,
-                "mapping": parametermap}))
-            
+        self.backend.add_parametermap(name, parametermap)
+
     def get_parametermaps(self):
-        res = check_result(
-            requests.post("%s/geocloud-gribfile-parametermap/_search" % self.es_url,
-                          json={
-                              "_source": ["name"],
-                              "query":{
-                                  "bool": {
-                                      "must": {
-                                          "match_all": {}
-                                      }
-                                  }
-                              }
-                          }))
-        return [item["_source"]["name"] for item in res.json()["hits"]["hits"]]
-        
+        return self.backend.get_parametermaps()
+
+    def get_grid_tree(self, reload=False):
+        """Returns a GridTree of all grids. It is loaded on first use,
+        and reloaded when it is older than grid_ttl seconds, after
+        add_grid has registered a grid it did not contain, or if
+        reload is set."""
+        gridtree = self.gridtree
+        if reload or gridtree is None or time.time() - self.gridtree_loaded > self.grid_ttl:
+            loaded = time.time()
+            gridtree = gributils.gridtree.GridTree(self.backend.get_grids())
+            self.gridtree, self.gridtree_loaded = gridtree, loaded
+        return gridtree
+
+    def check_grid_tree(self, gridids):
+        """Returns the GridTree, reloaded first if it lacks any of
+        gridids, e.g. because they were added by another process"""
+        gridtree = self.get_grid_tree()
+        if any(gridid not in gridtree for gridid in gridids):
+            gridtree = self.get_grid_tree(reload=True)
+        return gridtree
+
     def get_grids_for_position(self, lat, lon):
-        res = check_result(
-            requests.post("%s/geocloud-gribfile-grid/_search" % self.es_url,
-                          json={
-                              "_source": ["gridid"],
-                              "query":{
-                                  "bool": {
-                                      "must": {
-                                          "match_all": {}
-                                      },
-                                      "filter": {
-                                          "geo_shape": {
-                                              "polygon": {
-                                                  "shape": {
-                                                      "type": "point",
-                                                      "coordinates": [lon, lat]
-                                                  },
-                                                  "relation": "contains"
-                                              }
-                                          }
-                                      }
-                                  }
-                              }
-                          }))
-        return [item["_source"]["gridid"] for item in res.json()["hits"]["hits"]]
-        
+        gridids = self.get_grid_tree().for_position(lat, lon)
+        if not gridids:
+            gridids = self.check_grid_tree(
+                self.backend.get_grids_for_position(lat, lon)).for_position(lat, lon)
+        return gridids
+
+    def get_grids_for_positions(self, lats, lons):
+        """Like get_grids_for_position, but for sequences of lats and
+        lons. Returns one list of gridids per point."""
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        gridtree = self.get_grid_tree()
+        res = gridtree.for_positions(lats, lons)
+        missing = np.array([not gridids for gridids in res], dtype=bool)
+        if missing.any():
+            reloaded = self.check_grid_tree(self.backend.get_grids_for_bbox(
+                lons[missing].min(), lats[missing].min(), lons[missing].max(), lats[missing].max()))
+            if reloaded is not gridtree:
+                res = reloaded.for_positions(lats, lons)
+        return res
+
+    def get_grids_for_bbox(self, minlon, minlat, maxlon, maxlat):
+        """Returns a dictionary of gridid: polygon for all grids
+        intersecting a bounding box"""
+        grids = self.get_grid_tree().for_bbox(minlon, minlat, maxlon, maxlat)
+        if not grids:
+            gridtree = self.check_grid_tree(self.backend.get_grids_for_bbox(minlon, minlat, maxlon, maxlat))
+            grids = gridtree.for_bbox(minlon, minlat, maxlon, maxlat)
+        return grids
+
+    def get_grid_for_fingerprint(self, fingerprint):
+        """Returns the gridid of layers with a certain
+        gributils.bounds.grid_fingerprint, or None if no such layer
+        has been added yet."""
+        if fingerprint not in self.fingerprintcache:
+            gridid = self.backend.get_grid_for_fingerprint(fingerprint)
+            if gridid is None:
+                return None
+            self.fingerprintcache[fingerprint] = gridid
+        return self.fingerprintcache[fingerprint]
+
+    def add_grid_fingerprint(self, fingerprint, gridid):
+        self.backend.add_grid_fingerprint(fingerprint, gridid)
+        self.fingerprintcache[fingerprint] = gridid
+
     def get_grid_for_layer(self, grb):
-        gridid, poly = self.extract_polygons(grb)
-        if gridid in self.gridcache:
+        fingerprint = gributils.bounds.grid_fingerprint(grb)
+        gridid = self.get_grid_for_fingerprint(fingerprint)
+        if gridid is not None:
             return gridid
-        print("Cache miss for", gridid)
-
-        res = check_result(
-            requests.post("%s/geocloud-gribfile-grid/_search" % self.es_url,
-                          json={"query": {"bool": {"must": {"match": {"gridid": gridid}}}}}))
-
-        if res.json()["hits"]["total"] == 0:
-            print("INSERT NEW GRID", repr({
-                "gridid": gridid,
-                "projparams": grb.projparams,
-                "polygon": poly.wkt}))
-            res = check_result(
-                requests.post("%s/geocloud-gribfile-grid/doc" % self.es_url, json = {
-                    "gridid": gridid,
-                    "projparams": grb.projparams,
-                    "polygon": poly.wkt}))
 
-        self.gridcache.add(gridid)
-        
+        gridid, poly = self.extract_polygons(grb)
+        with self.gridlock:
+            if self.defer_grids and gridid not in self.gridcache:
+                # Leave registration to whoever collects pending_grids
+                grid = self.pending_grids.setdefault(gridid, {
+                    "projparams": grb.projparams,
+                    "polygon": poly.wkt,
+                    "fingerprints": set()})
+                grid["fingerprints"].add(fingerprint)
+                self.fingerprintcache[fingerprint] = gridid
+                return gridid
+
+            self.add_grid(gridid, grb.projparams, poly.wkt)
+            self.add_grid_fingerprint(fingerprint, gridid)
         return gridid
 
+    def add_grid(self, gridid, projparams, polygon):
+        """Register a grid with a polygon (in WKT) unless it already exists"""
+        with self.gridlock:
+            if gridid in self.gridcache:
+                return
+            print("Cache miss for", gridid)
+
+            if not self.backend.has_grid(gridid):
+                print("INSERT NEW GRID", repr({
+                    "gridid": gridid,
+                    "projparams": projparams,
+                    "polygon": polygon}))
+                self.backend.add_grid(gridid, projparams, polygon)
+
+            if self.gridtree is not None and gridid not in self.gridtree:
+                self.gridtree = None
+            self.gridcache.add(gridid)
+
+    def add_pending_grids(self, grids):
+        """Register grids collected in pending_grids when defer_grids is set"""
+        with self.gridlock:
+            for gridid, grid in grids.items():
+                self.add_grid(gridid, grid["projparams"], grid["polygon"])
+                for fingerprint in grid["fingerprints"]:
+                    if self.fingerprintcache.get(fingerprint) != gridid:
+                        self.add_grid_fingerprint(fingerprint, gridid)
+
     def get_grid_bboxes(self):
-        res = check_result(
-            requests.post("%s/geocloud-gribfile-grid/_search" % self.es_url,
-                          json={
-                              "query": {"match_all": {}},
-                              "size": 10000
-                          }))
-        return {hit["_source"]["gridid"]: shapely.wkt.loads(hit["_source"]["polygon"]).bounds
-                for hit in res.json()["hits"]["hits"]}
-    
+        return {gridid: polygon.bounds
+                for gridid, polygon in self.get_grid_tree().grids.items()}
+
     def map_parameter(self, filepath, grb, **kw):
         parametermap = self.load_parametermap(filepath, **kw)
         parameter_name = grb.parameterName
@@ -207,23 +243,15 @@ class GribIndex(object):
             parametermap = os.path.basename(os.path.dirname(filepath))
 
         if parametermap not in self.parametermapcache:
-            res = check_result(
-                requests.post("%s/geocloud-gribfile-parametermap/_search" % self.es_url,
-                              json={"query":{"bool": {"must": {"term": {"name": parametermap}}}}}))
-            res = res.json()["hits"]["hits"]
-            if len(res):
-                self.parametermapcache[parametermap] = res[0]["_source"]["mapping"]                
-            else:
-                self.parametermapcache[parametermap] = {}
+            mapping = self.backend.get_parametermap(parametermap)
+            self.parametermapcache[parametermap] = mapping if mapping is not None else {}
                 
         return self.parametermapcache[parametermap]
-    
+
     def add_layer(self, grb, url, idx, **kw):
-        check_result(
-            requests.post("%s/geocloud-gribfile-layer/doc" % self.es_url,
-                          json = self.format_layer(grb, url, idx, **kw)))
+        self.backend.add_layers([self.format_layer(grb, url, idx, **kw)])
 
-    def format_layer(self, grb, url, idx, extra={}, **kw):
+    def format_layer(self, grb, url, idx, extra={}, offset=None, length=None, content_hash=None, **kw):
         gridid = self.get_grid_for_layer(grb)
 
         parameter_name, parameter_unit = self.map_parameter(url, grb, **kw)
@@ -235,6 +263,11 @@ class GribIndex(object):
             "parameterUnit": parameter_unit,
             "typeOfLevel": grb.typeOfLevel,
             "level": grb.level,
+            "seriesKey": gributils.backend.series_id({
+                "parameterName": parameter_name,
+                "parameterUnit": parameter_unit,
+                "typeOfLevel": grb.typeOfLevel,
+                "level": grb.level}),
 
             "validDate": grb.validDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
             "analDate": grb.analDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
@@ -242,164 +275,302 @@ class GribIndex(object):
             "url": url,
             "idx": idx
         }
+        if offset is not None:
+            res["offset"] = offset
+            res["length"] = length
+        if content_hash is not None:
+            res["contentHash"] = content_hash
         res.update(extra)
         return res
-        
-    
-    def add_file(self, filepath, **kw):
+
+    def iter_file(self, filepath, content_hash=None, **kw):
+        """Yields the formatted layers of a file as they are decoded.
+        The layers are tagged with the sha256 hash of the content of
+        the file, which is computed unless given as content_hash."""
         print("Adding file", filepath)
-        with pygrib.open(filepath) as grbs:
-            layers = [self.format_layer(grb, filepath, grb_idx+1, **kw)
-                      for grb_idx, grb in enumerate(grbs)]
-        data = "".join(
-            json.dumps({"index": {"_index": "geocloud-gribfile-layer", "_type":"doc"}}) + "\n" +
-            json.dumps(layer) + "\n"
-            for layer in layers)
-        res = check_result(
-            requests.post("%s/_bulk" % self.es_url,
-                          data = data,
-                          headers = {'Content-Type': 'application/json'}))
-        assert not res.json()["errors"], repr(res.json())
-            
-    def add_dir(self, basedir, cb, **kw):
+        if content_hash is None:
+            content_hash = gributils.manifest.file_hash(filepath)
+        fieldstore = self.fields if self.store_fields else None
+        for grb_idx, (grb, offset, length) in enumerate(gributils.layer.read_messages(filepath)):
+            layer = self.format_layer(grb, filepath, grb_idx+1, offset=offset, length=length,
+                                      content_hash=content_hash, **kw)
+            if fieldstore is not None:
+                fieldstore.put(filepath, grb_idx+1, grb.values)
+                fieldstore.latlons(layer["gridid"], grb.latlons)
+            yield layer
+
+    def format_file(self, filepath, **kw):
+        return list(self.iter_file(filepath, **kw))
+
+    def add_layers(self, layers, cb=None):
+        """Add layers from an iterable. They are written in bounded
+        batches as they are produced. Layers that could not be added
+        are reported to cb, in the same format as errors from add_dir,
+        or if cb is None, raised as an exception once all others have
+        been written. Returns the list of errors."""
+        errors = self.backend.add_layers(layers)
+        if cb is not None:
+            for error in errors:
+                cb({
+                    "file": error["layer"]["url"],
+                    "idx": error["layer"]["idx"],
+                    "error": error["error"]
+                    })
+        elif errors:
+            raise Exception("Unable to add %s layers: %s" % (
+                len(errors), "; ".join("%s#%s: %s" % (error["layer"]["url"], error["layer"]["idx"], error["error"])
+                                       for error in errors[:10])))
+        return errors
+
+    def has_content(self, content_hash):
+        """True if a file with this sha256 content hash has been added"""
+        return self.backend.has_content(content_hash)
+
+    def add_file(self, filepath, cb=None, **kw):
+        """Add all layers of a file, streaming them to the index as
+        they are decoded. See add_layers for cb."""
+        self.add_layers(self.iter_file(filepath, **kw), cb)
+
+    def find_files(self, basedir):
         for root, dirs, files in os.walk(basedir):
             for filename in files:
                 if not (filename.endswith(".grib") or filename.endswith(".grb")): continue
-                filepath = os.path.abspath(os.path.join(root, filename))
+                yield os.path.abspath(os.path.join(root, filename))
+
+    def add_dir(self, basedir, cb, workers=1, manifest=None, **kw):
+        """Add all grib files in a directory tree. Errors are reported
+        per file to cb, and per layer for layers the index rejects.
+
+        With workers > 1, files are decoded and formatted in that many
+        worker processes, while this process registers new grids and
+        writes the layers to the index as they come in.
+
+        manifest is an optional path to an IngestManifest database.
+        Files recorded there as added, that have not changed since,
+        are skipped. Files are recorded as soon as their layers have
+        been written, so an interrupted run can be restarted with the
+        same manifest and will continue where it stopped."""
+        if manifest is not None:
+            manifest = gributils.manifest.IngestManifest(manifest)
+
+        def jobs():
+            for filepath in self.find_files(basedir):
+                if manifest is None:
+                    yield filepath, False, None, kw
+                    continue
+                try:
+                    if manifest.unchanged(filepath):
+                        continue
+                    entry = manifest.get(filepath)
+                except Exception as e:
+                    cb({
+                        "file": filepath,
+                        "error": e
+                        })
+                    continue
+                yield filepath, True, entry and entry["hash"], kw
+
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, _init_ingest_worker,
+                                        (self.database, self.fieldstore, self.store_fields))
+            results = pool.imap_unordered(_ingest_worker, jobs())
+        else:
+            pool = None
+            # Layers are written as they are decoded
+            results = (self.ingest_job(job, stream=True) for job in jobs())
+
+        try:
+            for filepath, layers, grids, state, error in results:
                 try:
-                    self.add_file(filepath, **kw)
+                    if error is not None:
+                        raise error
+                    if layers is not None:
+                        self.add_pending_grids(grids)
+                        if self.add_layers(layers, cb):
+                            # Leave the file out of the manifest, so
+                            # that it is retried on the next run
+                            continue
+                    if state is not None:
+                        manifest.set(filepath, *state)
                 except Exception as e:
                     cb({
                         "file": filepath,
                         "error": e
                         })
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if manifest is not None:
+                manifest.close()
+
+    def ingest_job(self, job, stream=False):
+        """Formats the layers of a file for add_dir. Returns (filepath,
+        layers, pending grids, file state, error). layers is None if
+        the content of the file is unchanged since it was last added.
+
+        layers is a list, as needed to pass it back from a worker
+        process, or with stream, a generator decoding the layers as it
+        is consumed. Decoding errors are then raised by the
+        generator."""
+        filepath, incremental, known_hash, kw = job
+        state = None
+        try:
+            content_hash = None
+            if incremental:
+                state = gributils.manifest.file_state(filepath)
+                content_hash = state[2]
+                if content_hash == known_hash:
+                    return filepath, None, {}, state, None
+            if stream:
+                layers = self.iter_file(filepath, content_hash=content_hash, **kw)
+            else:
+                layers = self.format_file(filepath, content_hash=content_hash, **kw)
+        except Exception as e:
+            return filepath, None, {}, None, e
+        grids = self.pending_grids
+        self.pending_grids = {}
+        return filepath, layers, grids, state, None
 
     def lookup(self, output="layers",
                lat=None, lon=None, timestamp=None, parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
-               timestamp_last_before=1, level_highest_below=True):
-        """Return a set of griblayers matching the specified requirements"""
-        
-        aggregation = None
-        
-        if output == "layers":
-            pass
-        elif output == "names":
-            aggregation = {"terms": {"field": "parameterName"}}
-        elif output == "units":
-            aggregation = {"terms": {"field": "parameterUnit"}}
-        elif output == "level-types":
-            aggregation = {"terms": {"field": "typeOfLevel"}}
-        elif output == "levels":
-            aggregation = {"terms": {"field": "level"}}
-        else:
-            raise Exception("Unknown output. Available outputs are layers, names, units, level-types, levels")
+               timestamp_last_before=1, level_highest_below=True, gridids=None, timestamp_end=None,
+               stream=False):
+        """Return a set of griblayers matching the specified requirements
+
+        Instead of lat/lon, a list of gridids can be given directly. If
+        timestamp_end is given, all layers with a validDate between
+        timestamp and timestamp_end are returned, instead of the last
+        layer before / first layer after timestamp.
+
+        Results are not limited in number. With stream=True, a
+        generator is returned that fetches them from the database page
+        by page as it is consumed, instead of a list.
+
+        Layers of identical files added under different urls are
+        returned, and counted in doc_count, only once."""
+
+        gributils.backend.check_output(output)
 
         if lat is not None:
             assert lon is not None, "lat and lon must both be set, or must both be left unset"
             
             gridids = self.get_grids_for_position(lat, lon)
 
-        filters = []
-        if lat is not None and lon is not None:
-            filters.append({
-                "terms": {
-                    "gridid": gridids
-                }
-            })
-
-        if timestamp is not None:
-            filters.append({
-                "range" : {
-                    "validDate" : {
-                        ["gte", "lte"][not not timestamp_last_before]: timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-                    }
-                }
-            })
-            if aggregation is None:
-                aggregation = {
-                    "terms": {
-                        "script" : {
-                            "source": "doc.parameterName + \"-\" + doc.parameterUnit + \"-\" + doc.typeOfLevel + \"-\" + doc.level",
-                            "lang": "painless"
-                        },
-                        "size": 100000
-                    },
-                    "aggs": {
-                        "results": {
-                            "top_hits": {
-                                "sort": [
-                                    {"validDate": {"order": ["asc", "desc"][not not timestamp_last_before]}}
-                                ],
-                                "size" : 1
-                            }
-                        }
-                    }
-                }
-        if parameter_name is not None:
-            filters.append({"term": {"parameterName": parameter_name}})
-        if parameter_unit is not None:
-            filters.append({"term": {"parameterUnit": parameter_unit}})
-        if type_of_level is not None:
-            filters.append({"term": {"typeOfLevel": type_of_level}})
-        if level is not None:
-            filters.append({
-                "range": {
-                    "level": {
-                        ["gte", "lte"][not not level_highest_below]: level
-                    }
-                }
-            })            
-
-        if not filters:
-            filters = {"match_all": {}}
-
-        if aggregation:
-            query = {
-                "aggs" : {
-                    "results": {
-                        "filter": {"bool": {"must": filters}},
-                        "aggs": {
-                            "results": aggregation
-                        }
-                    }
-                },
-                "size": 0
-            }
-        else:
-            query = {
-                "query": {
-                    "bool": {"must": filters}
-                },
-                "size": 10000
-            }
-
-        #print(json.dumps(query, indent=2))
-            
-        res = check_result(
-            requests.post("%s/geocloud-gribfile-layer/_search" % self.es_url,
-                          json=query))
-        res = res.json()
-
-        if aggregation is not None:
-            res = res["aggregations"]["results"]["results"]["buckets"]
-            if res and "results" in res[0]:
-                res = [subentry["_source"]
-                       for entry in res
-                       for subentry in entry["results"]["hits"]["hits"]]
-        else:
-            res = [item["_source"] for item in res["hits"]["hits"]]
-        return res
+        res = self.backend.iter_lookup(output, gridids, timestamp,
+                                       parameter_name, parameter_unit, type_of_level, level,
+                                       timestamp_last_before, level_highest_below, timestamp_end)
+        if output == "layers":
+            res = unique_layers(res)
+        if stream:
+            return res
+        return list(res)
     
+    def lookup_bracket(self, lat=None, lon=None, timestamp=None,
+                       parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                       level_highest_below=True, gridids=None):
+        """Returns (last before, first after): for each series matching
+        the requirements, the layers immediately before and after
+        timestamp, fetched in a single query"""
+        if lat is not None:
+            assert lon is not None, "lat and lon must both be set, or must both be left unset"
+            gridids = self.get_grids_for_position(lat, lon)
+
+        return self.backend.lookup_bracket(timestamp, gridids,
+                                           parameter_name, parameter_unit, type_of_level, level,
+                                           level_highest_below)
+
+    def get_layer(self, entry):
+        """Returns the (cached) layer for an entry returned by lookup"""
+        return self.layercache.get(entry["url"], entry["idx"], entry.get("gridid"),
+                                   entry.get("offset"), entry.get("length"))
+
     def interp_latlon(self,
                      gribfile=None, layeridx=None,
                      lat=None, lon=None):
 
         try:
             layer = self.layercache.get(gribfile, int(layeridx))
-            return layer.interpolate(lat, lon)[0]
+            value = layer.interpolate(lat, lon)[0]
         except Exception as e:
             print('Unable to load layer:', e)
             return None
+        return value_or_none(value)
+
+    def interp_latlon_points(self,
+                             gribfile=None, layeridx=None,
+                             lats=None, lons=None):
+        """Interpolate a layer at many points at once. lats and lons
+        are arrays (or lists) of the same length. Returns an array of
+        values, with NaN for points outside the layer."""
+        layer = self.layercache.get(gribfile, int(layeridx))
+        return layer.interpolate(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+
+    def subset(self, gribfile=None, layeridx=None,
+               minlat=None, minlon=None, maxlat=None, maxlon=None, stride=1):
+        """Returns (values, georef): the values of a layer inside a
+        lat/lon bounding box, as a float32 array (NaN for missing
+        values) taking every stride:th row and column, and a dictionary
+        describing how it maps onto the grid of the layer.
+
+        The window is the smallest one covering the bounding box on
+        the grid, so for projected grids it will contain some points
+        outside of the bounding box. Row r, column c of values is the
+        grid point at x = x0 + c * dx, y = y0 + r * dy in the
+        projection projparams (x is longitude and y latitude for
+        lat/lon grids). values is None if the bounding box is outside
+        the grid."""
+        stride = int(stride)
+        layer = self.layercache.get(gribfile, int(layeridx))
+        data = layer.interpolate.data
+        mapper = layer.interpolate.mapper
+        georef = {
+            "projparams": mapper.proj.projparams,
+            "validDate": layer.layer.validDate.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "gridShape": list(data.shape)
+        }
+        window = mapper.window(minlat, minlon, maxlat, maxlon, data.shape)
+        if window is None:
+            return None, georef
+        row0, row1, col0, col1 = window
+        values = np.asarray(data[row0:row1:stride, col0:col1:stride], dtype=np.float32)
+        georef.update({
+            "shape": list(values.shape),
+            "window": [row0, row1, col0, col1],
+            "stride": stride,
+            "x0": mapper.x0 + col0 * mapper.dx,
+            "y0": mapper.y0 + row0 * mapper.dy,
+            "dx": mapper.dx * stride,
+            "dy": mapper.dy * stride
+        })
+        return values, georef
+
+    def synthesize_uv_entries(self, entries):
+        """Pass through layer entries, adding synthetic Azimuth and
+        Magnitude entries for each pair of U and V component layers
+        in the same file"""
+        components = {"U": {}, "V": {}}
+        for entry in entries:
+            if " component of " in entry["parameterName"]:
+                compname, name = entry["parameterName"].split(" component of ", 1)
+                if compname in components:
+                    components[compname][(name, entry["parameterUnit"], entry["typeOfLevel"], entry["level"], entry["validDate"], entry["url"])] = entry
+            yield entry
+        for key, entryU in components["U"].items():
+            entryV = components["V"].get(key)
+            if entryV is None:
+                continue
+            for component in ("azimuth", "magnitude"):
+                entry = dict(entryU)
+                entry["idx"] = (entryU["idx"], entryV["idx"], component)
+                entry["parameterName"] = "%s component of %s" % (component.capitalize(), key[0])
+                entry["seriesKey"] = gributils.backend.series_id(entry)
+                if "offset" in entryU and "offset" in entryV:
+                    entry["offset"] = (entryU["offset"], entryV["offset"])
+                    entry["length"] = (entryU["length"], entryV["length"])
+                else:
+                    entry.pop("offset", None)
+                    entry.pop("length", None)
+                yield entry
 
     def interp_timestamp(self, lat=None, lon=None, timestamp=None,
                          parameter_name=None, parameter_unit=None,
@@ -408,35 +579,12 @@ class GribIndex(object):
 
         # FIXME: Interpolate along levels too maybe?
 
-        if isinstance(timestamp, str):
-            try:
-                timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-            except:
-                timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
-        timestamp_int = int(timestamp.strftime("%s"))
-
-        def synthesize_uv_entries(entries):
-            components = {"U": {}, "V": {}}
-            for entry in entries:
-                if " component of " in entry["parameterName"]:
-                    compname, name = entry["parameterName"].split(" component of ")
-                    components[compname][(name, entry["parameterUnit"], entry["typeOfLevel"], entry["level"], entry["validDate"])] = entry
-                yield entry
-            for key, entryU in components["U"].items():
-                entryV = components["V"][key]
-                entry = dict(entryU)
-                entry["idx"] = (entryU["idx"], entryV["idx"], "azimuth")
-                entry["parameterName"] = "Azimuth component of %s" % key[0]
-                yield entry
-                entry = dict(entryU)
-                entry["idx"] = (entryU["idx"], entryV["idx"], "magnitude")
-                entry["parameterName"] = "Magnitude component of %s" % key[0]
-                yield entry
-                
+        timestamp = parse_timestamp(timestamp)
+        timestamp_int = timestamp_to_int(timestamp)
+
         def to_map(entries):
             return {
-                (entry["parameterName"], entry["parameterUnit"], entry["typeOfLevel"], entry["level"]):
-                self.layercache.get(entry["url"], entry["idx"])
+                series_key(entry): self.get_layer(entry)
                 for entry in entries}
 
         def interpolate_parameter(data_last_before, data_first_after):
@@ -457,26 +605,225 @@ class GribIndex(object):
         
             return float(f(timestamp_int))
         
-        layer_last_before =  to_map(
-            synthesize_uv_entries(
-                self.lookup(output="layers",
-                            lat=lat, lon=lon, timestamp=timestamp,
-                            parameter_name=parameter_name, parameter_unit=parameter_unit,
-                            type_of_level=type_of_level, level=level,
-                            timestamp_last_before=1, level_highest_below=level_highest_below)))
-        
-        layer_first_after = to_map(
-            synthesize_uv_entries(
-                self.lookup(output="layers",
-                            lat=lat, lon=lon, timestamp=timestamp,
-                            parameter_name=parameter_name, parameter_unit=parameter_unit,
-                            type_of_level=type_of_level, level=level,
-                            timestamp_last_before=0, level_highest_below=level_highest_below)))
+        entries_last_before, entries_first_after = self.lookup_bracket(
+            lat=lat, lon=lon, timestamp=timestamp,
+            parameter_name=parameter_name, parameter_unit=parameter_unit,
+            type_of_level=type_of_level, level=level,
+            level_highest_below=level_highest_below)
+        layer_last_before = to_map(self.synthesize_uv_entries(entries_last_before))
+        layer_first_after = to_map(self.synthesize_uv_entries(entries_first_after))
 
         return [{"parameterName": key[0],
                  "parameterUnit": key[1],
                  "typeOfLevel": key[2],
                  "level": key[3],
-                 "value": interpolate_parameter(layer_last_before[key], layer_first_after[key])}
+                 "value": value_or_none(interpolate_parameter(layer_last_before[key], layer_first_after[key]))}
                 for key in layer_last_before.keys()
                 if key in layer_first_after]
+
+    def timeseries(self, lat=None, lon=None, start=None, end=None,
+                   parameter_name=None, parameter_unit=None,
+                   type_of_level=None, level=None,
+                   level_highest_below=True, step=None):
+        """Returns the values at a point of all layers with a validDate
+        between start and end, as one entry per series (parameter name,
+        unit, level type and level) with the lists validDate and value,
+        sorted by validDate. Where layers from several forecasts have
+        the same validDate, the one with the latest analDate is used.
+
+        If step (in seconds, or a timedelta) is given, each series is
+        instead linearly interpolated to the times start, start +
+        step, ... up to end. Values outside the time span of a series
+        are NaN.
+
+        All layers are found with a single lookup."""
+        start = parse_timestamp(start)
+        end = parse_timestamp(end)
+
+        entries = self.lookup(output="layers", lat=lat, lon=lon,
+                              timestamp=start, timestamp_end=end,
+                              parameter_name=parameter_name, parameter_unit=parameter_unit,
+                              type_of_level=type_of_level, level=level,
+                              level_highest_below=level_highest_below)
+
+        series = {}
+        for entry in self.synthesize_uv_entries(entries):
+            steps = series.setdefault(series_key(entry), {})
+            previous = steps.get(entry["validDate"])
+            if previous is None or previous["analDate"] < entry["analDate"]:
+                steps[entry["validDate"]] = entry
+
+        if step is not None:
+            if isinstance(step, timedelta):
+                step = step.total_seconds()
+            times = np.arange(timestamp_to_int(start), timestamp_to_int(end) + 1, step)
+            # The inverse of timestamp_to_int
+            dates = [datetime.fromtimestamp(time).strftime("%Y-%m-%dT%H:%M:%S.%fZ") for time in times]
+
+        res = []
+        for key, steps in sorted(series.items()):
+            valid_dates = sorted(steps.keys())
+            values = np.array([self.get_layer(steps[valid_date]).interpolate(lat, lon)[0]
+                               for valid_date in valid_dates])
+            if step is not None:
+                layer_times = np.array([timestamp_to_int(parse_timestamp(valid_date)) for valid_date in valid_dates])
+                values = np.interp(times, layer_times, values, left=np.nan, right=np.nan)
+                valid_dates = dates
+            res.append({"parameterName": key[0],
+                        "parameterUnit": key[1],
+                        "typeOfLevel": key[2],
+                        "level": key[3],
+                        "validDate": valid_dates,
+                        "value": [float(value) for value in values]})
+        return res
+
+    def interp_track(self, lats=None, lons=None, timestamps=None,
+                     parameter_name=None, parameter_unit=None,
+                     type_of_level=None, level=None,
+                     level_highest_below=True):
+        """Like interp_timestamp, but for a whole track of points given
+        as equal length sequences of lats, lons and timestamps. Returns
+        one list of parameter values per point, in the same format as
+        interp_timestamp.
+
+        The layers needed are resolved with two queries per grid in the
+        bounding box of the track and one over its whole time span, and
+        points sharing the same pair of layers are interpolated
+        together. Layers with the same validDate are ordered by url and
+        idx, as by the backends."""
+
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+        timestamps = [parse_timestamp(timestamp) for timestamp in timestamps]
+        timestamps_int = np.array([timestamp_to_int(timestamp) for timestamp in timestamps])
+        results = [[] for idx in range(len(lats))]
+        if not len(results):
+            return results
+
+        filters = dict(parameter_name=parameter_name, parameter_unit=parameter_unit,
+                       type_of_level=type_of_level, level=level,
+                       level_highest_below=level_highest_below)
+
+        point_grids = self.get_grids_for_positions(lats, lons)
+        gridids = sorted(set(gridid for grids in point_grids for gridid in grids))
+        if not gridids:
+            return results
+        grid_idx = {gridid: idx for idx, gridid in enumerate(gridids)}
+        # covered[g, p] is True if grid gridids[g] contains point p
+        covered = np.zeros((len(gridids), len(lats)), dtype=bool)
+        for point, grids in enumerate(point_grids):
+            covered[[grid_idx[gridid] for gridid in grids], point] = True
+        # Points covered by the same set of grids can use the same layers
+        coverages, coverage_points = np.unique(covered.T, axis=0, return_inverse=True)
+        coverage_points = coverage_points.ravel()
+
+        # Find the time span needed to bracket all points for all
+        # series. A point is bracketed by layers on the grids covering
+        # it, so the span must include the bracketing layers on each
+        # grid, not just the closest ones over all grids.
+        first = start = min(timestamps)
+        last = end = max(timestamps)
+        for gridid in gridids:
+            before = self.lookup(output="layers", gridids=[gridid], timestamp=first,
+                                 timestamp_last_before=1, **filters)
+            after = self.lookup(output="layers", gridids=[gridid], timestamp=last,
+                                timestamp_last_before=0, **filters)
+            if before:
+                start = min(start, min(parse_timestamp(entry["validDate"]) for entry in before))
+            if after:
+                end = max(end, max(parse_timestamp(entry["validDate"]) for entry in after))
+        entries = self.lookup(output="layers", gridids=gridids,
+                              timestamp=start, timestamp_end=end, **filters)
+
+        series = {}
+        for entry in self.synthesize_uv_entries(entries):
+            series.setdefault(series_key(entry), []).append(entry)
+
+        for key, entries in series.items():
+            entries.sort(key=lambda entry: (entry["validDate"], entry["url"], entry["idx"]))
+            entry_times = np.array([timestamp_to_int(parse_timestamp(entry["validDate"])) for entry in entries])
+            entry_grids = np.array([grid_idx[entry["gridid"]] for entry in entries])
+
+            pairs = {}
+            for coverage_idx, coverage in enumerate(coverages):
+                points = np.nonzero(coverage_points == coverage_idx)[0]
+                candidates = np.nonzero(coverage[entry_grids])[0]
+                if not len(candidates):
+                    continue
+                times = entry_times[candidates]
+                idx_before = np.searchsorted(times, timestamps_int[points], "right") - 1
+                idx_after = np.searchsorted(times, timestamps_int[points], "left")
+                valid = (idx_before >= 0) & (idx_after < len(times))
+                for point, idx_b, idx_a in zip(points[valid], idx_before[valid], idx_after[valid]):
+                    pairs.setdefault((candidates[idx_b], candidates[idx_a]), []).append(point)
+
+            for (idx_b, idx_a), points in pairs.items():
+                points = np.array(points)
+                entry_b = entries[idx_b]
+                entry_a = entries[idx_a]
+                values_b = self.get_layer(entry_b).interpolate(lats[points], lons[points])
+                if entry_times[idx_b] == entry_times[idx_a]:
+                    # The points are at the validDate of the layers.
+                    # Like interp_timestamp, use the last one before
+                    values = values_b
+                else:
+                    values_a = self.get_layer(entry_a).interpolate(lats[points], lons[points])
+                    weight = (timestamps_int[points] - entry_times[idx_b]) / (entry_times[idx_a] - entry_times[idx_b])
+                    values = values_b + (values_a - values_b) * weight
+                for point, value in zip(points, values):
+                    results[point].append({"parameterName": key[0],
+                                           "parameterUnit": key[1],
+                                           "typeOfLevel": key[2],
+                                           "level": key[3],
+                                           "value": value_or_none(value)})
+        return results
+
+_worker_index = None
+
+def _init_ingest_worker(database, fieldstore, store_fields):
+    global _worker_index
+    _worker_index = GribIndex(database, fieldstore=fieldstore, store_fields=store_fields)
+    _worker_index.defer_grids = True
+
+def _ingest_worker(job):
+    return _worker_index.ingest_job(job)
+
+def unique_layers(entries):
+    """Pass through layer entries, dropping layers from a file whose
+    content (by contentHash) has already been seen under another url.
+
+    Copies of a layer have the same validDate, and the backends return
+    layers sorted by validDate (or one per series), so only the layers
+    at the current validDate are remembered."""
+    seen = set()
+    valid_date = None
+    for entry in entries:
+        if entry["validDate"] != valid_date:
+            seen = set()
+            valid_date = entry["validDate"]
+        key = (entry.get("contentHash") or entry["url"], entry["idx"])
+        if key in seen:
+            continue
+        seen.add(key)
+        yield entry
+
+def parse_timestamp(timestamp):
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+        except:
+            timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    return timestamp
+
+def timestamp_to_int(timestamp):
+    return int(timestamp.strftime("%s"))
+
+def series_key(entry):
+    return (entry["parameterName"], entry["parameterUnit"], entry["typeOfLevel"], entry["level"])
+
+def value_or_none(value):
+    """Returns value as a float, or None for NaN (points outside of
+    the valid area of a layer)"""
+    if np.isnan(value):
+        return None
+    return float(value)
@@ -0,0 +1,39 @@
+import numpy as np
+import shapely
+
+class GridTree(object):
+    """Spatial index of grid polygons (a dictionary of gridid:
+    polygon), for resolving positions to grids without a database
+    query."""
+    def __init__(self, grids):
+        self.grids = grids
+        self.gridids = np.array(sorted(grids.keys()), dtype=object)
+        self.polygons = [grids[gridid] for gridid in self.gridids]
+        shapely.prepare(self.polygons)
+        self.tree = shapely.STRtree(self.polygons)
+
+    def __len__(self):
+        return len(self.gridids)
+
+    def __contains__(self, gridid):
+        return gridid in self.grids
+
+    def for_position(self, lat, lon):
+        """Returns a list of the gridids of all grids covering a point"""
+        return self.for_positions([lat], [lon])[0]
+
+    def for_positions(self, lats, lons):
+        """Returns, for each of a sequence of points, the list of the
+        gridids of all grids covering it"""
+        points = shapely.points(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        res = [[] for point in points]
+        point_idxs, grid_idxs = self.tree.query(points, predicate="within")
+        for point_idx, grid_idx in zip(point_idxs, grid_idxs):
+            res[point_idx].append(self.gridids[grid_idx])
+        return res
+
+    def for_bbox(self, minlon, minlat, maxlon, maxlat):
+        """Returns a dictionary of gridid: polygon for all grids
+        intersecting a bounding box"""
+        grid_idxs = self.tree.query(shapely.box(minlon, minlat, maxlon, maxlat), predicate="intersects")
+        return {self.gridids[idx]: self.polygons[idx] for idx in sorted(grid_idxs)}
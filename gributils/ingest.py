@@ -0,0 +1,97 @@
+import collections
+import datetime
+import queue
+import threading
+import uuid
+
+class QueueFull(Exception): pass
+
+class IngestQueue(object):
+    """Adds files to an index in the background. Jobs wait in a queue
+    of at most size entries and are processed by a pool of worker
+    threads. The status of the last keep finished jobs is kept."""
+    def __init__(self, index, workers=2, size=16, keep=1000):
+        self.index = index
+        self.keep = keep
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.finished = collections.deque()
+        self.workers = [threading.Thread(target=self.work, name="ingest-%s" % idx, daemon=True)
+                        for idx in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def full(self):
+        return self.queue.full()
+
+    def submit(self, filepath, id=None, content_hash=None, **kw):
+        """Queue a file to be added with index.add_file(filepath, **kw).
+        content_hash, if known, is recorded with the job. Returns the
+        job id. Raises QueueFull if the queue is full."""
+        id = id or str(uuid.uuid4())
+        job = {
+            "id": id,
+            "file": filepath,
+            "hash": content_hash,
+            "status": "queued",
+            "submitted": now(),
+            "errors": []
+        }
+        with self.lock:
+            self.jobs[id] = job
+        try:
+            self.queue.put_nowait((job, kw))
+        except queue.Full:
+            with self.lock:
+                del self.jobs[id]
+            raise QueueFull("The ingest queue is full")
+        return id
+
+    def status(self, id):
+        """Returns the status of a job, or None for unknown jobs"""
+        with self.lock:
+            job = self.jobs.get(id)
+            if job is None:
+                return None
+            return dict(job, errors=list(job["errors"]))
+
+    def stats(self):
+        with self.lock:
+            statuses = collections.Counter(job["status"] for job in self.jobs.values())
+        return {
+            "workers": len(self.workers),
+            "queued": self.queue.qsize(),
+            "maxsize": self.queue.maxsize,
+            "jobs": dict(statuses)
+        }
+
+    def work(self):
+        while True:
+            job, kw = self.queue.get()
+            self.update(job, status="running", started=now())
+            def cb(error):
+                self.update(job, errors=job["errors"] + [dict(error, error=str(error["error"]))])
+            try:
+                self.index.add_file(job["file"], cb=cb, **kw)
+            except Exception as e:
+                self.update(job, status="failed", error=str(e), finished=now())
+            else:
+                self.update(job, status="failed" if job["errors"] else "done", finished=now())
+            finally:
+                self.queue.task_done()
+            self.forget(job)
+
+    def update(self, job, **kw):
+        with self.lock:
+            job.update(kw)
+
+    def forget(self, job):
+        """Drop the oldest finished jobs beyond keep"""
+        with self.lock:
+            self.finished.append(job["id"])
+            while len(self.finished) > self.keep:
+                self.jobs.pop(self.finished.popleft(), None)
+
+def now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -0,0 +1,76 @@
+import numpy as np
+
+def _linear_weights(t):
+    return np.stack([1 - t, t], axis=-1)
+
+def _cubic_weights(t):
+    # Keys cubic convolution kernel with a=-0.5 (Catmull-Rom)
+    t2 = t * t
+    t3 = t2 * t
+    return np.stack([(-t3 + 2*t2 - t) / 2,
+                     (3*t3 - 5*t2 + 2) / 2,
+                     (-3*t3 + 4*t2 + t) / 2,
+                     (t3 - t2) / 2], axis=-1)
+
+methods = {
+    "linear": (np.arange(0, 2), _linear_weights),
+    "cubic": (np.arange(-1, 3), _cubic_weights),
+}
+
+def interpolate(data, rows, cols, method="cubic"):
+    """Interpolates the 2d array data at the fractional indices
+    rows, cols (arrays of the same shape) and returns an array of
+    values of that shape.
+
+    Only the 2x2 (method="linear") or 4x4 (method="cubic") stencil
+    around each point is read, so no setup over the whole grid is
+    needed. Stencils reaching over the grid edge are clamped to the
+    edge. Points outside the grid, or whose stencil contains missing
+    values (NaN) get the value NaN.
+
+    The cubic method is cubic convolution (Catmull-Rom), which
+    reproduces polynomials up to second order exactly. Compared to the
+    global bicubic spline previously used (scipy interp2d), values
+    differ by third order terms in the grid spacing, typically well
+    below the packing precision of the grib fields themselves.
+    """
+    offsets, weights = methods[method]
+    rows = np.asarray(rows, dtype=float)
+    cols = np.asarray(cols, dtype=float)
+    shape = np.broadcast(rows, cols).shape
+    rows = np.broadcast_to(rows, shape).ravel()
+    cols = np.broadcast_to(cols, shape).ravel()
+
+    inside = ((rows >= 0) & (rows <= data.shape[0] - 1) &
+              (cols >= 0) & (cols <= data.shape[1] - 1))
+    rows = np.where(inside, rows, 0)
+    cols = np.where(inside, cols, 0)
+
+    row0 = np.floor(rows)
+    col0 = np.floor(cols)
+    wrows = weights(rows - row0)
+    wcols = weights(cols - col0)
+    stencilrows = np.clip(row0.astype(int)[:,None] + offsets, 0, data.shape[0] - 1)
+    stencilcols = np.clip(col0.astype(int)[:,None] + offsets, 0, data.shape[1] - 1)
+
+    stencil = data[stencilrows[:,:,None], stencilcols[:,None,:]]
+    res = np.einsum("ni,nij,nj->n", wrows, stencil, wcols)
+    res[~inside] = np.nan
+    return res.reshape(shape)
+
+class GridInterpolator(object):
+    """Callable interpolating the 2d array data at lat/lon
+    positions. Drop in replacement for scipy.interpolate.interp2d
+    objects over a grib layer, but without any setup cost over the
+    whole grid.
+
+    mapper maps lat/lons to fractional indices into data, see
+    gributils.projection.GridMapper."""
+    def __init__(self, data, mapper, method="cubic"):
+        self.data = np.ma.filled(data, np.nan)
+        self.mapper = mapper
+        self.method = method
+
+    def __call__(self, lat, lon):
+        rows, cols = self.mapper.indices(np.atleast_1d(lat), np.atleast_1d(lon))
+        return interpolate(self.data, rows, cols, self.method)
@@ -1,99 +1,158 @@
 import pygrib
-from scipy import interpolate
+import mmap
 import numpy as np
-import datetime
+import gributils.cache
 import gributils.uv
+import gributils.interpolation
+import gributils.projection
 
-class GribCacheEntry(object):
+def read_messages(filepath):
+    """Yields (message, offset, length) for all messages in a grib
+    file, where offset and length give the byte range of the message
+    in the file (or are None for files with multi field messages)."""
+    with pygrib.open(filepath) as grbs, open(filepath, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            multi_field = grbs.has_multi_field_msgs
+            position = 0
+            for grb in grbs:
+                if multi_field:
+                    yield grb, None, None
+                    continue
+                length = grb["totalLength"]
+                offset = data.find(b"GRIB", position)
+                position = offset + length
+                yield grb, offset, length
+
+class GribFile(object):
+    """An open grib file. Messages can be read by index, or, much
+    faster for large files, directly from their byte offset and
+    length."""
     def __init__(self, filepath):
         self.filepath = filepath
-        self.last_access = datetime.datetime.now()
-        self.grbs = pygrib.open(filepath)
-        
+        self.grbs = None
+        self.file = None
+        self.data = None
+
+    def message(self, idx, offset=None, length=None):
+        if offset is None:
+            if self.grbs is None:
+                self.grbs = pygrib.open(self.filepath)
+            return self.grbs[idx]
+        if self.data is None:
+            self.file = open(self.filepath, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return pygrib.fromstring(self.data[offset:offset+length])
+
+    def close(self):
+        if self.grbs is not None:
+            self.grbs.close()
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+
 class GribCache(object):
-    def __init__(self, size=10):
-        self.size = size
-        self.entries = {}
+    """Open grib files, bounded by the number of open files"""
+    def __init__(self, size=10, policy="lru"):
+        self.entries = gributils.cache.policies[policy](size, on_evict=self.close)
+
+    def close(self, filepath, file):
+        file.close()
 
     def get(self, filepath):
-        if filepath not in self.entries:
-            if len(self.entries) >= self.size:
-                entries = list(entries.values)
-                entries.sort(key=lambda e: e.last_access)
-                del self.entries[entries[0].filepath]
-                entries[0].grbs.close()
-            self.entries[filepath] = GribCacheEntry(filepath)
-        entry = self.entries[filepath]
-        entry.last_access = datetime.datetime.now()
-        return entry.grbs
+        return self.entries.get(filepath, lambda: GribFile(filepath))
+
+    def stats(self):
+        return self.entries.stats()
 
 class Layer(object):
-    def __init__(self, layers, idx):
-        self.layers = layers
-        self.idx = idx
-        self.layer = layers[idx]
+    def __init__(self, layer, mapper, method="cubic", values=None):
+        """values, if given, are used instead of decoding layer.values"""
+        self.layer = layer
+        if values is None:
+            values = self.layer.values
 
-        data = self.layer.data()
-        x = data[2][0,:]
-        y = data[1][:,0]
-        z = data[0]
-        self.interpolate = interpolate.interp2d(x, y, z, kind='cubic')
+        self.interpolate = gributils.interpolation.GridInterpolator(values, mapper, method)
 
         self.valid_date = int(self.layer.validDate.strftime("%s"))
 
+    @property
+    def nbytes(self):
+        return self.interpolate.data.nbytes
+
 class LayerUVComponent(object): pass
 
 class LayerUV(object):
-    def __init__(self, layers, idxU, idxV):
-        self.layers = layers
-        self.idxU = idxU
-        self.idxV = idxV
-        self.layerU = layers[idxU]
-        self.layerV = layers[idxV]
+    def __init__(self, layerU, layerV, mapper, method="cubic", valuesU=None, valuesV=None, latlons=None):
+        self.layerU = layerU
+        self.layerV = layerV
                 
         self.magnitude = LayerUVComponent()
         self.azimuth = LayerUVComponent()
-        self.magnitude.data, self.azimuth.data = gributils.uv.uv_to_magnitude_azimuth(self.layerU, self.layerV)
+        self.magnitude.data, self.azimuth.data = gributils.uv.uv_to_magnitude_azimuth(
+            self.layerU, self.layerV, valuesU, valuesV, latlons, mapper.proj)
 
-        data, lats, lons = self.layerU.data()
-        x = lons[0,:]
-        y = lats[:,0]
-
-        self.magnitude.interpolate = interpolate.interp2d(x, y, self.magnitude.data, kind='cubic')
-        self.azimuth.interpolate = interpolate.interp2d(x, y, self.azimuth.data, kind='cubic')
+        self.magnitude.interpolate = gributils.interpolation.GridInterpolator(self.magnitude.data, mapper, method)
+        self.azimuth.interpolate = gributils.interpolation.GridInterpolator(self.azimuth.data, mapper, method)
 
         self.valid_date = int(self.layerU.validDate.strftime("%s"))
         self.magnitude.valid_date = self.valid_date
         self.azimuth.valid_date = self.valid_date
-        
-class LayerCacheEntry(object):
-    def __init__(self, key, layer):
-        self.key = key
-        self.last_access = datetime.datetime.now()
-        self.layer = layer
 
+    @property
+    def nbytes(self):
+        return self.magnitude.interpolate.data.nbytes + self.azimuth.interpolate.data.nbytes
+        
 class LayerCache(object):
-    def __init__(self, size=100, filessize=10):
-        self.size = size
-        self.entries = {}
-        self.gribcache = GribCache(filessize)
-
-    def get(self, filepath, idx):
-        key = (filepath, idx)
-        if key not in self.entries:
-            if len(self.entries) >= self.size:
-                entries = list(entries.values)
-                entries.sort(key=lambda e: e.last_access)
-                del self.entries[entries[0].key]
-            file = self.gribcache.get(filepath)
-            if isinstance(idx, tuple):
-                if len(idx) == 2:
-                    layer = LayerUV(file, idx[0], idx[1])
-                else:
-                    layer = getattr(self.get(filepath, idx[:2]), idx[2])
-            else:
-                layer = Layer(file, idx)
-            self.entries[key] = LayerCacheEntry(key, layer)
-        entry = self.entries[key]
-        entry.last_access = datetime.datetime.now()
-        return entry.layer
+    """Decoded layers, bounded by the memory used by their arrays
+    (size is in bytes). Open files are kept in a GribCache.
+
+    With a FieldStore, layer values (and grid lats/lons) are decoded
+    from grib only the first time, and memory mapped from the store
+    afterwards."""
+    def __init__(self, size=512*1024**2, filessize=10, policy="lru", gribcache=None, fieldstore=None):
+        self.entries = gributils.cache.policies[policy](size, sizeof=lambda layer: layer.nbytes)
+        self.gribcache = gribcache if gribcache is not None else GribCache(filessize, policy)
+        self.fieldstore = fieldstore
+        self.mappers = gributils.projection.GridMapperCache()
+
+    def get(self, filepath, idx, gridid=None, offset=None, length=None):
+        """Returns the layer with index idx in a file. For a pair of
+        U/V indices (idxU, idxV), returns a LayerUV, and for (idxU,
+        idxV, component), one of its components.
+
+        If known, offset and length (pairs of them for U/V layers) is
+        the byte range of the message(s) in the file, which are then
+        read directly."""
+        if isinstance(idx, tuple) and len(idx) == 3:
+            # Components share their arrays with the LayerUV they belong to
+            return getattr(self.get(filepath, idx[:2], gridid, offset, length), idx[2])
+        return self.entries.get((filepath, idx), lambda: self.load(filepath, idx, gridid, offset, length))
+
+    def load(self, filepath, idx, gridid=None, offset=None, length=None):
+        file = self.gribcache.get(filepath)
+        if isinstance(idx, tuple):
+            offset = offset or (None, None)
+            length = length or (None, None)
+            layerU = file.message(idx[0], offset[0], length[0])
+            layerV = file.message(idx[1], offset[1], length[1])
+            if self.fieldstore is None:
+                return LayerUV(layerU, layerV, self.mappers.get(layerU, gridid))
+            latlons = None
+            if gridid is not None:
+                latlons = self.fieldstore.latlons(gridid, layerU.latlons)
+            return LayerUV(layerU, layerV, self.mappers.get(layerU, gridid),
+                           valuesU=self.fieldstore.load(filepath, idx[0], lambda: layerU.values),
+                           valuesV=self.fieldstore.load(filepath, idx[1], lambda: layerV.values),
+                           latlons=latlons)
+        layer = file.message(idx, offset, length)
+        if self.fieldstore is None:
+            return Layer(layer, self.mappers.get(layer, gridid))
+        return Layer(layer, self.mappers.get(layer, gridid),
+                     values=self.fieldstore.load(filepath, idx, lambda: layer.values))
+
+    def stats(self):
+        res = {"layers": self.entries.stats(),
+               "files": self.gribcache.stats()}
+        if self.fieldstore is not None:
+            res["fields"] = self.fieldstore.stats()
+        return res
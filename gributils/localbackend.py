@@ -0,0 +1,248 @@
+import json
+import sqlite3
+import threading
+import shapely
+import shapely.wkt
+import gributils.backend
+
+# Number of rows fetched at a time when iterating over results
+page_size = 1000
+
+class LocalBackend(gributils.backend.Backend):
+    """Index stored in a local SQLite database, for running without an
+    Elasticsearch server.
+
+    Grid polygons are indexed by bounding box in an R-tree and kept
+    parsed in memory for the exact point-in-polygon tests. Layers are
+    indexed on validDate, so bracketing lookups are index scans."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.polygons = {}
+        self.init_db()
+
+    def init_db(self):
+        with self.lock:
+            self.db.executescript("""
+              create table if not exists parametermaps (
+                name text primary key,
+                mapping text);
+
+              create table if not exists grids (
+                id integer primary key,
+                gridid text unique,
+                projparams text,
+                polygon text);
+
+              create virtual table if not exists grids_bbox using rtree(
+                id, minlon, maxlon, minlat, maxlat);
+
+              create table if not exists gridfingerprints (
+                fingerprint text primary key,
+                gridid text);
+
+              create table if not exists layers (
+                id text primary key,
+                gridid text,
+                parameterName text,
+                parameterUnit text,
+                typeOfLevel text,
+                level real,
+                seriesKey text,
+                validDate text,
+                analDate text,
+                url text,
+                contentHash text,
+                idx integer,
+                doc text);
+
+              create index if not exists layers_validDate on layers (validDate);
+              create index if not exists layers_gridid_validDate on layers (gridid, validDate);
+              create index if not exists layers_seriesKey_validDate on layers (seriesKey, validDate);
+              create index if not exists layers_contentHash on layers (contentHash);
+            """)
+            self.db.commit()
+
+    def add_parametermap(self, name, mapping):
+        with self.lock:
+            self.db.execute("insert or replace into parametermaps (name, mapping) values (?, ?)",
+                            (name, json.dumps(mapping)))
+            self.db.commit()
+
+    def get_parametermaps(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("select name from parametermaps")]
+
+    def get_parametermap(self, name):
+        with self.lock:
+            row = self.db.execute("select mapping from parametermaps where name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_polygon(self, gridid, wkt=None):
+        if gridid not in self.polygons:
+            if wkt is None:
+                with self.lock:
+                    wkt = self.db.execute("select polygon from grids where gridid = ?", (gridid,)).fetchone()[0]
+            polygon = shapely.wkt.loads(wkt)
+            shapely.prepare(polygon)
+            self.polygons[gridid] = polygon
+        return self.polygons[gridid]
+
+    def get_grids_for_bbox(self, minlon, minlat, maxlon, maxlat):
+        with self.lock:
+            rows = self.db.execute("""
+              select grids.gridid, grids.polygon
+              from grids_bbox join grids on grids.id = grids_bbox.id
+              where grids_bbox.minlon <= ? and grids_bbox.maxlon >= ?
+                and grids_bbox.minlat <= ? and grids_bbox.maxlat >= ?""",
+                                   (maxlon, minlon, maxlat, minlat)).fetchall()
+        bbox = shapely.box(minlon, minlat, maxlon, maxlat)
+        polygons = {gridid: self.get_polygon(gridid, wkt) for gridid, wkt in rows}
+        return {gridid: polygon for gridid, polygon in polygons.items()
+                if polygon.intersects(bbox)}
+
+    def get_grids_for_position(self, lat, lon):
+        return [gridid for gridid, polygon in self.get_grids_for_bbox(lon, lat, lon, lat).items()
+                if shapely.contains_xy(polygon, lon, lat)]
+
+    def get_grids(self):
+        with self.lock:
+            rows = self.db.execute("select gridid, polygon from grids").fetchall()
+        return {gridid: self.get_polygon(gridid, wkt) for gridid, wkt in rows}
+
+    def has_grid(self, gridid):
+        with self.lock:
+            return self.db.execute("select 1 from grids where gridid = ?", (gridid,)).fetchone() is not None
+
+    def add_grid(self, gridid, projparams, polygon):
+        minlon, minlat, maxlon, maxlat = shapely.wkt.loads(polygon).bounds
+        with self.lock:
+            # Another process may have registered the grid already
+            cur = self.db.execute("insert or ignore into grids (gridid, projparams, polygon) values (?, ?, ?)",
+                                  (gridid, json.dumps(projparams), polygon))
+            if cur.rowcount:
+                self.db.execute("insert into grids_bbox (id, minlon, maxlon, minlat, maxlat) values (?, ?, ?, ?, ?)",
+                                (cur.lastrowid, minlon, maxlon, minlat, maxlat))
+            self.db.commit()
+
+    def get_grid_for_fingerprint(self, fingerprint):
+        with self.lock:
+            row = self.db.execute("select gridid from gridfingerprints where fingerprint = ?", (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add_grid_fingerprint(self, fingerprint, gridid):
+        with self.lock:
+            self.db.execute("insert or replace into gridfingerprints (fingerprint, gridid) values (?, ?)",
+                            (fingerprint, gridid))
+            self.db.commit()
+
+    def add_layers(self, layers):
+        errors = []
+        count = 0
+        for layer in layers:
+            try:
+                row = (gributils.backend.layer_id(layer["url"], layer["idx"]),
+                       layer["gridid"], layer["parameterName"], layer["parameterUnit"],
+                       layer["typeOfLevel"], layer["level"], layer["seriesKey"],
+                       layer["validDate"], layer["analDate"],
+                       layer["url"], layer.get("contentHash"), layer["idx"], json.dumps(layer))
+                with self.lock:
+                    self.db.execute("""
+                      insert or replace into layers
+                        (id, gridid, parameterName, parameterUnit, typeOfLevel, level, seriesKey, validDate, analDate, url, contentHash, idx, doc)
+                      values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", row)
+            except Exception as e:
+                errors.append({"layer": layer, "error": e})
+                continue
+            count += 1
+            if count % page_size == 0:
+                with self.lock:
+                    self.db.commit()
+        with self.lock:
+            self.db.commit()
+        return errors
+
+    def has_content(self, content_hash):
+        with self.lock:
+            return self.db.execute("select 1 from layers where contentHash = ? limit 1",
+                                   (content_hash,)).fetchone() is not None
+
+    def query(self, query, args):
+        """Yields the rows of a query, fetched a page at a time"""
+        with self.lock:
+            cur = self.db.execute(query, args)
+        try:
+            while True:
+                with self.lock:
+                    rows = cur.fetchmany(page_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
+    def iter_lookup(self, output="layers", gridids=None, timestamp=None,
+                    parameter_name=None, parameter_unit=None, type_of_level=None, level=None,
+                    timestamp_last_before=1, level_highest_below=True, timestamp_end=None):
+        gributils.backend.check_output(output)
+
+        where = []
+        args = []
+        if gridids is not None:
+            where.append("gridid in (%s)" % ", ".join("?" for gridid in gridids))
+            args.extend(gridids)
+        if timestamp is not None and timestamp_end is not None:
+            where.append("validDate >= ? and validDate <= ?")
+            args.extend([timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                         timestamp_end.strftime("%Y-%m-%dT%H:%M:%S.%fZ")])
+        elif timestamp is not None:
+            where.append("validDate %s ?" % ["<=", ">="][not timestamp_last_before])
+            args.append(timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+        if parameter_name is not None:
+            where.append("parameterName = ?")
+            args.append(parameter_name)
+        if parameter_unit is not None:
+            where.append("parameterUnit = ?")
+            args.append(parameter_unit)
+        if type_of_level is not None:
+            where.append("typeOfLevel = ?")
+            args.append(type_of_level)
+        if level is not None:
+            where.append("level %s ?" % ["<=", ">="][not level_highest_below])
+            args.append(level)
+        where = " and ".join(where) or "1"
+
+        if output != "layers":
+            column = gributils.backend.output_fields[output]
+            # Copies of a file under several urls are counted once
+            query = """
+              select %s, count(distinct coalesce(contentHash, url) || '#' || idx) from layers
+              where %s
+              group by %s
+              order by %s""" % (column, where, column, column)
+            for key, count in self.query(query, args):
+                yield {"key": key, "doc_count": count}
+            return
+
+        if timestamp is not None and timestamp_end is None:
+            # The last layer before / first layer after timestamp in
+            # each series. Layers with the same validDate are ordered
+            # by url and idx, as in the plain query below.
+            query = """
+              select doc from (
+                select doc, row_number() over (
+                  partition by seriesKey
+                  order by validDate {0}, url {0}, idx {0}) as position
+                from layers
+                where {1})
+              where position = 1""".format(["asc", "desc"][not not timestamp_last_before], where)
+        else:
+            query = "select doc from layers where %s order by validDate, url, idx" % where
+        for row in self.query(query, args):
+            yield json.loads(row[0])
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import hashlib
+import threading
+
+def file_hash(filepath, blocksize=1024*1024):
+    """Returns the sha256 hex digest of the content of a file"""
+    res = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            res.update(block)
+    return res.hexdigest()
+
+def file_state(filepath):
+    """Returns (size, mtime, content hash) of a file"""
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime, file_hash(filepath)
+
+class IngestManifest(object):
+    """A local record (in an SQLite database) of the files that have
+    been successfully added to an index, with their size, mtime and
+    content hash at the time, so that unchanged files can be skipped
+    when adding a directory again."""
+    def __init__(self, path):
+        self.path = path
+        # add_dir reads the manifest from the task feeding thread of
+        # its process pool
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+          create table if not exists files (
+            path text primary key,
+            size integer,
+            mtime real,
+            hash text)""")
+        self.db.commit()
+
+    def get(self, filepath):
+        """Returns a dictionary with size, mtime and hash for a file, or
+        None if the file has not been added"""
+        with self.lock:
+            row = self.db.execute("select size, mtime, hash from files where path = ?", (filepath,)).fetchone()
+        if row is None:
+            return None
+        return {"size": row[0], "mtime": row[1], "hash": row[2]}
+
+    def unchanged(self, filepath):
+        """True if the file has been added and its size and mtime have
+        not changed since"""
+        entry = self.get(filepath)
+        if entry is None:
+            return False
+        stat = os.stat(filepath)
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime
+
+    def set(self, filepath, size, mtime, hash):
+        with self.lock:
+            self.db.execute("insert or replace into files (path, size, mtime, hash) values (?, ?, ?, ?)",
+                            (filepath, size, mtime, hash))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -1,12 +1,32 @@
 import pyproj
 import functools
 import numpy
+import json
+
+# pygrib names regular lat/lon grids "cyl" (older versions) or "longlat"
+latlon_projs = ("cyl", "longlat")
+
+@functools.lru_cache(maxsize=None)
+def transformers(projparams):
+    """Returns (project, unproject), pyproj Transformers from lon/lat to
+    a projection and back, given its projparams as a json string with
+    sorted keys. Transformers are created once per projection and
+    shared."""
+    projparams = json.loads(projparams)
+    gridproj = pyproj.Proj(**projparams)
+    gridproj_over = pyproj.Proj(over=True, **projparams)
+    wgs84 = pyproj.Proj(over=True, init='epsg:4326')
+    return (pyproj.Transformer.from_proj(wgs84, gridproj, always_xy=True),
+            pyproj.Transformer.from_proj(gridproj_over, wgs84, always_xy=True))
 
 class LayerProjection(object):
+    """The projection and grid geometry of a layer.
+
+    Use layer_projection(layer) to get the instance shared by all
+    layers with the same grid."""
     def __init__(self, layer):
-        self.layer = layer
         self.projparams = layer.projparams
-        if self.projparams["proj"] == "cyl":
+        if self.projparams["proj"] in latlon_projs:
             self.projparams = {"init": 'epsg:4326'}
             if "Nx" in layer.keys():
                 self.nx = layer.Nx
@@ -17,7 +37,14 @@ class LayerProjection(object):
             else:
                 self.ny = layer.Nj
             self.dy = (layer.latitudeOfLastGridPointInDegrees - layer.latitudeOfFirstGridPointInDegrees) / (self.ny - 1)
-            self.dx = (layer.longitudeOfLastGridPointInDegrees - layer.longitudeOfFirstGridPointInDegrees) / (self.nx  - 1)
+            # Longitudes can wrap around, e.g. from 350 to 30
+            dlon = layer.longitudeOfLastGridPointInDegrees - layer.longitudeOfFirstGridPointInDegrees
+            i_negative = "iScansNegatively" in layer.keys() and layer["iScansNegatively"] == 1
+            if i_negative and dlon > 0:
+                dlon -= 360
+            elif not i_negative and dlon < 0:
+                dlon += 360
+            self.dx = dlon / (self.nx  - 1)
         else:
             if "DxInMetres" in layer.keys():
                 self.dx = layer.DxInMetres
@@ -28,12 +55,9 @@ class LayerProjection(object):
             else:
                 self.dy = layer.DjInMetres
 
-        self.gridproj = pyproj.Proj(**self.projparams)
-        self.gridproj_over = pyproj.Proj(over=True, **self.projparams)
-        self.wgs84 = pyproj.Proj(over=True, init='epsg:4326')
-
-        self.project = functools.partial(pyproj.transform, self.wgs84, self.gridproj)
-        self.unproject = functools.partial(pyproj.transform, self.gridproj_over, self.wgs84)
+        projector, unprojector = transformers(json.dumps(self.projparams, sort_keys=True))
+        self.project = projector.transform
+        self.unproject = unprojector.transform
 
         self.x0, self.y0 = self.project((layer.longitudeOfFirstGridPointInDegrees + 180) % 360 - 180,
                                         layer.latitudeOfFirstGridPointInDegrees)
@@ -46,3 +70,115 @@ class LayerProjection(object):
     def latlons(self):
         lons, lats = self.scale(*numpy.meshgrid(numpy.arange(0, self.nx), numpy.arange(0, self.ny)))
         return lats, lons
+
+signature_keys = ("Ni", "Nj", "Nx", "Ny",
+                  "latitudeOfFirstGridPointInDegrees", "longitudeOfFirstGridPointInDegrees",
+                  "latitudeOfLastGridPointInDegrees", "longitudeOfLastGridPointInDegrees",
+                  "DxInMetres", "DyInMetres", "DiInMetres", "DjInMetres",
+                  "iScansNegatively", "jScansPositively")
+
+def grid_signature(layer):
+    """Returns a string identifying the grid geometry of a layer,
+    computed from its header only"""
+    keys = layer.keys()
+    return json.dumps([layer.projparams,
+                       [(key, layer[key]) for key in signature_keys if key in keys]],
+                      sort_keys=True, default=str)
+
+projections = {}
+
+def layer_projection(layer):
+    """Returns the LayerProjection of a layer, creating it only for the
+    first layer seen on each grid in this process"""
+    signature = grid_signature(layer)
+    proj = projections.get(signature)
+    if proj is None:
+        proj = projections[signature] = LayerProjection(layer)
+    return proj
+
+class GridMapper(object):
+    """Maps lat/lon positions to fractional (row, column) indices into
+    the values array of layers on a grid, taking the projection of
+    the grid into account.
+
+    Construct once per grid and share between all layers on it, see
+    GridMapperCache."""
+    def __init__(self, layer):
+        self.proj = layer_projection(layer)
+        self.cyl = layer.projparams["proj"] in latlon_projs
+        keys = layer.keys()
+        i_negative = "iScansNegatively" in keys and layer["iScansNegatively"] == 1
+        j_positive = "jScansPositively" not in keys or layer["jScansPositively"] == 1
+
+        self.x0 = self.proj.x0
+        self.y0 = self.proj.y0
+        if self.cyl:
+            # The first/last grid points already give the scanning
+            # direction
+            self.dx = self.proj.dx
+            self.dy = self.proj.dy
+        else:
+            self.dx = -abs(self.proj.dx) if i_negative else abs(self.proj.dx)
+            self.dy = abs(self.proj.dy) if j_positive else -abs(self.proj.dy)
+
+    def indices(self, lats, lons):
+        """Returns arrays of fractional row and column indices for
+        arrays of lats and lons"""
+        lats = numpy.asarray(lats, dtype=float)
+        lons = numpy.asarray(lons, dtype=float)
+        if self.cyl:
+            dlon = lons - self.x0
+            if self.dx > 0:
+                dlon = dlon % 360
+            else:
+                dlon = -(-dlon % 360)
+            return (lats - self.y0) / self.dy, dlon / self.dx
+        x, y = self.proj.project(lons, lats)
+        return ((numpy.asarray(y) - self.y0) / self.dy,
+                (numpy.asarray(x) - self.x0) / self.dx)
+
+    def window(self, minlat, minlon, maxlat, maxlon, shape, samples=32):
+        """Returns (row0, row1, col0, col1), the smallest window of a
+        grid with the given shape (rows, cols) covering a lat/lon
+        bounding box, or None if the bounding box is outside the grid.
+
+        The window is found from the indices of the corners of the
+        bounding box and of samples points along each of its edges,
+        so that it also covers bounding boxes that map to curved
+        shapes on the grid."""
+        edge = numpy.linspace(0, 1, samples)
+        lats = numpy.concatenate([numpy.full(samples, minlat), numpy.full(samples, maxlat),
+                                  minlat + (maxlat - minlat) * edge, minlat + (maxlat - minlat) * edge])
+        lons = numpy.concatenate([minlon + (maxlon - minlon) * edge, minlon + (maxlon - minlon) * edge,
+                                  numpy.full(samples, minlon), numpy.full(samples, maxlon)])
+        rows, cols = self.indices(lats, lons)
+        valid = numpy.isfinite(rows) & numpy.isfinite(cols)
+        if not valid.any():
+            return None
+        rows = rows[valid]
+        cols = cols[valid]
+        row0 = max(int(numpy.floor(rows.min())), 0)
+        row1 = min(int(numpy.ceil(rows.max())) + 1, shape[0])
+        col0 = max(int(numpy.floor(cols.min())), 0)
+        col1 = min(int(numpy.ceil(cols.max())) + 1, shape[1])
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return row0, row1, col0, col1
+
+class GridMapperCache(object):
+    """GridMapper objects by gridid (or grid signature when the gridid
+    isn't known)"""
+    def __init__(self):
+        self.mappers = {}
+
+    def get(self, layer, gridid=None):
+        mapper = self.mappers.get(gridid)
+        if mapper is None:
+            signature = grid_signature(layer)
+            mapper = self.mappers.get(signature)
+            if mapper is None:
+                mapper = GridMapper(layer)
+                self.mappers[signature] = mapper
+            if gridid is not None:
+                self.mappers[gridid] = mapper
+        return mapper
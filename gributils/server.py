@@ -1,17 +1,23 @@
 from flask import Flask
 from flask import Flask, request
 import uuid
+import hashlib
 import os.path
 import json
 import datetime
+import math
+import io
+import numpy
 import urllib.parse
 import flask
 import flask_swagger
+import gributils.ingest
 
 app = Flask(__name__)
 
 filearea = None
 index = None
+ingest = None
 
 def format_result(result, pretty):
     if pretty:
@@ -21,6 +27,16 @@ def format_result(result, pretty):
             json.dumps(row) + "\n"
             for row in result)
 
+def save_upload(filename, blocksize=1024*1024):
+    """Write the body of the current request to a file, a block at a
+    time, and return the sha256 hex digest of its content"""
+    res = hashlib.sha256()
+    with open(filename, "wb") as f:
+        for block in iter(lambda: request.stream.read(blocksize), b""):
+            res.update(block)
+            f.write(block)
+    return res.hexdigest()
+
 def argparse(request):
     def parseitem(item):
         item = urllib.parse.unquote(item)
@@ -109,16 +125,22 @@ def lookup():
         - true
     responses:
       200:
-        description: "A set of layers"
+        description: "A set of layers, streamed as newline separated json unless pretty is set"
     """
     args = argparse(request)
     pretty = args.pop("pretty", False)
-    return format_result(index.lookup(**args), pretty)
+    if pretty:
+        return format_result(index.lookup(**args), pretty)
+    rows = index.lookup(stream=True, **args)
+    return flask.Response(flask.stream_with_context(json.dumps(row) + "\n" for row in rows),
+                          mimetype="application/x-ndjson")
 
-@app.route('/index/interpolate/latlon')
+@app.route('/index/interpolate/latlon', methods=["GET", "POST"])
 def interp_latlon():
     """
-    Interpolate a parametervalue at a specific lat/lon inside a specified layer
+    Interpolate a parametervalue at a specific lat/lon inside a specified layer.
+    When POSTed a set of points, interpolate the layer at all of them
+    and return a list of values (null for points outside the layer).
     ---
     produces:
     - "application/json"
@@ -135,19 +157,35 @@ def interp_latlon():
       type: integer
     - name: lat
       in: query
-      description: Latitude for the point
-      required: true
+      description: Latitude for the point (GET only)
       type: number
     - name: lon
       in: query
-      description: Longitude for for the point
-      required: true
+      description: Longitude for for the point (GET only)
       type: number
+    - name: points
+      in: body
+      description: Points to interpolate at (POST only)
+      schema:
+        type: object
+        properties:
+          lat:
+            type: array
+            items:
+              type: number
+          lon:
+            type: array
+            items:
+              type: number
     responses:
       200:
-        description: "An interpolated parameter value (float)"
+        description: "An interpolated parameter value (float), or a list of values for POST"
     """
     args = argparse(request)
+    if request.method == "POST":
+        points = request.get_json(force=True)
+        values = index.interp_latlon_points(lats=points["lat"], lons=points["lon"], **args)
+        return json.dumps([None if math.isnan(value) else value for value in values.tolist()])
     return json.dumps(index.interp_latlon(**args))
 
 
@@ -212,10 +250,238 @@ def interp_timestamp():
     pretty = args.pop("pretty", False)
     return format_result(index.interp_timestamp(**args), pretty)
 
+@app.route('/index/interpolate/track', methods=["POST"])
+def interp_track():
+    """
+    Return parameter values interpolated in time and space for every
+    point of a track. The result contains one list of parameter
+    values per point, in the same format as /index/interpolate/timestamp.
+    ---
+    consumes:
+    - "application/json"
+    produces:
+    - "application/json"
+    parameters:
+    - name: track
+      in: body
+      description: The points of the track
+      required: true
+      schema:
+        type: object
+        properties:
+          lat:
+            type: array
+            items:
+              type: number
+          lon:
+            type: array
+            items:
+              type: number
+          timestamp:
+            type: array
+            items:
+              type: string
+              format: "Date time: %Y-%m-%dT%H:%M:%S.%fZ"
+    - name: parameter_name
+      in: query
+      description: Parameter name for filtering on layers containing only a certain parameter value such as "Wind speed"
+      type: string
+    - name: parameter_unit
+      in: query
+      description: Parameter unit name for filtering on layers containing only parameter values in a certain unit, such as m/s
+      type: string
+    - name: type_of_level
+      in: query
+      description: Type of level for filtering on only layers with a specified level of this type, such as "Meters above sea level"
+      type: string
+    - name: level
+      in: query
+      description: Level for filtering on only layers at this level. Combine with type_of_level to specify layers at e.g. 10m above sea level.
+      type: number
+    - name: level_highest_below
+      in: query
+      description: Find the layer at the highest level under the specified level (1) or at the lowest level above that level (0)
+      type: integer
+      default: 1
+    - name: pretty
+      in: query
+      description: Pretty-print a single json object (true) or return newline separated json
+      type: string
+      enum:
+        - true
+    responses:
+      200:
+        description: "A set of parameter values per point"
+    """
+    args = argparse(request)
+    pretty = args.pop("pretty", False)
+    track = request.get_json(force=True)
+    return format_result(index.interp_track(lats=track["lat"], lons=track["lon"], timestamps=track["timestamp"], **args), pretty)
+
+@app.route('/index/timeseries')
+def timeseries():
+    """
+    Return the values at a point of all layers between two timestamps,
+    as one time series per parameter, optionally resampled to a fixed
+    time step.
+    ---
+    produces:
+    - "application/json"
+    parameters:
+    - name: lat
+      in: query
+      description: Latitude of the point
+      type: number
+      required: true
+    - name: lon
+      in: query
+      description: Longitude of the point
+      type: number
+      required: true
+    - name: start
+      in: query
+      description: Start of the time series
+      type: string
+      format: "Date time: %Y-%m-%dT%H:%M:%S.%fZ"
+      required: true
+    - name: end
+      in: query
+      description: End of the time series
+      type: string
+      format: "Date time: %Y-%m-%dT%H:%M:%S.%fZ"
+      required: true
+    - name: step
+      in: query
+      description: Resample the series to this time step, in seconds, using linear interpolation
+      type: number
+    - name: parameter_name
+      in: query
+      description: Parameter name for filtering on layers containing only a certain parameter value such as "Wind speed"
+      type: string
+    - name: parameter_unit
+      in: query
+      description: Parameter unit name for filtering on layers containing only parameter values in a certain unit, such as m/s
+      type: string
+    - name: type_of_level
+      in: query
+      description: Type of level for filtering on only layers with a specified level of this type, such as "Meters above sea level"
+      type: string
+    - name: level
+      in: query
+      description: Level for filtering on only layers at this level. Combine with type_of_level to specify layers at e.g. 10m above sea level.
+      type: number
+    - name: level_highest_below
+      in: query
+      description: Find the layer at the highest level under the specified level (1) or at the lowest level above that level (0)
+      type: integer
+      default: 1
+    - name: pretty
+      in: query
+      description: Pretty-print a single json object (true) or return newline separated json
+      type: string
+      enum:
+        - true
+    responses:
+      200:
+        description: "One time series per parameter, with the lists validDate and value (null outside the layers)"
+    """
+    args = argparse(request)
+    pretty = args.pop("pretty", False)
+    res = index.timeseries(**args)
+    for series in res:
+        series["value"] = [None if math.isnan(value) else value for value in series["value"]]
+    return format_result(res, pretty)
+
+@app.route('/index/subset')
+def subset():
+    """
+    Return the values of a layer inside a lat/lon bounding box, as a
+    float32 array in NPY format (or raw, native byte order), with NaN
+    for missing values. The X-Gributils-Georef header contains a json
+    object with the shape of the array, the window of the grid it was
+    cut from and the grid coordinates (x0, y0, dx, dy, in the
+    projection projparams) of its points.
+    ---
+    produces:
+    - "application/octet-stream"
+    parameters:
+    - name: gribfile
+      in: query
+      description: The gribfile id of the layer
+      required: true
+      type: string
+    - name: layeridx
+      in: query
+      description: The layer index (starts with 1 for the first layer)
+      required: true
+      type: integer
+    - name: minlat
+      in: query
+      description: Southern edge of the bounding box
+      required: true
+      type: number
+    - name: minlon
+      in: query
+      description: Western edge of the bounding box
+      required: true
+      type: number
+    - name: maxlat
+      in: query
+      description: Northern edge of the bounding box
+      required: true
+      type: number
+    - name: maxlon
+      in: query
+      description: Eastern edge of the bounding box
+      required: true
+      type: number
+    - name: stride
+      in: query
+      description: Only return every stride:th row and column
+      type: integer
+      default: 1
+    - name: format
+      in: query
+      description: NPY file (npy) or raw array data (raw)
+      type: string
+      default: npy
+      enum:
+        - npy
+        - raw
+    responses:
+      200:
+        description: "The values"
+      404:
+        description: "The bounding box is outside the grid of the layer"
+    """
+    args = argparse(request)
+    fmt = args.pop("format", "npy")
+    values, georef = index.subset(**args)
+    if values is None:
+        return flask.Response(json.dumps({"error": "outside_grid", "georef": georef}),
+                              status=404, mimetype="application/json")
+    def generate():
+        if fmt == "npy":
+            header = io.BytesIO()
+            numpy.lib.format.write_array_header_1_0(header, {
+                "descr": numpy.lib.format.dtype_to_descr(values.dtype),
+                "fortran_order": False,
+                "shape": values.shape})
+            yield header.getvalue()
+        for row in values:
+            yield row.tobytes()
+    resp = flask.Response(generate(), mimetype="application/octet-stream")
+    resp.headers.set("X-Gributils-Georef", json.dumps(georef))
+    return resp
+
 @app.route('/index/add', methods=["POST"])
 def add_file():
     """
-    Add a new gribfile to the index
+    Add a new gribfile to the index. The file is stored and queued to
+    be indexed in the background; poll /index/jobs/{id} for the
+    result. Files are stored by the sha256 hash of their content, and
+    a file with the same content as one already indexed is not
+    indexed again.
     ---
     consumes:
     - application/wmo-grib
@@ -238,19 +504,72 @@ def add_file():
         type: string
     responses:
       200:
-        description: "The file was successfully added to the index"
+        description: "A file with the same content is already indexed. Returns its sha256 hash."
+      202:
+        description: "The file was queued for indexing. Returns the job id and the sha256 hash of the file."
+      429:
+        description: "The ingest queue is full, retry later"
     """
+    if ingest.full():
+        return queue_full()
     args = argparse(request)
-    time = datetime.datetime.now().strftime('%Y-%m-%d')
     id = str(uuid.uuid4())
-    dirpath = os.path.join(filearea, time, id[:3])
+    tmpdir = os.path.join(filearea, "incoming")
+    if not os.path.exists(tmpdir):
+        os.makedirs(tmpdir, exist_ok=True)
+    tmpname = os.path.join(tmpdir, "%s.grb" % id)
+    content_hash = save_upload(tmpname)
+
+    # Files are stored by content, so a re-sent file ends up at the
+    # same path and url as the first copy
+    dirpath = os.path.join(filearea, content_hash[:2])
     if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
-    filename = os.path.join(dirpath, "%s.grb" % id)
-    with open(filename, "wb") as f:
-        f.write(request.get_data())
-    index.add_file(filename, **args)
-    return json.dumps({"status": "success"})
+        os.makedirs(dirpath, exist_ok=True)
+    filename = os.path.join(dirpath, "%s.grb" % content_hash)
+    if os.path.exists(filename):
+        os.unlink(tmpname)
+    else:
+        os.replace(tmpname, filename)
+
+    if index.has_content(content_hash):
+        return json.dumps({"status": "exists", "hash": content_hash})
+    try:
+        ingest.submit(filename, id=id, content_hash=content_hash, **args)
+    except gributils.ingest.QueueFull:
+        return queue_full()
+    return flask.Response(json.dumps({"status": "queued", "job": id, "hash": content_hash}),
+                          status=202, mimetype="application/json",
+                          headers={"Location": "/index/jobs/%s" % id})
+
+def queue_full():
+    return flask.Response(json.dumps({"status": "error", "error": "The ingest queue is full"}),
+                          status=429, mimetype="application/json",
+                          headers={"Retry-After": "10"})
+
+@app.route('/index/jobs/<id>')
+def job_status(id):
+    """
+    Status of a file added with /index/add
+    ---
+    produces:
+    - "application/json"
+    parameters:
+    - name: id
+      in: path
+      description: The job id returned by /index/add
+      type: string
+      required: true
+    responses:
+      200:
+        description: "The job, with its status (queued, running, done or failed), timestamps and any errors"
+      404:
+        description: "Unknown job"
+    """
+    job = ingest.status(id)
+    if job is None:
+        return flask.Response(json.dumps({"status": "error", "error": "Unknown job"}),
+                              status=404, mimetype="application/json")
+    return json.dumps(job)
 
 @app.route('/index/parametermap/add', methods=["POST"])
 def parametermap_add_file():
@@ -282,8 +601,7 @@ def parametermap_add_file():
     """
     args = argparse(request)
     filename = os.path.join(filearea, "%s.csv" % (uuid.uuid4(),))
-    with open(filename, "wb") as f:
-        f.write(request.get_data())
+    save_upload(filename)
     index.add_parametermap(mapping=filename, **args)
     return json.dumps({"status": "success"})
     
@@ -300,5 +618,18 @@ def parametermap_list():
     """
     return json.dumps(index.get_parametermaps())
 
+@app.route('/stats')
+def stats():
+    """
+    Cache and database statistics
+    ---
+    produces:
+    - "application/json"
+    responses:
+      200:
+        description: "Hit, miss and eviction counters and sizes of the layer and file caches, request counts and latencies per database operation, and ingest queue state"
+    """
+    return json.dumps(dict(index.stats(), ingest=ingest.stats()))
+
 if __name__ == "__main__":
     app.run()
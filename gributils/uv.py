@@ -4,17 +4,28 @@ import numpy as np
 
 wgs84_geod = pyproj.Geod(ellps='WGS84')
 
-def uv_to_magnitude_azimuth(grbU, grbV):
-    proj = gributils.projection.LayerProjection(grbU)
+def uv_to_magnitude_azimuth(grbU, grbV, valuesU=None, valuesV=None, latlons=None, proj=None):
+    """Returns the magnitude and azimuth of the vectors of a pair of U
+    and V component layers. The values of the layers, their lats and
+    lons, and their LayerProjection are read from the layers unless
+    given."""
+    if proj is None:
+        proj = gributils.projection.layer_projection(grbU)
+    if valuesU is None:
+        valuesU = grbU.values
+    if valuesV is None:
+        valuesV = grbV.values
 
-    lats1, lons1 = grbU.latlons()
+    lats1, lons1 = latlons if latlons is not None else grbU.latlons()
     x1, y1 = proj.project(lons1, lats1)
 
-    x2 = x1 + grbU.values * proj.dx
-    y2 = y1 + grbV.values * proj.dy
+    # U and V are along increasing x and y, whatever the scanning
+    # direction of the grid
+    x2 = x1 + valuesU * abs(proj.dx)
+    y2 = y1 + valuesV * abs(proj.dy)
 
     lons2, lats2 = proj.unproject(x2, y2)
     azimuth, back, dist = wgs84_geod.inv(lons1, lats1, lons2, lats2)
 
-    magnitude = np.sqrt(grbU.values**2 + grbV.values**2)
+    magnitude = np.sqrt(valuesU**2 + valuesV**2)
     return magnitude, azimuth
@@ -27,7 +27,7 @@ indexing gribfiles. Current features include:
           'numpy',
           'pyproj',
           'pygrib',
-          'shapely',
+          'shapely>=2',
           'scipy',
           'scikit-image',
           'click',
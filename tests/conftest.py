@@ -0,0 +1,146 @@
+import datetime
+import numpy as np
+import pytest
+import gributils.backend
+import gributils.gribindex
+
+class FakeLayer(object):
+    """The parts of a pygrib message used by GridMapper and bounds()"""
+    def __init__(self, values, projparams, **attrs):
+        self.values = values
+        self.minimum = float(values.min())
+        self.maximum = float(values.max())
+        self.projparams = projparams
+        self.attrs = attrs
+        self.__dict__.update(attrs)
+
+    def keys(self):
+        return list(self.attrs.keys())
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+def temperature(lats, lons, step):
+    return 273 + 10 * np.sin(np.radians(lats) * 5) * np.cos(np.radians(lons) * 3) + step
+
+def wind_u(lats, lons, step):
+    return 3 + np.cos(np.radians(lats) * 4) + 0.5 * step
+
+parameters = [
+    # discipline, category, number, level, values
+    (0, 0, 0, 2, temperature),
+    (0, 2, 2, 10, wind_u)]
+
+def write_grib(path, grid, steps, offset=0.0, analysis=6):
+    """Writes a grib2 file with one temperature and one wind layer per
+    forecast step (in hours from the analysis, at 2018-08-30 06:00 by
+    default). grid is a dictionary of grid definition keys;
+    gridDefinitionTemplateNumber 30 gives a Lambert conformal grid.
+    offset is added to all values."""
+    eccodes = pytest.importorskip("eccodes")
+    with open(path, "wb") as f:
+        for step in steps:
+            for discipline, category, number, level, values in parameters:
+                handle = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+                for key, value in grid.items():
+                    eccodes.codes_set(handle, key, value)
+                eccodes.codes_set(handle, "dataDate", 20180830)
+                eccodes.codes_set(handle, "dataTime", analysis * 100)
+                eccodes.codes_set(handle, "discipline", discipline)
+                eccodes.codes_set(handle, "parameterCategory", category)
+                eccodes.codes_set(handle, "parameterNumber", number)
+                eccodes.codes_set(handle, "typeOfFirstFixedSurface", 103)
+                eccodes.codes_set(handle, "scaledValueOfFirstFixedSurface", level)
+                eccodes.codes_set(handle, "forecastTime", step)
+                size = grid.get("Ni", grid.get("Nx")) * grid.get("Nj", grid.get("Ny"))
+                eccodes.codes_set_values(handle, np.zeros(size))
+                lats = np.array(eccodes.codes_get_array(handle, "latitudes"))
+                lons = np.array(eccodes.codes_get_array(handle, "longitudes"))
+                eccodes.codes_set_values(handle, values(lats, lons, step) + offset)
+                eccodes.codes_write(handle, f)
+                eccodes.codes_release(handle)
+    return str(path)
+
+def grid_latlons(path):
+    """Returns the lats and lons of the grid points of the first message
+    of a grib file, in the order of its values array. (pygrib's
+    latlons() reorders them for grids scanning i negatively.)"""
+    eccodes = pytest.importorskip("eccodes")
+    with open(path, "rb") as f:
+        handle = eccodes.codes_grib_new_from_file(f)
+        try:
+            shape = (eccodes.codes_get(handle, "Nj" if eccodes.codes_is_defined(handle, "Nj") else "Ny"),
+                     eccodes.codes_get(handle, "Ni" if eccodes.codes_is_defined(handle, "Ni") else "Nx"))
+            return (np.array(eccodes.codes_get_array(handle, "latitudes")).reshape(shape),
+                    np.array(eccodes.codes_get_array(handle, "longitudes")).reshape(shape))
+        finally:
+            eccodes.codes_release(handle)
+
+def latlon_grid(first_lat=70.0, last_lat=50.0, first_lon=350.0, last_lon=30.0, step=0.25, **kw):
+    span = (last_lon - first_lon) % 360
+    if kw.get("iScansNegatively"):
+        span = (first_lon - last_lon) % 360
+    return dict({
+        "Ni": int(round(span / step)) + 1,
+        "Nj": int(round(abs(last_lat - first_lat) / step)) + 1,
+        "latitudeOfFirstGridPointInDegrees": first_lat,
+        "latitudeOfLastGridPointInDegrees": last_lat,
+        "longitudeOfFirstGridPointInDegrees": first_lon,
+        "longitudeOfLastGridPointInDegrees": last_lon,
+        "iDirectionIncrementInDegrees": step,
+        "jDirectionIncrementInDegrees": step,
+        "jScansPositively": int(last_lat > first_lat)}, **kw)
+
+def lambert_grid(first_lat=50.0, first_lon=0.0, j_positive=1, nx=60, ny=50):
+    return {
+        "gridDefinitionTemplateNumber": 30,
+        "Nx": nx,
+        "Ny": ny,
+        "latitudeOfFirstGridPointInDegrees": first_lat,
+        "longitudeOfFirstGridPointInDegrees": first_lon,
+        "LoVInDegrees": 15.0,
+        "LaDInDegrees": 63.3,
+        "Latin1InDegrees": 63.3,
+        "Latin2InDegrees": 63.3,
+        "DxInMetres": 10000,
+        "DyInMetres": 10000,
+        "jScansPositively": j_positive}
+
+@pytest.fixture
+def gribs(tmp_path):
+    """Two regular lat/lon grids covering 60N 10E, with layers at some
+    but not all of the same validDates, and a Lambert conformal grid"""
+    return {
+        "wide": write_grib(tmp_path / "wide.grb", latlon_grid(), [0, 2, 3]),
+        "narrow": write_grib(tmp_path / "narrow.grb",
+                             latlon_grid(first_lat=65.0, last_lat=55.0, first_lon=5.0, last_lon=15.0, step=0.1),
+                             [1, 2, 4], offset=1.5),
+        "lambert": write_grib(tmp_path / "lambert.grb", lambert_grid(), [0, 1])}
+
+def index_layer(url, idx, hour, name="Temperature", level=2, gridid="north"):
+    """A layer as stored in an index, for backend tests"""
+    res = {
+        "gridid": gridid,
+        "parameterName": name,
+        "parameterUnit": "K" if name == "Temperature" else "m s-1",
+        "typeOfLevel": "heightAboveGround",
+        "level": level,
+        "validDate": "2018-08-30T%02d:00:00.000000Z" % hour,
+        "analDate": "2018-08-30T00:00:00.000000Z",
+        "url": url,
+        "idx": idx
+    }
+    res["seriesKey"] = gributils.backend.series_id(res)
+    return res
+
+def timestamp(hour, minute=0):
+    return datetime.datetime(2018, 8, 30, hour, minute)
+
+@pytest.fixture
+def index(tmp_path, gribs):
+    """A local index of the gribs files"""
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    index.init_db()
+    for path in gribs.values():
+        index.add_file(path)
+    return index
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import shapely
+import gributils.bounds
+import gributils.projection
+from conftest import FakeLayer
+
+lambert = {"a": 6371229, "b": 6371229, "proj": "lcc",
+           "lon_0": 15.0, "lat_0": 63.3, "lat_1": 63.3, "lat_2": 63.3}
+
+def layer(mask):
+    values = np.random.default_rng(0).normal(280, 5, size=mask.shape)
+    return FakeLayer(np.ma.masked_array(values, mask=mask), lambert,
+                     Nx=mask.shape[1], Ny=mask.shape[0], DxInMetres=10000.0, DyInMetres=10000.0,
+                     iScansNegatively=0, jScansPositively=1,
+                     latitudeOfFirstGridPointInDegrees=50.0, longitudeOfFirstGridPointInDegrees=0.0)
+
+def masks():
+    shape = (50, 60)
+    yield np.zeros(shape, bool)
+    mask = np.ones(shape, bool)
+    mask[10:40, 5:50] = False
+    yield mask
+    mask = np.ones(shape, bool)
+    mask[20, 5:50] = False
+    yield mask
+    mask = np.ones(shape, bool)
+    mask[20, 30] = False
+    yield mask
+
+@pytest.mark.parametrize("mask", list(masks()))
+def test_rectangle_same_as_contours(mask, monkeypatch):
+    assert gributils.bounds.valid_rectangle(~mask) is not None
+    fast = gributils.bounds.bounds(layer(mask))
+    monkeypatch.setattr(gributils.bounds, "valid_rectangle", lambda validmap: None)
+    traced = gributils.bounds.bounds(layer(mask))
+    assert fast.equals_exact(traced, 1e-9)
+
+def test_valid_rectangle():
+    validmap = np.zeros((10, 10), bool)
+    assert gributils.bounds.valid_rectangle(validmap) is None
+    validmap[2:5, 3:8] = True
+    assert gributils.bounds.valid_rectangle(validmap) == (2, 5, 3, 8)
+    validmap[3, 4] = False
+    assert gributils.bounds.valid_rectangle(validmap) is None
+    validmap[3, 4] = True
+    validmap[8, 8] = True
+    assert gributils.bounds.valid_rectangle(validmap) is None
+
+def test_contour_projection_matches_grid_points():
+    mask = np.ones((50, 60), bool)
+    mask[10:40, 5:50] = False
+    grid = layer(mask)
+    proj = gributils.projection.layer_projection(grid)
+    shape = gributils.bounds.bounds(grid, add_buffer=0, simplify=False)
+    # The outline passes half a cell outside the valid grid points
+    # (up to the chords of segments of at most 8 grid cells)
+    lons, lats = proj.unproject(*proj.scale(np.array([4.5, 49.5]), np.array([25.0, 25.0])))
+    assert shape.boundary.distance(shapely.Point(lons[0], lats[0])) < 1e-3
+    assert shape.boundary.distance(shapely.Point(lons[1], lats[1])) < 1e-3
+
+def test_contours_are_projected_together(monkeypatch):
+    mask = np.ones((50, 60), bool)
+    mask[5:15, 5:15] = False
+    mask[30:45, 20:50] = False
+    mask[35:40, 30:40] = True
+    grid = layer(mask)
+    proj = gributils.projection.layer_projection(grid)
+    calls = []
+    unproject = proj.unproject
+    monkeypatch.setattr(proj, "unproject", lambda x, y: calls.append(len(x)) or unproject(x, y))
+    shape = gributils.bounds.bounds(grid, fill_holes=False, add_buffer=0, simplify=False)
+    assert len(calls) == 1
+    # Two areas and the outline of the hole in one of them
+    assert len(shape.geoms) == 3
@@ -0,0 +1,45 @@
+import gributils.cache
+import gributils.gribindex
+
+def fill(cache, keys):
+    for key in keys:
+        cache.get(key, lambda: b"x" * 40)
+
+def test_lru_evicts_least_recently_used():
+    evicted = []
+    cache = gributils.cache.policies["lru"](100, sizeof=len, on_evict=lambda key, value: evicted.append(key))
+    fill(cache, ["a", "b"])
+    fill(cache, ["a"])
+    fill(cache, ["c"])
+    assert evicted == ["b"]
+    assert "a" in cache and "c" in cache
+    assert cache.size == 80 <= cache.maxsize
+
+def test_lfu_evicts_least_frequently_used():
+    evicted = []
+    cache = gributils.cache.policies["lfu"](120, sizeof=len, on_evict=lambda key, value: evicted.append(key))
+    fill(cache, ["a", "a", "a", "b", "b", "c"])
+    fill(cache, ["d"])
+    assert evicted == ["c"]
+    fill(cache, ["e"])
+    assert evicted == ["c", "d"]
+    assert set(cache.values) == {"a", "b", "e"}
+
+def test_size_bound():
+    cache = gributils.cache.policies["lru"](100, sizeof=len)
+    for idx in range(10):
+        cache.put(idx, b"x" * (10 + idx * 5))
+        assert cache.size <= 100
+    assert cache.size == sum(cache.sizes.values())
+    stats = cache.stats()
+    assert stats["evictions"] > 0 and stats["entries"] == len(cache)
+
+def test_layer_cache_is_bounded_by_bytes(gribs):
+    index = gributils.gribindex.GribIndex(":memory:", cache_size=250000)
+    for idx in (1, 2, 3):
+        index.interp_latlon(gribs["wide"], idx, 60, 10)
+    index.interp_latlon(gribs["wide"], 3, 60, 10)
+    stats = index.cache_stats()["layers"]
+    assert stats["size"] <= 250000
+    assert (stats["entries"], stats["misses"], stats["hits"], stats["evictions"]) == (2, 3, 1, 1)
+    assert stats["size"] == 2 * index.layercache.get(gribs["wide"], 3).nbytes
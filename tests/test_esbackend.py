@@ -0,0 +1,57 @@
+import json
+import gributils.esbackend
+from conftest import index_layer as layer
+
+class Response(object):
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = json.dumps(content).encode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+def backend(monkeypatch, respond, **kw):
+    """An ElasticsearchBackend recording its requests as (method, url,
+    keyword arguments), answered by respond(method, url, kw)"""
+    backend = gributils.esbackend.ElasticsearchBackend("http://localhost:9200/", **kw)
+    requests = []
+    def request(method, url, **kw):
+        requests.append((method, url, kw))
+        return Response(respond(method, url, kw))
+    monkeypatch.setattr(backend.client.session, "request", request)
+    return backend, requests
+
+def test_paths(monkeypatch):
+    es, requests = backend(monkeypatch, lambda method, url, kw: {"acknowledged": True})
+    es.init_db()
+    es.add_grid("abc", {"proj": "cyl"}, "POLYGON ((0 0, 1 0, 1 1, 0 0))")
+    assert [url for method, url, kw in requests] == [
+        "http://localhost:9200/geocloud-gribfile-parametermap",
+        "http://localhost:9200/geocloud-gribfile-grid",
+        "http://localhost:9200/geocloud-gribfile-gridfingerprint",
+        "http://localhost:9200/geocloud-gribfile-layer",
+        "http://localhost:9200/geocloud-gribfile-grid/doc/abc"]
+    assert all(method == "PUT" and kw["timeout"] == 60 for method, url, kw in requests)
+    assert es.stats()["admin"]["requests"] == 4
+
+def test_bulk_batches_and_errors(monkeypatch):
+    def respond(method, url, kw):
+        items = kw["data"].decode("utf-8").splitlines()[1::2]
+        return {"errors": True,
+                "items": [{"index": {"error": "rejected"} if json.loads(item)["idx"] == 4 else {}}
+                          for item in items]}
+    es, requests = backend(monkeypatch, respond, bulk_docs=2)
+    errors = es.add_layers(layer("a.grb", idx, 6) for idx in range(1, 6))
+    assert [len(kw["data"].decode("utf-8").splitlines()) for method, url, kw in requests] == [4, 4, 2]
+    assert [(error["layer"]["idx"], error["error"]) for error in errors] == [(4, "rejected")]
+
+def test_distinct_layer_counts(monkeypatch):
+    def respond(method, url, kw):
+        assert kw["json"]["aggs"]["results"]["aggs"]["results"]["aggs"]["layers"] == gributils.esbackend.distinct_layers
+        return {"aggregations": {"results": {"results": {"buckets": [
+            {"key": {"key": "Temperature"}, "doc_count": 6, "layers": {"value": 3}}]}}}}
+    es, requests = backend(monkeypatch, respond)
+    assert es.lookup("names") == [{"key": "Temperature", "doc_count": 3}]
@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import gributils.fieldstore
+import gributils.gribindex
+
+def decoder(values, calls):
+    def decode():
+        calls.append(1)
+        return values
+    return decode
+
+def test_put_and_get(tmp_path, gribs):
+    store = gributils.fieldstore.FieldStore(str(tmp_path / "fields"))
+    assert store.get(gribs["wide"], 1) is None
+    values = np.ma.masked_invalid([[1.0, np.nan], [3.0, 4.0]])
+    store.put(gribs["wide"], 1, values)
+    stored = store.get(gribs["wide"], 1)
+    assert stored.dtype == np.float32 and not stored.flags.writeable
+    np.testing.assert_array_equal(stored, [[1.0, np.nan], [3.0, 4.0]])
+    assert store.get(gribs["wide"], 2) is None
+
+def test_stale_layers_are_ignored(tmp_path, gribs):
+    store = gributils.fieldstore.FieldStore(str(tmp_path / "fields"))
+    store.put(gribs["wide"], 1, np.ones((2, 2)))
+    mtime = os.stat(store.layer_path(gribs["wide"], 1)).st_mtime
+    os.utime(gribs["wide"], (mtime + 10, mtime + 10))
+    assert store.get(gribs["wide"], 1) is None
+
+def test_load_decodes_once(tmp_path, gribs):
+    store = gributils.fieldstore.FieldStore(str(tmp_path / "fields"))
+    calls = []
+    for attempt in range(3):
+        values = store.load(gribs["wide"], 1, decoder(np.arange(4.0).reshape(2, 2), calls))
+        np.testing.assert_array_equal(values, [[0, 1], [2, 3]])
+    assert len(calls) == 1
+    assert (store.stats()["misses"], store.stats()["hits"]) == (1, 2)
+
+def test_latlons(tmp_path):
+    store = gributils.fieldstore.FieldStore(str(tmp_path / "fields"))
+    calls = []
+    latlons = (np.array([[60.0, 60.0]]), np.array([[10.0, 11.0]]))
+    for attempt in range(2):
+        lats, lons = store.latlons("north", decoder(latlons, calls))
+        np.testing.assert_array_equal(lats, latlons[0])
+        np.testing.assert_array_equal(lons, latlons[1])
+    assert len(calls) == 1
+
+def test_stored_fields_are_used(tmp_path, gribs):
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"),
+                                          fieldstore=str(tmp_path / "fields"), store_fields=True)
+    index.add_file(gribs["wide"])
+    expected = gributils.gribindex.GribIndex(":memory:").interp_latlon(gribs["wide"], 3, 60, 10)
+    assert index.interp_latlon(gribs["wide"], 3, 60, 10) == expected
+    stats = index.cache_stats()["fields"]
+    assert (stats["hits"], stats["misses"]) == (1, 0)
+
+def old_file(tmp_path):
+    """Returns the path of a file older than any stored layer"""
+    path = tmp_path / "old.grb"
+    path.write_bytes(b"")
+    os.utime(path, (0, 0))
+    return str(path)
+
+def size_file(cache):
+    with open(os.path.join(cache.path, ".size")) as f:
+        return int(f.read())
+
+def test_shared_cache_evicts_to_maxsize(tmp_path):
+    url = old_file(tmp_path)
+    values = np.zeros((10, 10), dtype=np.float32)
+    entrysize = values.nbytes + 128
+    cache = gributils.fieldstore.SharedLayerCache(str(tmp_path / "shared"), maxsize=3 * entrysize)
+    for idx in range(1, 6):
+        cache.put(url, idx, values)
+        assert size_file(cache) == sum(entry[1] for entry in cache.entries()) <= cache.maxsize
+    stats = cache.stats()
+    assert (stats["entries"], stats["evictions"]) == (3, 2)
+    assert stats["size"] == size_file(cache)
+    assert cache.get(url, 1) is None and cache.get(url, 5) is not None
+    # Replacing an entry does not change the size
+    cache.put(url, 5, values)
+    assert size_file(cache) == stats["size"]
+
+def test_shared_cache_evicts_least_recently_used(tmp_path):
+    url = old_file(tmp_path)
+    values = np.zeros((10, 10), dtype=np.float32)
+    cache = gributils.fieldstore.SharedLayerCache(str(tmp_path / "shared"), maxsize=3 * (values.nbytes + 128))
+    for idx in range(1, 4):
+        cache.put(url, idx, values)
+        os.utime(cache.layer_path(url, idx), (idx, idx))
+    cache.get(url, 1)
+    cache.put(url, 4, values)
+    assert [cache.get(url, idx) is not None for idx in range(1, 5)] == [True, False, True, True]
+
+def test_shared_cache_size_is_recomputed(tmp_path):
+    url = old_file(tmp_path)
+    cache = gributils.fieldstore.SharedLayerCache(str(tmp_path / "shared"))
+    cache.put(url, 1, np.zeros((10, 10)))
+    os.unlink(os.path.join(cache.path, ".size"))
+    cache.put(url, 2, np.zeros((10, 10)))
+    assert size_file(cache) == cache.stats()["size"]
+
+def test_shared_cache_smaller_than_an_entry(tmp_path):
+    url = old_file(tmp_path)
+    cache = gributils.fieldstore.SharedLayerCache(str(tmp_path / "shared"), maxsize=10)
+    latlons = (np.array([[60.0, 60.0]]), np.array([[10.0, 11.0]]))
+    lats, lons = cache.latlons("north", lambda: latlons)
+    np.testing.assert_array_equal(lons, latlons[1])
+    values = cache.load(url, 1, lambda: np.ones((2, 2)))
+    np.testing.assert_array_equal(values, np.ones((2, 2)))
+    assert cache.stats()["entries"] == 0 and size_file(cache) == 0
+
+def test_shared_cache_loads_from_backing(tmp_path):
+    url = old_file(tmp_path)
+    backing = gributils.fieldstore.FieldStore(str(tmp_path / "fields"))
+    calls = []
+    for name in ("a", "b"):
+        cache = gributils.fieldstore.SharedLayerCache(str(tmp_path / name), backing=backing)
+        cache.load(url, 1, decoder(np.ones((2, 2)), calls))
+        assert cache.stats()["misses"] == 1
+    assert len(calls) == 1
+    assert (backing.hits, backing.misses) == (1, 1)
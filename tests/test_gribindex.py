@@ -0,0 +1,280 @@
+import math
+import os
+import shutil
+import numpy as np
+import pygrib
+import pytest
+import gributils.backend
+import gributils.gribindex
+import gributils.manifest
+from conftest import timestamp, write_grib, grid_latlons, latlon_grid
+
+def test_points_same_as_single_points(index, gribs):
+    lats = [60, 58.3, 68, 40]
+    lons = [10, 12.7, -5, 10]
+    values = index.interp_latlon_points(gribs["wide"], 1, lats, lons)
+    assert len(values) == len(lats)
+    for lat, lon, value in zip(lats, lons, values):
+        single = index.interp_latlon(gribs["wide"], 1, lat, lon)
+        if single is None:
+            assert np.isnan(value)
+        else:
+            assert value == pytest.approx(single)
+    assert np.isnan(values[-1])
+
+def by_series(values):
+    return sorted(values, key=lambda value: (value["parameterName"], value["level"]))
+
+def assert_same_values(track, point):
+    assert len(track) == len(point)
+    for track_value, point_value in zip(by_series(track), by_series(point)):
+        assert track_value["parameterName"] == point_value["parameterName"]
+        if point_value["value"] is None:
+            assert track_value["value"] is None
+        else:
+            assert track_value["value"] == pytest.approx(point_value["value"])
+
+points = [
+    # At a validDate of layers on two grids
+    (60, 10, timestamp(8)),
+    # Between validDates of layers on two grids
+    (60, 10, timestamp(7, 30)),
+    (58, 12, timestamp(9, 30)),
+    # Only on one grid, which has no layer at 07:00 like the other
+    (68, -5, timestamp(7, 30)),
+    (68, -5, timestamp(6, 45)),
+    (51, 2, timestamp(6, 30)),
+    # Inside the buffered polygon of a grid, but outside its data
+    (60, 30.2, timestamp(7, 30)),
+    # Before the first layer
+    (60, 10, timestamp(5))]
+
+tracks = [
+    points,
+    # Starts after a layer on one grid, but before the bracketing
+    # layer of the other
+    [(60, 10, timestamp(7, 30)), (68, -5, timestamp(7, 30))]]
+
+@pytest.mark.parametrize("track", tracks)
+def test_track_same_as_timestamp(index, track):
+    values = index.interp_track([point[0] for point in track],
+                                [point[1] for point in track],
+                                [point[2] for point in track])
+    for point, point_values in zip(track, values):
+        assert_same_values(point_values, index.interp_timestamp(*point))
+
+def test_track_at_shared_validdate(index):
+    values = index.interp_track([60], [10], [timestamp(8)])[0]
+    assert values
+    assert all(value["value"] is not None and not math.isnan(value["value"]) for value in values)
+
+def test_outside_data_is_none(index):
+    assert all(value["value"] is None for value in index.interp_timestamp(60, 30.2, timestamp(7, 30)))
+    assert all(value["value"] is None for value in index.interp_track([60], [30.2], [timestamp(7, 30)])[0])
+
+def test_bounds_computed_once_per_grid(tmp_path, gribs, monkeypatch):
+    calls = []
+    extract_polygons = gributils.gribindex.GribIndex.extract_polygons
+    def counting_extract_polygons(self, layer):
+        calls.append(layer)
+        return extract_polygons(self, layer)
+    monkeypatch.setattr(gributils.gribindex.GribIndex, "extract_polygons", counting_extract_polygons)
+    database = str(tmp_path / "index.sqlite")
+    gributils.gribindex.GribIndex(database).add_file(gribs["wide"])
+    assert len(calls) == 1
+    # Another index on the same database finds the grid by its fingerprint
+    index = gributils.gribindex.GribIndex(database)
+    index.add_file(gribs["wide"])
+    assert len(calls) == 1
+    assert len(index.get_grids_for_position(60, 10)) == 1
+
+def grib_dir(tmp_path, gribs):
+    """A directory with the wide and narrow grib files, and a copy of
+    the wide one"""
+    basedir = tmp_path / "gribs"
+    basedir.mkdir()
+    for name in ("wide", "narrow"):
+        shutil.copy(gribs[name], basedir / ("%s.grb" % name))
+    shutil.copy(gribs["wide"], basedir / "copy.grb")
+    return str(basedir)
+
+def test_add_dir_with_workers(tmp_path, gribs):
+    errors = []
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    index.add_dir(grib_dir(tmp_path, gribs), errors.append, workers=2)
+    assert errors == []
+    assert len(index.backend.get_grids()) == 2
+    assert index.backend.db.execute("select count(*) from gridfingerprints").fetchone()[0] == 2
+    layers = index.backend.lookup(timestamp=timestamp(0), timestamp_end=timestamp(12))
+    assert len(layers) == 3 * 6
+    gridids = {os.path.basename(layer["url"]): layer["gridid"] for layer in layers}
+    assert gridids["wide.grb"] == gridids["copy.grb"] != gridids["narrow.grb"]
+
+def count_calls(monkeypatch, cls, name):
+    """Records the first argument of every call to a method"""
+    calls = []
+    method = getattr(cls, name)
+    def counting(self, arg, *args, **kw):
+        calls.append(arg)
+        return method(self, arg, *args, **kw)
+    monkeypatch.setattr(cls, name, counting)
+    return calls
+
+def test_add_dir_skips_added_files(tmp_path, gribs, monkeypatch):
+    basedir = grib_dir(tmp_path, gribs)
+    manifest = str(tmp_path / "manifest.sqlite")
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    decoded = count_calls(monkeypatch, gributils.gribindex.GribIndex, "iter_file")
+    index.add_dir(basedir, pytest.fail, manifest=manifest)
+    assert len(decoded) == 3
+    index.add_dir(basedir, pytest.fail, manifest=manifest)
+    assert len(decoded) == 3
+    # A file with a new mtime, but the same content, is hashed but not decoded
+    os.utime(os.path.join(basedir, "copy.grb"), (0, 0))
+    index.add_dir(basedir, pytest.fail, manifest=manifest)
+    assert len(decoded) == 3
+    shutil.copy(gribs["narrow"], os.path.join(basedir, "copy.grb"))
+    index.add_dir(basedir, pytest.fail, manifest=manifest)
+    assert decoded[3:] == [os.path.join(basedir, "copy.grb")]
+
+def test_add_dir_resumes(tmp_path, gribs, monkeypatch):
+    basedir = grib_dir(tmp_path, gribs)
+    manifest = str(tmp_path / "manifest.sqlite")
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    add_layers = index.backend.add_layers
+    def failing_add_layers(layers):
+        layers = list(layers)
+        if layers[0]["url"].endswith("narrow.grb"):
+            raise Exception("Interrupted")
+        return add_layers(layers)
+    monkeypatch.setattr(index.backend, "add_layers", failing_add_layers)
+    errors = []
+    index.add_dir(basedir, errors.append, manifest=manifest)
+    assert [error["file"] for error in errors] == [os.path.join(basedir, "narrow.grb")]
+
+    monkeypatch.setattr(index.backend, "add_layers", add_layers)
+    decoded = count_calls(monkeypatch, gributils.gribindex.GribIndex, "iter_file")
+    index.add_dir(basedir, pytest.fail, manifest=manifest)
+    assert decoded == [os.path.join(basedir, "narrow.grb")]
+    assert len(index.backend.lookup(timestamp=timestamp(0), timestamp_end=timestamp(12))) == 3 * 6
+
+def test_adding_a_file_again_replaces_its_layers(tmp_path, gribs):
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    index.add_file(gribs["wide"])
+    index.add_file(gribs["wide"])
+    layers = index.backend.lookup(timestamp=timestamp(0), timestamp_end=timestamp(12))
+    assert len(layers) == 6
+    ids = {row[0] for row in index.backend.db.execute("select id from layers")}
+    assert ids == {gributils.backend.layer_id(gribs["wide"], idx) for idx in range(1, 7)}
+
+def test_grids_added_by_another_index(tmp_path, gribs):
+    database = str(tmp_path / "index.sqlite")
+    server = gributils.gribindex.GribIndex(database)
+    server.add_file(gribs["wide"])
+    assert server.interp_timestamp(60, 10, timestamp(7))
+    assert server.interp_timestamp(25, 105, timestamp(7)) == []
+
+    far = write_grib(tmp_path / "far.grb", latlon_grid(first_lat=30.0, last_lat=20.0, first_lon=100.0, last_lon=110.0), [0, 3])
+    other = gributils.gribindex.GribIndex(database)
+    other.add_file(far)
+    assert server.get_grids_for_position(25, 105) == other.get_grids_for_position(25, 105) != []
+    assert server.interp_timestamp(25, 105, timestamp(7)) == other.interp_timestamp(25, 105, timestamp(7)) != []
+    assert server.interp_track([60, 25], [10, 105], [timestamp(7), timestamp(7)])[1] != []
+
+def test_overlapping_grids_added_by_another_index(tmp_path, gribs):
+    database = str(tmp_path / "index.sqlite")
+    server = gributils.gribindex.GribIndex(database, grid_ttl=0)
+    server.add_file(gribs["wide"])
+    assert len(server.get_grids_for_position(60, 10)) == 1
+    gributils.gribindex.GribIndex(database).add_file(gribs["narrow"])
+    assert len(server.get_grids_for_position(60, 10)) == 2
+
+def test_add_dir_streams_layers(tmp_path, gribs, monkeypatch):
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    formatted = count_calls(monkeypatch, gributils.gribindex.GribIndex, "format_layer")
+    add_layers = index.backend.add_layers
+    written = []
+    def recording_add_layers(layers):
+        def record(layers):
+            for layer in layers:
+                written.append(len(formatted))
+                yield layer
+        return add_layers(record(layers))
+    monkeypatch.setattr(index.backend, "add_layers", recording_add_layers)
+    index.add_dir(grib_dir(tmp_path, gribs), pytest.fail)
+    # Each layer is written before the next one is decoded
+    assert written == list(range(1, 3 * 6 + 1))
+
+def test_copies_are_returned_once(tmp_path, gribs):
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    copy = str(tmp_path / "copy.grb")
+    shutil.copy(gribs["wide"], copy)
+    index.add_file(gribs["wide"])
+    index.add_file(copy)
+    assert index.has_content(gributils.manifest.file_hash(copy))
+    assert not index.has_content(gributils.manifest.file_hash(gribs["narrow"]))
+    layers = index.lookup(lat=60, lon=10, timestamp=timestamp(0), timestamp_end=timestamp(12))
+    assert len(layers) == 6 and len({layer["url"] for layer in layers}) == 1
+    assert len(index.lookup(lat=60, lon=10, timestamp=timestamp(7))) == 2
+    assert index.lookup("names") == [{"key": "Temperature", "doc_count": 3},
+                                     {"key": "u-component of wind", "doc_count": 3}]
+
+def test_unique_layers_streams():
+    def entries():
+        for hour in range(10):
+            for url in ("a.grb", "b.grb"):
+                yield {"validDate": "2018-08-30T%02d:00:00.000000Z" % hour, "url": url,
+                       "contentHash": "abc", "idx": hour}
+            yield {"validDate": "2018-08-30T%02d:00:00.000000Z" % hour, "url": "c.grb", "idx": hour}
+        raise AssertionError("Read past the end")
+    res = gributils.gribindex.unique_layers(entries())
+    assert [(entry["url"], entry["idx"]) for idx, entry in zip(range(20), res)] == [
+        (url, hour) for hour in range(10) for url in ("a.grb", "c.grb")]
+
+@pytest.fixture
+def forecasts(tmp_path, gribs):
+    """A local index of the wide grid, and a later forecast on the
+    same grid with layers at some of the same validDates"""
+    index = gributils.gribindex.GribIndex(str(tmp_path / "forecasts.sqlite"))
+    index.add_file(gribs["wide"])
+    index.add_file(write_grib(tmp_path / "later.grb", latlon_grid(), [0, 1], offset=100, analysis=8))
+    return index
+
+def test_timeseries(forecasts, gribs):
+    res = forecasts.timeseries(lat=60, lon=10, start=timestamp(5), end=timestamp(10))
+    assert [series["parameterName"] for series in res] == ["Temperature", "u-component of wind"]
+    assert res[0]["validDate"] == ["2018-08-30T%02d:00:00.000000Z" % hour for hour in (6, 8, 9)]
+    # The later forecast is used where both have a layer
+    value = gributils.gribindex.GribIndex(":memory:").interp_latlon(gribs["wide"], 1, 60, 10)
+    assert res[0]["value"] == pytest.approx([value, value + 100, value + 101])
+
+def test_timeseries_with_step(forecasts):
+    res = forecasts.timeseries(lat=60, lon=10, start=timestamp(5), end=timestamp(10), step=3600,
+                               parameter_name="Temperature")
+    assert len(res) == 1
+    assert res[0]["validDate"] == ["2018-08-30T%02d:00:00.000000Z" % hour for hour in range(5, 11)]
+    assert math.isnan(res[0]["value"][0]) and math.isnan(res[0]["value"][-1])
+    value = res[0]["value"][1]
+    assert res[0]["value"][1:-1] == pytest.approx([value, value + 50, value + 100, value + 101])
+
+@pytest.mark.parametrize("stride", [1, 2, 3])
+def test_subset(gribs, stride):
+    index = gributils.gribindex.GribIndex(":memory:")
+    values, georef = index.subset(gribs["wide"], 1, minlat=55, minlon=0, maxlat=60, maxlon=5, stride=stride)
+    data = pygrib.open(gribs["wide"])[1].values
+    assert values.dtype == np.float32
+    assert georef["window"] == [40, 61, 40, 61] and georef["gridShape"] == [81, 161]
+    np.testing.assert_array_equal(values, data[40:61:stride, 40:61:stride].astype(np.float32))
+    assert georef["shape"] == list(values.shape) and georef["stride"] == stride
+    assert georef["validDate"] == "2018-08-30T06:00:00.000000Z"
+    # Row r, column c is the grid point at x0 + c * dx, y0 + r * dy
+    lats, lons = grid_latlons(gribs["wide"])
+    rows, cols = values.shape
+    assert georef["y0"] + (rows - 1) * georef["dy"] == pytest.approx(lats[40 + (rows - 1) * stride, 0])
+    assert (georef["x0"] + (cols - 1) * georef["dx"]) % 360 == pytest.approx(lons[0, 40 + (cols - 1) * stride])
+    assert (georef["y0"], georef["x0"] % 360, georef["dy"]) == pytest.approx((60, 0, -0.25 * stride))
+
+def test_subset_outside_grid(gribs):
+    index = gributils.gribindex.GribIndex(":memory:")
+    values, georef = index.subset(gribs["wide"], 1, minlat=-50, minlon=100, maxlat=-40, maxlon=120)
+    assert values is None and georef["gridShape"] == [81, 161]
@@ -0,0 +1,74 @@
+import shutil
+import threading
+import time
+import pytest
+import gributils.gribindex
+import gributils.ingest
+
+class BlockingIndex(object):
+    """Adds files once released"""
+    def __init__(self):
+        self.released = threading.Event()
+        self.files = []
+
+    def add_file(self, filepath, cb=None, **kw):
+        self.released.wait(10)
+        if filepath == "broken.grb":
+            raise Exception("Not a grib file")
+        if filepath == "partial.grb":
+            cb({"file": filepath, "idx": 2, "error": Exception("Rejected")})
+        self.files.append((filepath, kw))
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_queue_is_bounded():
+    index = BlockingIndex()
+    ingest = gributils.ingest.IngestQueue(index, workers=1, size=1)
+    running = ingest.submit("a.grb")
+    wait_for(lambda: ingest.status(running)["status"] == "running")
+    queued = ingest.submit("b.grb", parametermap="arome")
+    assert ingest.full()
+    with pytest.raises(gributils.ingest.QueueFull):
+        ingest.submit("c.grb")
+    assert ingest.status(queued)["status"] == "queued"
+    assert ingest.stats()["jobs"] == {"running": 1, "queued": 1}
+    index.released.set()
+    ingest.queue.join()
+    assert ingest.status(running)["status"] == ingest.status(queued)["status"] == "done"
+    assert index.files == [("a.grb", {}), ("b.grb", {"parametermap": "arome"})]
+
+def test_job_status():
+    index = BlockingIndex()
+    index.released.set()
+    ingest = gributils.ingest.IngestQueue(index, workers=2, keep=2)
+    jobs = [ingest.submit(filepath, content_hash="abc") for filepath in ("a.grb", "broken.grb", "partial.grb")]
+    ingest.queue.join()
+    assert ingest.status("unknown") is None
+    statuses = [ingest.status(job) for job in jobs]
+    assert [status and status["status"] for status in statuses].count("failed") == 2
+    # Only the last keep finished jobs are remembered
+    assert statuses.count(None) == 1
+    for status in statuses:
+        if status is None:
+            continue
+        assert status["hash"] == "abc" and status["submitted"] <= status["started"] <= status["finished"]
+        if status["file"] == "broken.grb":
+            assert status["error"] == "Not a grib file"
+        elif status["file"] == "partial.grb":
+            assert status["errors"] == [{"file": "partial.grb", "idx": 2, "error": "Rejected"}]
+
+def test_concurrent_files_on_one_grid(tmp_path, gribs):
+    index = gributils.gribindex.GribIndex(str(tmp_path / "index.sqlite"))
+    ingest = gributils.ingest.IngestQueue(index, workers=4)
+    jobs = []
+    for idx in range(4):
+        path = str(tmp_path / ("copy%s.grb" % idx))
+        shutil.copy(gribs["wide"], path)
+        jobs.append(ingest.submit(path))
+    ingest.queue.join()
+    assert [ingest.status(job)["status"] for job in jobs] == ["done"] * 4
+    assert len(index.backend.get_grids()) == 1
@@ -0,0 +1,40 @@
+import numpy as np
+import scipy.interpolate
+import gributils.interpolation
+
+class IndexMapper(object):
+    """Maps lat, lon directly to row, column"""
+    def indices(self, lats, lons):
+        return np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+
+def test_exact_at_nodes():
+    data = np.random.default_rng(0).normal(size=(20, 30))
+    interpolator = gributils.interpolation.GridInterpolator(data, IndexMapper())
+    rows, cols = np.mgrid[0:20, 0:30]
+    assert np.allclose(interpolator(rows.ravel(), cols.ravel()), data.ravel(), rtol=0, atol=1e-12)
+
+def test_close_to_bicubic_spline():
+    # scipy's interp2d, used before, fitted a bicubic spline through the
+    # grid (RectBivariateSpline is its replacement for gridded data)
+    y = np.arange(40.0)
+    x = np.arange(50.0)
+    data = np.sin(y[:,None] / 6) * np.cos(x[None,:] / 8) * 10
+    spline = scipy.interpolate.RectBivariateSpline(y, x, data, kx=3, ky=3, s=0)
+    rnd = np.random.default_rng(1)
+    rows = rnd.uniform(1, 38, 500)
+    cols = rnd.uniform(1, 48, 500)
+    interpolator = gributils.interpolation.GridInterpolator(data, IndexMapper())
+    assert np.abs(interpolator(rows, cols) - spline.ev(rows, cols)).max() < 0.01
+
+def test_outside_and_missing_values_are_nan():
+    data = np.ma.masked_array(np.ones((10, 10)), mask=False)
+    data[5, 5] = np.ma.masked
+    interpolator = gributils.interpolation.GridInterpolator(data, IndexMapper())
+    values = interpolator([-0.5, 4.5, 2, 9], [2, 4.5, 10.5, 9])
+    assert np.isnan(values[:3]).all()
+    assert values[3] == 1
+
+def test_linear():
+    data = np.arange(12.0).reshape(3, 4)
+    interpolator = gributils.interpolation.GridInterpolator(data, IndexMapper(), method="linear")
+    assert np.allclose(interpolator([0.5, 1.25], [0.5, 2.5]), [2.5, 7.5])
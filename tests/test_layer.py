@@ -0,0 +1,27 @@
+import numpy as np
+import gributils.layer
+
+def test_read_by_offset(gribs):
+    with open(gribs["lambert"], "rb") as f:
+        data = f.read()
+    messages = list(gributils.layer.read_messages(gribs["lambert"]))
+    assert len(messages) == 4
+    file = gributils.layer.GribFile(gribs["lambert"])
+    try:
+        for idx, (grb, offset, length) in enumerate(messages, 1):
+            assert data[offset:offset+4] == b"GRIB"
+            assert data[offset+length-4:offset+length] == b"7777"
+            by_offset = file.message(idx, offset, length)
+            by_idx = file.message(idx)
+            assert by_offset.validDate == by_idx.validDate == grb.validDate
+            assert np.array_equal(by_offset.values, by_idx.values)
+    finally:
+        file.close()
+    assert messages[-1][1] + messages[-1][2] == len(data)
+
+def test_index_stores_offsets(index, gribs):
+    layers = index.lookup(gridids=index.get_grids_for_position(51, 2), parameter_name="Temperature")
+    assert layers and all("offset" in layer and "length" in layer for layer in layers)
+    for layer in layers:
+        assert np.array_equal(index.get_layer(layer).interpolate.data,
+                              index.layercache.load(layer["url"], layer["idx"]).interpolate.data)
@@ -0,0 +1,83 @@
+import datetime
+import pytest
+import shapely
+import gributils.localbackend
+from conftest import index_layer as layer
+
+layers = [
+    layer("a.grb", 1, 6),
+    layer("a.grb", 2, 6, "Wind", 10),
+    layer("a.grb", 3, 9),
+    layer("a.grb", 4, 9, "Wind", 10),
+    layer("b.grb", 1, 6, gridid="south"),
+    layer("b.grb", 2, 12, level=100, gridid="south")]
+
+def ids(layers):
+    return [(layer["url"], layer["idx"]) for layer in layers]
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = gributils.localbackend.LocalBackend(str(tmp_path / "index.sqlite"))
+    backend.add_grid("north", {"proj": "cyl"}, shapely.box(0, 50, 20, 70).wkt)
+    backend.add_grid("south", {"proj": "cyl"}, shapely.box(10, 40, 30, 60).wkt)
+    assert backend.add_layers(layers) == []
+    return backend
+
+def test_grids(backend):
+    assert backend.has_grid("north") and not backend.has_grid("west")
+    assert sorted(backend.get_grids_for_position(55, 15)) == ["north", "south"]
+    assert backend.get_grids_for_position(65, 5) == ["north"]
+    assert backend.get_grids_for_position(30, 5) == []
+    assert backend.get_grids_for_bbox(-10, 30, 5, 45) == {}
+    assert sorted(backend.get_grids_for_bbox(25, 30, 40, 45)) == ["south"]
+    # Registering a grid again is harmless
+    backend.add_grid("north", {"proj": "cyl"}, shapely.box(0, 50, 20, 70).wkt)
+    assert sorted(backend.get_grids()) == ["north", "south"]
+
+def test_parametermaps(backend):
+    backend.add_parametermap("arome", {"11": ["Temperature", "K"]})
+    assert backend.get_parametermaps() == ["arome"]
+    assert backend.get_parametermap("arome") == {"11": ["Temperature", "K"]}
+    assert backend.get_parametermap("hirlam") is None
+
+def test_outputs(backend):
+    assert backend.lookup("names") == [{"key": "Temperature", "doc_count": 4}, {"key": "Wind", "doc_count": 2}]
+    assert backend.lookup("units") == [{"key": "K", "doc_count": 4}, {"key": "m s-1", "doc_count": 2}]
+    assert backend.lookup("level-types") == [{"key": "heightAboveGround", "doc_count": 6}]
+    assert backend.lookup("levels", gridids=["north"]) == [{"key": 2, "doc_count": 2}, {"key": 10, "doc_count": 2}]
+    with pytest.raises(Exception):
+        backend.lookup("colors")
+
+def test_filters(backend):
+    assert ids(backend.lookup(parameter_name="Wind")) == [("a.grb", 2), ("a.grb", 4)]
+    assert ids(backend.lookup(gridids=["south"])) == [("b.grb", 1), ("b.grb", 2)]
+    assert ids(backend.lookup(parameter_name="Temperature", level=10)) == [("a.grb", 1), ("b.grb", 1), ("a.grb", 3)]
+    assert ids(backend.lookup(parameter_name="Temperature", level=10, level_highest_below=False)) == [("b.grb", 2)]
+    assert ids(backend.lookup(timestamp=datetime.datetime(2018, 8, 30, 7),
+                              timestamp_end=datetime.datetime(2018, 8, 30, 12))) == [
+                                  ("a.grb", 3), ("a.grb", 4), ("b.grb", 2)]
+
+def test_last_before_and_first_after(backend):
+    timestamp = datetime.datetime(2018, 8, 30, 7)
+    # One layer per series. Of the layers at the same validDate, the
+    # last before is the last by url and idx, the first after the first.
+    assert sorted(ids(backend.lookup(timestamp=timestamp, timestamp_last_before=1))) == [("a.grb", 2), ("b.grb", 1)]
+    assert sorted(ids(backend.lookup(timestamp=timestamp, timestamp_last_before=0))) == [("a.grb", 3), ("a.grb", 4), ("b.grb", 2)]
+    assert sorted(ids(backend.lookup(timestamp=datetime.datetime(2018, 8, 30, 6), timestamp_last_before=0))) == [
+        ("a.grb", 1), ("a.grb", 2), ("b.grb", 2)]
+    assert sorted(ids(backend.lookup(timestamp=timestamp, timestamp_last_before=1, gridids=["north"]))) == [("a.grb", 1), ("a.grb", 2)]
+
+def test_lookup_bracket(backend):
+    timestamp = datetime.datetime(2018, 8, 30, 7)
+    before, after = backend.lookup_bracket(timestamp, parameter_name="Temperature")
+    assert before == backend.lookup(timestamp=timestamp, timestamp_last_before=1, parameter_name="Temperature")
+    assert after == backend.lookup(timestamp=timestamp, timestamp_last_before=0, parameter_name="Temperature")
+
+def test_results_are_paged(backend, monkeypatch):
+    monkeypatch.setattr(gributils.localbackend, "page_size", 2)
+    backend.add_layers([layer("c.grb", idx, 15) for idx in range(1, 8)])
+    res = backend.iter_lookup(timestamp=datetime.datetime(2018, 8, 30, 0),
+                              timestamp_end=datetime.datetime(2018, 8, 30, 18))
+    assert not isinstance(res, list)
+    assert ids(res) == [("a.grb", 1), ("a.grb", 2), ("b.grb", 1), ("a.grb", 3), ("a.grb", 4), ("b.grb", 2)] + [
+        ("c.grb", idx) for idx in range(1, 8)]
@@ -0,0 +1,66 @@
+import numpy as np
+import pygrib
+import pytest
+import shapely
+import gributils.bounds
+import gributils.projection
+from conftest import write_grib, grid_latlons, latlon_grid, lambert_grid
+
+grids = {
+    "latlon": latlon_grid(first_lat=50.0, last_lat=60.0, first_lon=0.0, last_lon=20.0, step=0.5),
+    "latlon_north_to_south": latlon_grid(first_lat=60.0, last_lat=50.0, first_lon=0.0, last_lon=20.0, step=0.5),
+    "latlon_wrapping": latlon_grid(),
+    "latlon_i_negative": latlon_grid(first_lon=30.0, last_lon=350.0, iScansNegatively=1),
+    "lambert": lambert_grid()}
+
+@pytest.mark.parametrize("name", sorted(grids.keys()))
+def test_indices_of_grid_points(tmp_path, name):
+    path = write_grib(tmp_path / "grid.grb", grids[name], [0])
+    layer = pygrib.open(path)[1]
+    lats, lons = grid_latlons(path)
+    mapper = gributils.projection.GridMapper(layer)
+    rows, cols = mapper.indices(lats, lons)
+    expected_rows, expected_cols = np.mgrid[0:lats.shape[0], 0:lats.shape[1]]
+    assert np.allclose(rows, expected_rows, atol=1e-3)
+    assert np.allclose(cols, expected_cols, atol=1e-3)
+
+def test_lambert_negative_j_scanning(tmp_path):
+    # The same grid points, scanned from the north west corner
+    path = write_grib(tmp_path / "north.grb", lambert_grid(), [0])
+    lats, lons = grid_latlons(path)
+    layer = pygrib.open(write_grib(tmp_path / "south.grb",
+                                   lambert_grid(first_lat=lats[-1,0], first_lon=lons[-1,0], j_positive=0),
+                                   [0]))[1]
+    mapper = gributils.projection.GridMapper(layer)
+    rows, cols = mapper.indices(lats, lons)
+    expected_rows, expected_cols = np.mgrid[0:lats.shape[0], 0:lats.shape[1]]
+    assert np.allclose(rows, expected_rows[::-1], atol=1e-3)
+    assert np.allclose(cols, expected_cols, atol=1e-3)
+
+def test_window(tmp_path):
+    layer = pygrib.open(write_grib(tmp_path / "grid.grb", latlon_grid(), [0]))[1]
+    mapper = gributils.projection.GridMapper(layer)
+    assert mapper.window(55, 0, 60, 5, (81, 161)) == (40, 61, 40, 61)
+    assert mapper.window(-50, 100, -40, 120, (81, 161)) is None
+
+def test_projections_are_shared(tmp_path):
+    path = write_grib(tmp_path / "grid.grb", lambert_grid(), [0, 1])
+    first, second = [message for message in pygrib.open(path)][:2]
+    assert gributils.projection.layer_projection(first) is gributils.projection.layer_projection(second)
+    other = pygrib.open(write_grib(tmp_path / "other.grb", lambert_grid(first_lat=55.0), [0]))[1]
+    assert gributils.projection.layer_projection(other) is not gributils.projection.layer_projection(first)
+    assert gributils.projection.layer_projection(other).unproject == gributils.projection.layer_projection(first).unproject
+
+def test_wrapping_longitude_step(tmp_path):
+    layer = pygrib.open(write_grib(tmp_path / "grid.grb", latlon_grid(), [0]))[1]
+    proj = gributils.projection.layer_projection(layer)
+    assert proj.dx == pytest.approx(0.25)
+    mapper = gributils.projection.GridMapper(layer)
+    rows, cols = mapper.indices([60, 60, 60], [-10, 0, 30])
+    assert np.allclose(cols, [0, 40, 160])
+    assert np.allclose(rows, [40, 40, 40])
+    polygon = gributils.bounds.bounds(layer)
+    assert polygon.contains(shapely.Point(10, 60)) and polygon.contains(shapely.Point(-5, 60))
+    assert not polygon.contains(shapely.Point(100, 60))
+    layer = pygrib.open(write_grib(tmp_path / "negative.grb", grids["latlon_i_negative"], [0]))[1]
+    assert gributils.projection.layer_projection(layer).dx == pytest.approx(-0.25)
@@ -0,0 +1,135 @@
+import hashlib
+import io
+import json
+import os
+import numpy as np
+import pytest
+import gributils.ingest
+import gributils.manifest
+import gributils.server
+from conftest import timestamp, write_grib, latlon_grid
+
+@pytest.fixture
+def client(index, tmp_path, monkeypatch):
+    monkeypatch.setattr(gributils.server, "index", index)
+    (tmp_path / "files").mkdir()
+    monkeypatch.setattr(gributils.server, "filearea", str(tmp_path / "files"))
+    monkeypatch.setattr(gributils.server, "ingest", gributils.ingest.IngestQueue(index, workers=1))
+    return gributils.server.app.test_client()
+
+def test_interpolate_points(client, gribs):
+    query = {"gribfile": gribs["wide"], "layeridx": 1}
+    res = client.post("/index/interpolate/latlon", query_string=query,
+                      data=json.dumps({"lat": [60, 40], "lon": [10, 10]}))
+    assert res.status_code == 200
+    values = json.loads(res.data)
+    single = json.loads(client.get("/index/interpolate/latlon",
+                                   query_string=dict(query, lat=60, lon=10)).data)
+    assert values[0] == pytest.approx(single)
+    assert values[1] is None
+
+def rows(res):
+    assert res.status_code == 200
+    return [json.loads(line) for line in res.data.decode("utf-8").splitlines()]
+
+def test_interpolate_track(client):
+    track = {"lat": [60, 60], "lon": [10, 30.2],
+             "timestamp": ["2018-08-30T07:30:00.000000Z", "2018-08-30T07:30:00.000000Z"]}
+    values = rows(client.post("/index/interpolate/track", data=json.dumps(track)))
+    assert len(values) == 2
+    point = rows(client.get("/index/interpolate/timestamp", query_string={
+        "lat": 60, "lon": 10, "timestamp": "2018-08-30T07:30:00.000000Z"}))
+    assert sorted(value["value"] for value in values[0]) == pytest.approx(sorted(value["value"] for value in point))
+    # Outside the data of the grid
+    assert values[1] and all(value["value"] is None for value in values[1])
+
+def test_stats(client, gribs):
+    client.get("/index/interpolate/latlon", query_string={"gribfile": gribs["wide"], "layeridx": 1, "lat": 60, "lon": 10})
+    stats = json.loads(client.get("/stats").data)
+    assert stats["layers"]["misses"] == 1
+    assert stats["files"]["entries"] == 1
+
+def test_lookup(client, index):
+    query = {"output": "layers", "lat": 60, "lon": 10}
+    res = client.get("/index/lookup", query_string=query)
+    assert res.is_streamed and res.mimetype == "application/x-ndjson"
+    layers = rows(res)
+    assert len(layers) == len(index.lookup(lat=60, lon=10)) == 12
+    assert json.loads(client.get("/index/lookup", query_string=dict(query, pretty="true")).data) == layers
+    names = rows(client.get("/index/lookup", query_string={"output": "names"}))
+    assert [name["key"] for name in names] == ["Temperature", "u-component of wind"]
+
+def test_add(client, tmp_path):
+    path = write_grib(tmp_path / "far.grb", latlon_grid(first_lat=30.0, last_lat=20.0, first_lon=100.0, last_lon=110.0), [0])
+    with open(path, "rb") as f:
+        res = client.post("/index/add", data=f.read(), query_string={"extra": json.dumps({"source": "test"})})
+    assert res.status_code == 202
+    job = json.loads(res.data)
+    assert job["status"] == "queued" and res.headers["Location"] == "/index/jobs/%s" % job["job"]
+    gributils.server.ingest.queue.join()
+    status = json.loads(client.get(res.headers["Location"]).data)
+    assert status["status"] == "done" and status["hash"] == job["hash"]
+    layers = gributils.server.index.lookup(lat=25, lon=105)
+    assert layers and all(layer["source"] == "test" for layer in layers)
+
+def test_add_to_full_queue(client, monkeypatch):
+    monkeypatch.setattr(gributils.server.ingest, "full", lambda: True)
+    res = client.post("/index/add", data=b"GRIB")
+    assert res.status_code == 429 and res.headers["Retry-After"]
+
+def test_unknown_job(client):
+    assert client.get("/index/jobs/unknown").status_code == 404
+
+def test_uploads_are_stored_by_content(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(gributils.server.ingest, "submit", lambda filepath, **kw: "job")
+    data = b"GRIB" + bytes(range(256)) * 10000
+    content_hash = hashlib.sha256(data).hexdigest()
+    res = client.post("/index/add", data=data)
+    assert json.loads(res.data)["hash"] == content_hash
+    with open(tmp_path / "files" / content_hash[:2] / ("%s.grb" % content_hash), "rb") as f:
+        assert f.read() == data
+    assert os.listdir(tmp_path / "files" / "incoming") == []
+
+def test_parametermap_upload(client):
+    res = client.post("/index/parametermap/add", query_string={"name": "arome"},
+                      data=b'parameter,name,unit\n"11","Temperature","K"\n')
+    assert res.status_code == 200
+    assert json.loads(client.get("/index/parametermap").data) == ["arome"]
+    assert gributils.server.index.backend.get_parametermap("arome") == {"11": ["Temperature", "K"]}
+
+def test_add_indexed_content(client, gribs):
+    with open(gribs["wide"], "rb") as f:
+        res = client.post("/index/add", data=f.read())
+    assert res.status_code == 200
+    assert json.loads(res.data) == {"status": "exists", "hash": gributils.manifest.file_hash(gribs["wide"])}
+    assert gributils.server.ingest.stats()["jobs"] == {}
+
+def test_timeseries(client, index):
+    query = {"lat": 60, "lon": 10, "start": "2018-08-30T05:00:00.000000Z", "end": "2018-08-30T11:00:00.000000Z",
+             "step": 3600, "parameter_name": "Temperature"}
+    series = rows(client.get("/index/timeseries", query_string=query))
+    assert len(series) == 1
+    assert len(series[0]["validDate"]) == 7
+    values = series[0]["value"]
+    assert values[0] is None and values[-1] is None
+    expected = index.timeseries(lat=60, lon=10, start=timestamp(5), end=timestamp(11), step=3600,
+                                parameter_name="Temperature")
+    assert values[1:-1] == pytest.approx(expected[0]["value"][1:-1])
+
+def test_subset(client, index, gribs):
+    query = {"gribfile": gribs["wide"], "layeridx": 1, "minlat": 55, "minlon": 0, "maxlat": 60, "maxlon": 5, "stride": 2}
+    expected, georef = index.subset(**query)
+    res = client.get("/index/subset", query_string=query)
+    assert res.status_code == 200
+    assert json.loads(res.headers["X-Gributils-Georef"]) == json.loads(json.dumps(georef))
+    values = np.load(io.BytesIO(res.data))
+    assert values.dtype == np.float32
+    np.testing.assert_array_equal(values, expected)
+    raw = client.get("/index/subset", query_string=dict(query, format="raw"))
+    np.testing.assert_array_equal(np.frombuffer(raw.data, dtype=np.float32).reshape(georef["shape"]), expected)
+
+def test_subset_outside_grid(client, gribs):
+    res = client.get("/index/subset", query_string={
+        "gribfile": gribs["wide"], "layeridx": 1, "minlat": -50, "minlon": 100, "maxlat": -40, "maxlon": 120})
+    assert res.status_code == 404
+    assert json.loads(res.data)["error"] == "outside_grid"
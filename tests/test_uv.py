@@ -0,0 +1,22 @@
+import numpy as np
+import pygrib
+import pytest
+import gributils.uv
+from conftest import write_grib, latlon_grid
+
+grids = {
+    "south_to_north": latlon_grid(first_lat=50.0, last_lat=60.0, first_lon=0.0, last_lon=20.0, step=0.5),
+    "north_to_south": latlon_grid(first_lat=60.0, last_lat=50.0, first_lon=0.0, last_lon=20.0, step=0.5),
+    "i_negative": latlon_grid(first_lat=60.0, last_lat=50.0, first_lon=20.0, last_lon=0.0, step=0.5,
+                              iScansNegatively=1)}
+
+@pytest.mark.parametrize("name", sorted(grids.keys()))
+def test_azimuth_whatever_the_scanning_direction(tmp_path, name):
+    layer = pygrib.open(write_grib(tmp_path / "grid.grb", grids[name], [0]))[1]
+    zeros = np.zeros(layer.values.shape)
+    ones = np.ones(layer.values.shape)
+    magnitude, azimuth = gributils.uv.uv_to_magnitude_azimuth(layer, layer, zeros, ones)
+    assert np.allclose(magnitude, 1)
+    assert np.allclose(azimuth, 0, atol=1e-6)
+    magnitude, azimuth = gributils.uv.uv_to_magnitude_azimuth(layer, layer, ones, zeros)
+    assert np.allclose(azimuth, 90, atol=0.5)